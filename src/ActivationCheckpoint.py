@@ -0,0 +1,86 @@
+import contextlib
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
+
+# encoder stages and decoder blocks of LinkNet34 / 50 / 50_full, LinkNeXt and UNet11
+checkpoint_stages = ['encoder1','encoder2','encoder3','encoder4',
+                     'decoder4','decoder3','decoder2','decoder1',
+                     'center','dec5','dec4','dec3','dec2']
+
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    """Keep BatchNorm running stats as they are while a block is recomputed"""
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in norms]
+    tracked = [m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum, count in zip(norms, momenta, tracked):
+            m.momentum = momentum
+            if count is not None:
+                m.num_batches_tracked.copy_(count)
+
+class CheckpointedMixin(object):
+    """
+    Drops the activations of the block in training and recomputes them in
+    the backward pass, the block keeps its class attributes and state_dict keys
+    """
+    def forward(self, *inputs):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super().forward,
+                              *inputs,
+                              use_reentrant=False,
+                              context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(self)))
+        return super().forward(*inputs)
+
+_checkpointed_classes = {}
+
+def checkpointed_class(cls):
+    if cls not in _checkpointed_classes:
+        _checkpointed_classes[cls] = type('Checkpointed' + cls.__name__, (CheckpointedMixin, cls), {})
+    return _checkpointed_classes[cls]
+
+def checkpoint_activations(model):
+    """
+    Switch the encoder stages and decoder blocks of the model to activation
+    checkpointing in place, return the names of the switched blocks
+    The class of every block is swapped instead of wrapping it, so checkpoints
+    stay compatible and DataParallel replicas keep checkpointing
+    """
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+        model = model.module
+    names = []
+    for name in checkpoint_stages:
+        block = getattr(model, name, None)
+        if isinstance(block, nn.Module) and not isinstance(block, CheckpointedMixin):
+            block.__class__ = checkpointed_class(block.__class__)
+            names.append(name)
+    if not names:
+        raise ValueError('Activation checkpointing not supported for {}'.format(type(model).__name__))
+    return names
+
+@contextlib.contextmanager
+def saved_activation_meter():
+    """
+    Count the bytes autograd keeps for the backward pass inside the context,
+    parameters and tensors saved more than once are counted once
+    Works on any device, unlike torch.cuda.max_memory_allocated
+    """
+    stats = {'bytes': 0}
+    seen = set()
+
+    def pack(tensor):
+        if not isinstance(tensor, nn.Parameter):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in seen:
+                seen.add(storage.data_ptr())
+                stats['bytes'] += storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        yield stats
@@ -0,0 +1,89 @@
+import atexit
+import glob
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+def to_cpu(obj):
+    """Copy of the tensors of a (nested) checkpoint dict on the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+def link_or_copy(src, dst):
+    """Atomically make dst the same file as src, a hardlink where the file system supports it"""
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+def epoch_filename(filename, epoch):
+    """weights/x_checkpoint.pth.tar -> weights/x_checkpoint_epoch12.pth.tar"""
+    base, ext = filename[:-len('.pth.tar')], '.pth.tar'
+    if not filename.endswith(ext):
+        base, ext = os.path.splitext(filename)
+    return '{}_epoch{}{}'.format(base, epoch, ext)
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints in a background thread
+    The state is copied to the CPU on the calling thread, serialized to a temp
+    file and renamed over the checkpoint, so a crash never leaves a partial file
+    The best checkpoint is a hardlink to the same file instead of a second copy
+    With keep > 0 the last `keep` epochs are also kept as *_epoch{N} hardlinks
+    At most one save is in flight, the next save waits for it and re-raises its error
+    """
+    def __init__(self, keep=0):
+        self.keep = keep
+        self.pool = ThreadPoolExecutor(1)
+        self.pending = None
+        atexit.register(self.close)
+
+    def _write(self, state, is_best, filename, best_filename):
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp = filename + '.tmp'
+        torch.save(state, tmp)
+        if is_best:
+            link_or_copy(tmp, best_filename)
+        if self.keep > 0 and 'epoch' in state:
+            link_or_copy(tmp, epoch_filename(filename, state['epoch']))
+            self._prune(filename)
+        os.replace(tmp, filename)
+
+    def _prune(self, filename):
+        pattern = re.escape(epoch_filename(filename, 'EPOCH')).replace('EPOCH', r'(\d+)')
+        epochs = []
+        for path in glob.glob(epoch_filename(glob.escape(filename), '*')):
+            match = re.fullmatch(pattern, path)
+            if match:
+                epochs.append((int(match.group(1)), path))
+        for _, path in sorted(epochs)[:-self.keep]:
+            os.remove(path)
+
+    def save(self, state, is_best, filename, best_filename):
+        state = to_cpu(state)
+        self.flush()
+        self.pending = self.pool.submit(self._write, state, is_best, filename, best_filename)
+
+    def flush(self):
+        """Wait for the save in flight, re-raise its error"""
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.result()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
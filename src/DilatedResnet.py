@@ -154,6 +154,33 @@ class ResNet(nn.Module):
 
         return x
 
+# encoder batching modes of the GapNets
+# 'eval'   - batch the shared encoder passes in eval mode only, training is unchanged
+# 'always' - also batch in training, BatchNorm then sees the statistics of all the inputs at once
+# 'never'  - run the shared encoder once per input as before
+batch_encoder_modes = ['eval','always','never']
+
+def encoder_forward(model, x):
+    """Shared firstbn -> encoder4 stem of the GapNets"""
+    x = model.firstbn(x)
+    x = model.firstrelu(x)
+    x = model.firstmaxpool(x)
+    e1 = model.encoder1(x)
+    e2 = model.encoder2(e1)
+    e3 = model.encoder3(e2)
+    e4 = model.encoder4(e3)
+    return e1, e2, e3, e4
+
+def batched_encoder_forward(model, x, n):
+    """
+    Run the shared encoder once on inputs stacked along the batch,
+    then put the features of every input side by side along the channels
+    """
+    return [torch.cat(e.split(n, dim=0), dim=1) for e in encoder_forward(model, x)]
+
+def use_batched_encoder(model):
+    return model.batch_encoder == 'always' or (model.batch_encoder == 'eval' and not model.training)
+
 def dilated_resnet18(**kwargs):
     """Constructs a ResNet-18 model.
     Args:
@@ -167,10 +194,15 @@ class GapNet18(nn.Module):
     def __init__(self, 
                  num_classes,
                  num_channels=3,
-                 dilation=1):
+                 dilation=1,
+                 batch_encoder='eval'):
         
         super().__init__()
 
+        if batch_encoder not in batch_encoder_modes:
+            raise ValueError('Encoder batching not supported')
+        self.batch_encoder = batch_encoder
+
         filters = [64*2, 128*2, 256*2, 512*2]
         resnet = dilated_resnet18(dilation=dilation)
 
@@ -206,6 +238,30 @@ class GapNet18(nn.Module):
     # noinspection PyCallingNonCallable
     def forward(self, x1, x2):
         # Encoder
+        if use_batched_encoder(self):
+            x = self.firstconv(torch.cat((x1,x2), dim=0))
+            e1, e2, e3, e4 = batched_encoder_forward(self, x, x1.size(0))
+        else:
+            e1, e2, e3, e4 = self.sequential_encoder_forward(x1, x2)
+
+        # Decoder with Skip Connections
+        d4 = self.decoder4(e4) + e3
+        # d4 = e3
+        d3 = self.decoder3(d4) + e2
+        d2 = self.decoder2(d3) + e1
+        d1 = self.decoder1(d2)
+
+        # Final Classification
+        f1 = self.finaldeconv1(d1)
+        f2 = self.finalrelu1(f1)
+        f3 = self.finalconv2(f2)
+        f4 = self.finalrelu2(f3)
+        f5 = self.finalconv3(f4)
+
+        # return f5 
+        return F.sigmoid(f5)
+
+    def sequential_encoder_forward(self, x1, x2):
         x1 = self.firstconv(x1)
         x1 = self.firstbn(x1)
         x1 = self.firstrelu(x1)
@@ -228,32 +284,21 @@ class GapNet18(nn.Module):
         e2 = torch.cat((e2_1,e2_2), dim=1)
         e3 = torch.cat((e3_1,e3_2), dim=1)
         e4 = torch.cat((e4_1,e4_2), dim=1)
-
-        # Decoder with Skip Connections
-        d4 = self.decoder4(e4) + e3
-        # d4 = e3
-        d3 = self.decoder3(d4) + e2
-        d2 = self.decoder2(d3) + e1
-        d1 = self.decoder1(d2)
-
-        # Final Classification
-        f1 = self.finaldeconv1(d1)
-        f2 = self.finalrelu1(f1)
-        f3 = self.finalconv2(f2)
-        f4 = self.finalrelu2(f3)
-        f5 = self.finalconv3(f4)
-
-        # return f5 
-        return F.sigmoid(f5)  
+        return e1, e2, e3, e4
    
 class GapNetImg18(nn.Module):
     def __init__(self, 
                  num_classes,
                  num_channels=3,
-                 dilation=1):
+                 dilation=1,
+                 batch_encoder='eval'):
         
         super().__init__()
 
+        if batch_encoder not in batch_encoder_modes:
+            raise ValueError('Encoder batching not supported')
+        self.batch_encoder = batch_encoder
+
         filters = [64*3, 128*3, 256*3, 512*3]
         resnet = dilated_resnet18(dilation=dilation)
 
@@ -285,6 +330,31 @@ class GapNetImg18(nn.Module):
     # noinspection PyCallingNonCallable
     def forward(self, x, x1, x2):
         # Encoder
+        if use_batched_encoder(self):
+            # the image branch has its own first conv, the rest of the encoder is shared
+            x = torch.cat((self.firstconv_img(x), self.firstconv(torch.cat((x1,x2), dim=0))), dim=0)
+            e1, e2, e3, e4 = batched_encoder_forward(self, x, x1.size(0))
+        else:
+            e1, e2, e3, e4 = self.sequential_encoder_forward(x, x1, x2)
+
+        # Decoder with Skip Connections
+        d4 = self.decoder4(e4) + e3
+        # d4 = e3
+        d3 = self.decoder3(d4) + e2
+        d2 = self.decoder2(d3) + e1
+        d1 = self.decoder1(d2)
+
+        # Final Classification
+        f1 = self.finaldeconv1(d1)
+        f2 = self.finalrelu1(f1)
+        f3 = self.finalconv2(f2)
+        f4 = self.finalrelu2(f3)
+        f5 = self.finalconv3(f4)
+
+        # return f5 
+        return F.sigmoid(f5)
+
+    def sequential_encoder_forward(self, x, x1, x2):
         x = self.firstconv_img(x)
         x = self.firstbn(x)
         x = self.firstrelu(x)
@@ -316,20 +386,4 @@ class GapNetImg18(nn.Module):
         e2 = torch.cat((e2_0,e2_1,e2_2), dim=1)
         e3 = torch.cat((e3_0,e3_1,e3_2), dim=1)
         e4 = torch.cat((e4_0,e4_1,e4_2), dim=1)
-
-        # Decoder with Skip Connections
-        d4 = self.decoder4(e4) + e3
-        # d4 = e3
-        d3 = self.decoder3(d4) + e2
-        d2 = self.decoder2(d3) + e1
-        d1 = self.decoder1(d2)
-
-        # Final Classification
-        f1 = self.finaldeconv1(d1)
-        f2 = self.finalrelu1(f1)
-        f3 = self.finalconv2(f2)
-        f4 = self.finalrelu2(f3)
-        f5 = self.finalconv3(f4)
-
-        # return f5 
-        return F.sigmoid(f5)  
\ No newline at end of file
+        return e1, e2, e3, e4  
\ No newline at end of file
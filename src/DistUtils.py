@@ -0,0 +1,131 @@
+import builtins
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+def get_rank():
+    """Rank of the process, also valid before the process group is initialized under torchrun"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return int(os.environ.get('RANK', 0))
+
+def get_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+def is_main_process():
+    return get_rank() == 0
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def silence_non_main(rank):
+    """Only rank 0 prints, unless print is called with force=True"""
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if rank == 0 or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+def init_distributed(device_type, backend=''):
+    """
+    Join the process group set up by torchrun (RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR and MASTER_PORT env variables), works across nodes
+    nccl is used on cuda and gloo on cpu unless the backend is given
+    Return the device of this process
+    """
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise ValueError('Distributed mode needs torchrun or the RANK / WORLD_SIZE env variables')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if not backend:
+        backend = 'nccl' if device_type == 'cuda' else 'gloo'
+    if device_type == 'cuda':
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend=backend)
+    silence_non_main(dist.get_rank())
+    print('Distributed {} training: {} processes'.format(backend, dist.get_world_size()))
+    return device
+
+def wrap_ddp(model, device):
+    """Move the model to the device of the process and wrap it into DDP"""
+    model = model.to(device)
+    if device.type == 'cuda':
+        return DistributedDataParallel(model, device_ids=[device.index], output_device=device.index)
+    return DistributedDataParallel(model)
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Every world_size-th sample starting at the rank, in order and without the
+    padding of DistributedSampler, the shards may differ by one sample
+    Sums reduced over all the processes count every sample exactly once
+    """
+    def __init__(self, dataset):
+        self.indices = list(range(get_rank(), len(dataset), get_world_size()))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+def distributed_loader(dataset, batch_size, shuffle, num_workers, pin_memory, seed=0, pad=True):
+    """
+    DataLoader over the shard of the dataset of this process
+    The batch size is the global one, as with DataParallel, and is split between processes
+    pad=False gives unpadded, uneven shards for validation, run the model
+    returned by eval_model on them, DDP forwards are collectives
+    """
+    if pad:
+        sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+    elif shuffle:
+        raise ValueError('Shuffling unpadded shards is not supported')
+    else:
+        sampler = ShardSampler(dataset)
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_size=max(batch_size // get_world_size(), 1),
+                                       sampler=sampler,
+                                       num_workers=num_workers,
+                                       pin_memory=pin_memory)
+
+def eval_model(model):
+    """
+    The model to validate on uneven shards with
+    A DDP forward broadcasts the buffers of rank 0, a collective the processes
+    with fewer batches would never join. The buffers are broadcast once here
+    and the wrapped module is returned, so the outputs are the same
+    """
+    if not isinstance(model, DistributedDataParallel):
+        return model
+    for buf in model.module.buffers():
+        dist.broadcast(buf, 0)
+    return model.module
+
+def set_loader_epoch(loader, epoch):
+    """Reshuffle the distributed shards every epoch"""
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+def reduce_average(total, count, device):
+    """Average of a per process sum over count items across all the processes"""
+    if not is_distributed():
+        return total / max(count, 1)
+    buf = torch.tensor([total, count], dtype=torch.float64, device=device)
+    dist.all_reduce(buf)
+    return (buf[0] / buf[1].clamp(min=1)).item()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,502 @@
+import math
+import struct
+import threading
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy.spatial import cKDTree
+from skimage.morphology import skeletonize
+import sknw
+from SkeletonUtils import skeleton_buffer
+
+# functions shared by the linestring generation scripts
+
+def max_pool(binary, factor):
+    """Any of every factor x factor block, the pooling of the fast kernel"""
+    height = -(-binary.shape[0] // factor) * factor
+    width = -(-binary.shape[1] // factor) * factor
+    padded = np.zeros((height, width), dtype=binary.dtype)
+    padded[:binary.shape[0], :binary.shape[1]] = binary
+    return padded.reshape(height // factor, factor, width // factor, factor).any(axis=(1, 3))
+
+def mask_to_graph(msk, thresh=30, crop=None, fast=False, factor=1):
+    """
+    Threshold a predicted mask, skeletonize it and build a road graph
+    :param msk: 2d mask, uint8 probabilities (as saved by predict)
+    :param thresh: binarization threshold
+    :param crop: optional (row, col, height, width) of the skeleton to keep,
+                 the rest of the mask only gives context to the skeletonization
+    :param fast: use the fused numba threshold + thinning kernel instead of skimage
+    :param factor: downsample factor, the thresholded mask is max pooled before
+                   thinning and graph coordinates are scaled back to the mask resolution
+    :return: sknw MultiGraph, coordinates are (row, col) in mask (or crop) pixels
+    """
+    if factor > 1 and crop is not None:
+        raise ValueError('Crop is not supported for downsampled skeletons')
+    if fast:
+        buf = skeleton_buffer(msk, thresh=thresh, factor=factor)
+        if crop is not None:
+            row, col, height, width = crop
+            cropped = np.zeros((height + 2, width + 2), dtype=np.uint16)
+            cropped[1:-1, 1:-1] = buf[1 + row:1 + row + height, 1 + col:1 + col + width]
+            buf = cropped
+        graph = sknw.build_sknw_buffer(buf, multi=True)
+        if factor > 1:
+            graph = scale_graph(graph, factor)
+        return graph
+
+    binary = (msk > thresh)*1
+    if factor > 1:
+        binary = max_pool(binary, factor)
+
+    ske = skeletonize(binary).astype(np.uint16)
+    if crop is not None:
+        row, col, height, width = crop
+        ske = ske[row:row + height, col:col + width]
+
+    # build graph from skeleton
+    graph = sknw.build_sknw(ske, multi=True)
+    if factor > 1:
+        graph = scale_graph(graph, factor)
+    return graph
+
+def simplify_edge(ps: np.ndarray, max_distance=3):
+    """
+    Combine multiple points of graph edges to line segments
+    so distance from points to segments <= max_distance
+    :param ps: array of points in the edge, including node coordinates
+    :param max_distance: maximum distance, if exceeded new segment started
+    :return: ndarray of new nodes coordinates
+    """
+    res_points = []
+    cur_idx = 0
+    # combine points to the single line while distance from the line to any point < max_distance
+    for i in range(1, len(ps) - 1):
+        segment = ps[cur_idx:i + 1, :] - ps[cur_idx, :]
+        angle = -math.atan2(segment[-1, 1], segment[-1, 0])
+        ca = math.cos(angle)
+        sa = math.sin(angle)
+        # rotate all the points so line is alongside first column coordinate
+        # and the second col coordinate means the distance to the line
+        segment_rotated = np.array([[ca, -sa], [sa, ca]]).dot(segment.T)
+        distance = np.max(np.abs(segment_rotated[1, :]))
+        if distance > max_distance:
+            res_points.append(ps[cur_idx, :])
+            cur_idx = i
+    if len(res_points) == 0:
+        res_points.append(ps[0, :])
+    res_points.append(ps[-1, :])
+
+    return np.array(res_points)
+
+def simplify_graph(graph, max_distance=2):
+    """
+    :type graph: MultiGraph
+    """
+    all_segments = []
+    for (s, e) in graph.edges():
+        for _, val in graph[s][e].items():
+            ps = val['pts']
+            full_segments = np.row_stack([
+                graph.node[s]['o'],
+                ps,
+                graph.node[e]['o']
+            ])
+
+            segments = simplify_edge(full_segments, max_distance=max_distance)
+            all_segments.append(segments)
+
+    return all_segments
+
+def stacked_segment_coords(segments):
+    """
+    Vertices of all the segments as written to the linestrings, (x, y) = (col, row)
+    A vertex equal to one of the two previous ones of its segment is dropped,
+    segments of less than 2 vertices and 2 vertex segments of one point are skipped
+    :return: stacked coordinates and the vertex count of every written segment
+    """
+    segments = [np.asarray(segment) for segment in segments]
+    segments = [segment for segment in segments if len(segment) >= 2]
+    if len(segments) == 0:
+        return np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+
+    lengths = np.array([len(segment) for segment in segments])
+    starts = np.cumsum(lengths) - lengths
+    points = np.concatenate(segments)
+    # position of every vertex inside its segment, comparisons never cross segments
+    position = np.arange(len(points)) - np.repeat(starts, lengths)
+
+    same = np.zeros(len(points), dtype=bool)
+    same[1:] = (points[1:] == points[:-1]).all(axis=1)
+    same[2:] |= (points[2:] == points[:-2]).all(axis=1) & (position[2:] >= 2)
+    same &= position >= 1
+    same |= np.repeat((lengths == 2) & same[starts + 1], lengths)
+
+    counts = np.add.reduceat((~same).astype(np.int64), starts)
+    return points[~same][:, ::-1], counts[counts > 0]
+
+def segmets_to_linestrings(segments, wkb=False):
+    coords, counts = stacked_segment_coords(segments)
+    if len(counts) == 0:
+        if wkb:
+            return [struct.pack('<BII', 1, 2, 0)]
+        return ['LINESTRING EMPTY']
+    ends = np.cumsum(counts).tolist()
+    starts = [0] + ends[:-1]
+
+    if wkb:
+        # little endian linestring header followed by the raw doubles
+        data = coords.astype('<f8').tobytes()
+        return [struct.pack('<BII', 1, 2, end - start) + data[16 * start:16 * end]
+                for start, end in zip(starts, ends)]
+
+    # all the vertices are formatted in one pass, same output as '{:.1f} {:.1f}' per vertex
+    vertices = ('%.1f %.1f\n' * len(coords) % tuple(coords.ravel().tolist())).split('\n')
+    return ['LINESTRING ({})'.format(', '.join(vertices[start:end])) for start, end in zip(starts, ends)]
+
+def segment_to_linestring(segment):
+    linestring = segmets_to_linestrings([segment])[0]
+    return [] if linestring == 'LINESTRING EMPTY' else linestring
+
+def scale_graph(graph, factor):
+    """
+    Move graph coordinates from a downsampled skeleton to the full resolution,
+    points land in the middle of their pooling blocks
+    """
+    shift = (factor - 1) / 2
+    for n in graph.nodes():
+        graph.node[n]['pts'] = (graph.node[n]['pts'].astype(np.int32) * factor
+                                + (factor - 1) // 2)
+        graph.node[n]['o'] = graph.node[n]['o'] * factor + shift
+    for (s, e) in graph.edges():
+        for _, val in graph[s][e].items():
+            val['pts'] = val['pts'].astype(np.int32) * factor + (factor - 1) // 2
+            val['weight'] = val['weight'] * factor
+    return graph
+
+def offset_graph(graph, row_off, col_off):
+    """
+    Move graph coordinates from tile to mosaic pixel space
+    pts are widened to int32, mosaics easily exceed the int16 sknw range
+    """
+    offset = np.array([row_off, col_off])
+    for n in graph.nodes():
+        graph.node[n]['pts'] = graph.node[n]['pts'].astype(np.int32) + offset
+        graph.node[n]['o'] = graph.node[n]['o'] + offset
+    for (s, e) in graph.edges():
+        for _, val in graph[s][e].items():
+            val['pts'] = val['pts'].astype(np.int32) + offset
+    return graph
+
+def seam_nodes(graph, core, shape):
+    """
+    Find the dangling nodes touching an inner border of a tile
+    :param core: (row_off, col_off, height, width) of the tile in the mosaic
+    :param shape: (height, width) of the mosaic, outer borders are not seams
+    :return: list of node ids
+    """
+    row_off, col_off, height, width = core
+    borders = []
+    if row_off > 0:
+        borders.append((0, row_off))
+    if row_off + height < shape[0]:
+        borders.append((0, row_off + height - 1))
+    if col_off > 0:
+        borders.append((1, col_off))
+    if col_off + width < shape[1]:
+        borders.append((1, col_off + width - 1))
+
+    nodes = []
+    for n in graph.nodes():
+        if graph.degree(n) != 1:
+            continue
+        pts = graph.node[n]['pts']
+        if any((pts[:, axis] == line).any() for axis, line in borders):
+            nodes.append(n)
+    return nodes
+
+def _orient(pts, o):
+    # make the edge points start next to the node o
+    if np.linalg.norm(pts[-1] - o) < np.linalg.norm(pts[0] - o):
+        return pts[::-1]
+    return pts
+
+def merge_tile_graphs(tile_graphs, tolerance=2):
+    """
+    Join per-tile graphs into one graph, stitching roads across tile seams
+    :param tile_graphs: iterable of (graph, seam node ids) in mosaic coordinates
+    :param tolerance: max distance in pixels between the two ends of a cut road
+    :return: MultiGraph
+    """
+    graph = nx.MultiGraph()
+    seams = []
+    seam_tiles = []
+    next_id = 0
+    for tile_no, (tile_graph, tile_seams) in enumerate(tile_graphs):
+        mapping = {}
+        for n in tile_graph.nodes():
+            mapping[n] = next_id
+            graph.add_node(next_id, **tile_graph.node[n])
+            next_id += 1
+        for s, e, val in tile_graph.edges(data=True):
+            graph.add_edge(mapping[s], mapping[e], **val)
+        seams.extend([mapping[n] for n in tile_seams])
+        seam_tiles.extend([tile_no] * len(tile_seams))
+
+    if len(seams) < 2:
+        return graph
+
+    # pair up the ends of the cut roads from different tiles
+    tree = cKDTree(np.array([graph.node[n]['o'] for n in seams]))
+    parent = list(range(len(seams)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in tree.query_pairs(tolerance):
+        if seam_tiles[i] != seam_tiles[j]:
+            parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(seams)):
+        groups.setdefault(find(i), []).append(seams[i])
+
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        keep = group[0]
+        graph.node[keep]['pts'] = np.vstack([graph.node[n]['pts'] for n in group])
+        graph.node[keep]['o'] = np.mean([graph.node[n]['o'] for n in group], axis=0)
+        for n in group[1:]:
+            for _, other, val in list(graph.edges(n, data=True)):
+                graph.add_edge(keep, other if other != n else keep, **val)
+            graph.remove_node(n)
+
+        # a road simply crossing the seam becomes one edge
+        if graph.degree(keep) != 2:
+            continue
+        (_, a, val_a), (_, b, val_b) = list(graph.edges(keep, data=True))
+        if keep in (a, b):
+            continue
+        o = graph.node[keep]['o']
+        pts = np.vstack([_orient(val_a['pts'], graph.node[a]['o']),
+                         np.round(o).astype(np.int32)[None],
+                         _orient(val_b['pts'], o)])
+        graph.remove_node(keep)
+        graph.add_edge(a, b, pts=pts, weight=val_a['weight'] + val_b['weight'])
+
+    return graph
+
+def ordered_subgraph(graph, nodes):
+    """
+    Copy of the subgraph with the nodes in the given order
+    Edges are oriented by node order and simplify_edge is not symmetric, so
+    keeping the tile order keeps the linestrings of a whole mosaic merge
+    """
+    node_set = set(nodes)
+    sub = nx.MultiGraph()
+    sub.add_nodes_from((n, graph.node[n]) for n in nodes)
+    sub.add_edges_from((s, e, val) for s, e, val in graph.edges(nodes, data=True)
+                       if s in node_set and e in node_set)
+    return sub
+
+def split_seam_edges(graph, seams):
+    """
+    Split a tile graph into the edges final as they are and the edges of the
+    seam nodes, the only ones merge_tile_graphs changes
+    :return: (interior graph, seam graph), the seam graph keeps both ends of its edges
+    """
+    seams = set(seams)
+    ends = set(seams)
+    for n in seams:
+        ends.update(graph.neighbors(n))
+    nodes = [n for n in graph.nodes() if n in ends]
+    seam = nx.MultiGraph()
+    seam.add_nodes_from((n, graph.node[n]) for n in nodes)
+    seam.add_edges_from((s, e, val) for s, e, val in graph.edges(nodes, data=True)
+                        if s in seams or e in seams)
+    return ordered_subgraph(graph, [n for n in graph.nodes() if n not in seams]), seam
+
+class TileGraphMerger(object):
+    """
+    merge_tile_graphs for tiles arriving one at a time, in any order
+    Components joined across seams form clusters in a union-find, a cluster is
+    merged and handed back once the tiles around all its seam nodes are in.
+    Fed with the seam graphs of split_seam_edges, only the cut road ends along
+    the processed front stay in memory
+    """
+    def __init__(self, cores, tile_size, tolerance=2):
+        self.tile_size = tile_size
+        self.tolerance = tolerance
+        self.tiles = set(self._key(core) for core in cores)
+        self.done = set()
+        self.closed = set()
+        # component id -> (tile, graph, seam node ids, node ranks in the tile graph)
+        self.components = {}
+        # tile -> (seam coordinates, component ids) to pair with the tiles arriving next
+        self.open_seams = {}
+        # union-find over component ids, with per cluster seam nodes of tiles not closed yet
+        self.parent = {}
+        self.unresolved = {}
+        self.members = {}
+        self.next_id = 0
+
+    def _key(self, core):
+        return core[0] // self.tile_size, core[1] // self.tile_size
+
+    def _neighbours(self, tile):
+        row, col = tile
+        return [(row + dr, col + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                if (dr or dc) and (row + dr, col + dc) in self.tiles]
+
+    def _find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def _union(self, i, j):
+        i, j = self._find(i), self._find(j)
+        if i == j:
+            return
+        self.parent[i] = j
+        self.unresolved[j] += self.unresolved.pop(i)
+        self.members[j].extend(self.members.pop(i))
+
+    def _merge_cluster(self, root):
+        del self.unresolved[root]
+        tiles = {}
+        for cid in self.members.pop(root):
+            del self.parent[cid]
+            tile, component, component_seams, ranks = self.components.pop(cid)
+            tiles.setdefault(tile, []).append((component, component_seams, ranks))
+
+        # the parts of each tile back in tile order, the tiles in mosaic order
+        tile_graphs = []
+        for tile in sorted(tiles):
+            parts = tiles[tile]
+            ranks = {}
+            for _, _, part_ranks in parts:
+                ranks.update(part_ranks)
+            graph = nx.compose_all([component for component, _, _ in parts])
+            seams = [n for _, component_seams, _ in parts for n in component_seams]
+            tile_graphs.append((ordered_subgraph(graph, sorted(graph.nodes(), key=ranks.get)),
+                                sorted(seams, key=ranks.get)))
+        return merge_tile_graphs(tile_graphs, tolerance=self.tolerance)
+
+    def add(self, core, graph, seams):
+        """
+        Add the graph of a tile in mosaic coordinates with its seam node ids
+        :return: list of the graphs completed by this tile, components without
+        seam nodes come back as they are
+        """
+        tile = self._key(core)
+        self.done.add(tile)
+        finished = []
+        seams = set(seams)
+        order = dict((n, i) for i, n in enumerate(graph.nodes()))
+        points = []
+        ids = []
+        for nodes in nx.connected_components(graph):
+            nodes = sorted(nodes, key=order.get)
+            component = ordered_subgraph(graph, nodes)
+            component_seams = [n for n in nodes if n in seams]
+            if not component_seams:
+                finished.append(component)
+                continue
+            cid = self.next_id
+            self.next_id += 1
+            self.components[cid] = (tile, component, component_seams,
+                                    dict((n, order[n]) for n in nodes))
+            self.parent[cid] = cid
+            self.unresolved[cid] = len(component_seams)
+            self.members[cid] = [cid]
+            for n in component_seams:
+                points.append(graph.node[n]['o'])
+                ids.append(cid)
+
+        # pair up the new road ends with the open ones of the tiles around
+        if points:
+            points = np.array(points)
+            tree = cKDTree(points)
+            for other in self._neighbours(tile):
+                if other not in self.open_seams:
+                    continue
+                other_points, other_ids = self.open_seams[other]
+                for i, matches in enumerate(tree.query_ball_point(other_points, self.tolerance)):
+                    for j in matches:
+                        self._union(other_ids[i], ids[j])
+            self.open_seams[tile] = (points, ids)
+
+        # once a tile and all the tiles around it are in, its seam nodes can not pair any more
+        for candidate in [tile] + self._neighbours(tile):
+            if candidate in self.closed or candidate not in self.done:
+                continue
+            if not all(other in self.done for other in self._neighbours(candidate)):
+                continue
+            self.closed.add(candidate)
+            _, candidate_ids = self.open_seams.pop(candidate, (None, []))
+            for cid in candidate_ids:
+                root = self._find(cid)
+                self.unresolved[root] -= 1
+                if self.unresolved[root] == 0:
+                    finished.append(self._merge_cluster(root))
+        return finished
+
+    def close(self):
+        """Merge whatever is left, only needed when some tiles never arrived"""
+        roots = [root for root in self.members]
+        self.open_seams = {}
+        return [self._merge_cluster(root) for root in roots]
+
+def prob_to_linestrings(prob, img_id, thresh=30, fast=False, factor=1):
+    """
+    Turn a predicted probability map into linestrings
+    :param prob: 2d float probabilities in [0, 1], padding already cropped
+    :param thresh: threshold on the 0-255 scale, same as for the saved jpg masks
+    :return: (img_id, list of linestrings)
+    """
+    msk = np.round(prob * 255).astype(np.uint8)
+    graph = mask_to_graph(msk, thresh=thresh, fast=fast, factor=factor)
+    return img_id, segmets_to_linestrings(simplify_graph(graph))
+
+def _init_graph_worker():
+    sknw.warmup()
+
+class GraphExtractionPool(object):
+    """
+    Process pool fed with probability maps straight from the predict loop
+    At most max_pending maps are queued, submit blocks when the queue is full
+    """
+    def __init__(self, workers=4, max_pending=16, **kwargs):
+        self.kwargs = kwargs
+        self.pool = Pool(workers, initializer=_init_graph_worker)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.results = []
+
+    def _release(self, _):
+        self.slots.release()
+
+    def submit(self, prob, img_id):
+        self.slots.acquire()
+        self.results.append(self.pool.apply_async(prob_to_linestrings,
+                                                  (prob, img_id),
+                                                  self.kwargs,
+                                                  callback=self._release,
+                                                  error_callback=self._release))
+
+    def close(self):
+        """Wait for all the maps and return the ImageId / WKT_Pix dataframe"""
+        self.pool.close()
+        self.pool.join()
+        img_ids = []
+        linestrings = []
+        for result in self.results:
+            img_id, img_linestrings = result.get()
+            img_ids.extend([img_id] * len(img_linestrings))
+            linestrings.extend(img_linestrings)
+        return pd.DataFrame({'ImageId': img_ids, 'WKT_Pix': linestrings})
@@ -1,7 +1,7 @@
 
 import torch
 import torch.nn as nn
-import torch.utils.model_zoo as model_zoo
+from PretrainedWeights import load_pretrained_state_dict
 import os
 import sys
 
@@ -341,7 +341,7 @@ def inceptionresnetv2(num_classes=1001, pretrained='imagenet'):
 
         # both 'imagenet'&'imagenet+background' are loaded from same parameters
         model = InceptionResNetV2(num_classes=1001)
-        model.load_state_dict(model_zoo.load_url(settings['url']))
+        model.load_state_dict(load_pretrained_state_dict(settings['url']))
         
         if pretrained == 'imagenet':
             new_last_linear = nn.Linear(1536, 1000)
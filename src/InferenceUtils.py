@@ -0,0 +1,285 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+import torch.fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.parallel import DistributedDataParallel
+
+from UNet import UNet11
+from LinkNet import LinkNet34,LinkNet50,LinkNet50_full,LinkNeXt
+
+# wrappers that prefix the state dict keys with 'module.'
+parallel_wrappers = (torch.nn.DataParallel, DistributedDataParallel)
+
+# presets with all the 8 multispectral channels as input
+eight_channel_presets = ['mul_ps_8channel','mul_8channel']
+
+def get_model(arch, preset, pretrained=True):
+    """
+    Build one of the segmentation models by its --arch name
+    pretrained=False skips the ImageNet encoder weights, for models a checkpoint is loaded into
+    """
+    num_channels = 8 if preset in eight_channel_presets else 3
+
+    if arch.startswith('linknet34'):
+        print('Full linknet34 activated')
+        model = LinkNet34(num_channels=num_channels,
+                          num_classes=1,
+                          pretrained=pretrained)
+    elif arch.startswith('linknext'):
+        print('LinkNeXt101-32 activated')
+        model = LinkNeXt(num_channels=3,
+                         num_classes=1,
+                         pretrained=pretrained)
+    elif arch.startswith('linknet50_full'):
+        print('Full linknet50 activated')
+        model = LinkNet50_full(num_channels=num_channels,
+                               num_classes=1,
+                               pretrained=pretrained)
+    elif arch.startswith('linknet50'):
+        print('Truncated linknet50 activated')
+        model = LinkNet50(num_channels=num_channels,
+                          num_classes=1,
+                          pretrained=pretrained)
+    elif arch.startswith('unet11'):
+        if num_channels == 8:
+            model = UNet11(num_classes=1,
+                           num_channels=8,
+                           pretrained=pretrained)
+        else:
+            model = UNet11(num_classes=1,
+                           num_channels=3,
+                           num_filters=32,
+                           pretrained=pretrained)
+    else:
+        raise ValueError('Model not supported')
+    return model
+
+def place_model(model, device, channels_last=False):
+    """
+    Move the model to the inference / training device
+    Several GPUs are used through DataParallel as before, CPU models stay plain
+    """
+    if device.type == 'cuda':
+        model = torch.nn.DataParallel(model).cuda()
+    else:
+        model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+def convert_state_dict(state_dict, model):
+    """Add or strip the DataParallel / DDP 'module.' prefix to fit the model"""
+    data_parallel = isinstance(model, parallel_wrappers)
+    converted = {}
+    for key, value in state_dict.items():
+        if key.startswith('module.') and not data_parallel:
+            key = key[len('module.'):]
+        elif not key.startswith('module.') and data_parallel:
+            key = 'module.' + key
+        converted[key] = value
+    return converted
+
+def load_checkpoint(model, path):
+    """Load a checkpoint saved from any device into the model, return the checkpoint"""
+    checkpoint = torch.load(path, map_location='cpu')
+    model.load_state_dict(convert_state_dict(checkpoint['state_dict'], model))
+    return checkpoint
+
+class EnsembleModel(object):
+    """
+    Several models behind one model call, every batch goes through all of them
+    and the outputs are averaged in memory
+    With parallel=True the models run in threads, torch releases the GIL in its kernels
+    """
+    def __init__(self, models, parallel=False):
+        self.models = models
+        self.pool = ThreadPoolExecutor(len(models)) if parallel else None
+
+    def eval(self):
+        for model in self.models:
+            model.eval()
+        return self
+
+    def __call__(self, input):
+        if self.pool is not None:
+            # grad mode is thread local, keep the one of the caller
+            grad_enabled = torch.is_grad_enabled()
+
+            def run(model):
+                with torch.set_grad_enabled(grad_enabled):
+                    return model(input)
+
+            outputs = list(self.pool.map(run, self.models))
+        else:
+            outputs = [model(input) for model in self.models]
+        output = outputs[0].clone()
+        for model_output in outputs[1:]:
+            output += model_output
+        return output / len(outputs)
+
+def load_ensemble(arch, preset, paths, device, channels_last=False, parallel=False):
+    """Load every checkpoint once into its own model and wrap them into an EnsembleModel"""
+    models = []
+    for path in paths:
+        model = place_model(get_model(arch, preset, pretrained=False), device, channels_last=channels_last)
+        checkpoint = load_checkpoint(model, path)
+        print("=> loaded checkpoint '{}' (epoch {})".format(path, checkpoint['epoch']))
+        models.append(model.eval())
+    return EnsembleModel(models, parallel=parallel)
+
+class ThroughputMeter(object):
+    """Counts predicted images and reports images per second (per core on CPU)"""
+    def __init__(self, device):
+        self.device = device
+        self.count = 0
+        self.start = time.time()
+
+    def update(self, n):
+        self.count += n
+
+    def report(self):
+        elapsed = time.time() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0
+        if self.device.type == 'cuda':
+            cores = max(torch.cuda.device_count(), 1)
+            unit = 'GPU'
+        else:
+            cores = torch.get_num_threads()
+            unit = 'core'
+        print(' * Predicted {} images in {:.1f}s: {:.3f} images/s, {:.3f} images/s per {} ({} {}s)'
+              .format(self.count, elapsed, rate, rate / cores, unit, cores, unit))
+        return rate
+
+# test time augmentations in tensor space, (forward, inverse) on NCHW batches
+# rotations and transpositions need square inputs, flips do not
+tta_transforms = [
+    ('identity', lambda x: x, lambda x: x),
+    ('hflip', lambda x: x.flip(3), lambda x: x.flip(3)),
+    ('vflip', lambda x: x.flip(2), lambda x: x.flip(2)),
+    ('hvflip', lambda x: x.flip(2).flip(3), lambda x: x.flip(2).flip(3)),
+    ('rot90', lambda x: x.rot90(1, (2, 3)), lambda x: x.rot90(-1, (2, 3))),
+    ('rot270', lambda x: x.rot90(-1, (2, 3)), lambda x: x.rot90(1, (2, 3))),
+    ('transpose', lambda x: x.transpose(2, 3), lambda x: x.transpose(2, 3)),
+    ('antitranspose', lambda x: x.rot90(1, (2, 3)).flip(2), lambda x: x.flip(2).rot90(-1, (2, 3))),
+]
+
+def tta_forward(model, input, variants=1):
+    """
+    Run the first `variants` TTA transforms of the batch as one forward pass
+    and average the un-transformed outputs
+    """
+    if variants <= 1:
+        return model(input)
+    if variants > len(tta_transforms):
+        raise ValueError('At most {} TTA variants are supported'.format(len(tta_transforms)))
+    if variants > 4 and input.size(2) != input.size(3):
+        raise ValueError('Rotation TTA variants need square inputs')
+
+    transforms = tta_transforms[:variants]
+    batch = torch.cat([forward(input) for _, forward, _ in transforms], 0)
+    if input.is_contiguous(memory_format=torch.channels_last):
+        batch = batch.contiguous(memory_format=torch.channels_last)
+    outputs = model(batch).chunk(variants, 0)
+
+    output = transforms[0][2](outputs[0]).clone()
+    for (_, _, inverse), variant_output in zip(transforms[1:], outputs[1:]):
+        output += inverse(variant_output)
+    return output / variants
+
+def benchmark_tta(model, input, max_variants, repeats=3):
+    """Print the forward time of a batch with 1..max_variants TTA variants"""
+    print('TTA benchmark on a batch of {}'.format(tuple(input.shape)))
+    base = None
+    with torch.no_grad():
+        for variants in range(1, max_variants + 1):
+            tta_forward(model, input, variants)
+            if input.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(repeats):
+                tta_forward(model, input, variants)
+            if input.is_cuda:
+                torch.cuda.synchronize()
+            elapsed = (time.time() - start) / repeats
+            base = base or elapsed
+            print('  {} variant(s), last {:<13}: {:.3f}s per batch, {:.3f}s per variant, x{:.2f} of no TTA'
+                  .format(variants, tta_transforms[variants - 1][0], elapsed,
+                          elapsed / variants, elapsed / base))
+
+def fold_conv_bn(model):
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d or ConvTranspose2d
+    into the conv weights, the model is traced with torch.fx and copied
+    Torchscript freezing alone folds Conv2d only, not the decoder deconvs
+    """
+    model = copy.deepcopy(model).eval()
+    traced = torch.fx.symbolic_trace(model)
+    modules = dict(traced.named_modules())
+    # modules called more than once (shared encoders in GapNet) are left as is
+    calls = {}
+    for node in traced.graph.nodes:
+        if node.op == 'call_module':
+            calls[node.target] = calls.get(node.target, 0) + 1
+    folded = 0
+    for node in traced.graph.nodes:
+        if node.op != 'call_module' or not isinstance(modules[node.target], nn.BatchNorm2d):
+            continue
+        conv_node = node.args[0]
+        if not isinstance(conv_node, torch.fx.Node) or conv_node.op != 'call_module':
+            continue
+        conv = modules[conv_node.target]
+        if not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) or len(conv_node.users) > 1:
+            continue
+        if calls[conv_node.target] > 1 or calls[node.target] > 1:
+            continue
+        fused = fuse_conv_bn_eval(conv, modules[node.target],
+                                  transpose=isinstance(conv, nn.ConvTranspose2d))
+        parent_name, _, name = conv_node.target.rpartition('.')
+        setattr(traced.get_submodule(parent_name) if parent_name else traced, name, fused)
+        node.replace_all_uses_with(conv_node)
+        traced.graph.erase_node(node)
+        folded += 1
+    traced.graph.lint()
+    traced.delete_all_unused_submodules()
+    traced.recompile()
+    print(' * Folded {} BatchNorm layers'.format(folded))
+    return traced
+
+def optimize_for_inference(model, example_inputs, atol=1e-4, repeats=3):
+    """
+    Fold conv + bn, trace to TorchScript and freeze the graph, which lets the
+    jit fuse conv + relu / add and pre-pack the weights
+    The frozen model is checked against the eager one and both are timed
+    on the example inputs, a mismatch above atol raises an error
+    """
+    if isinstance(model, parallel_wrappers):
+        model = model.module
+    if not isinstance(example_inputs, tuple):
+        example_inputs = (example_inputs,)
+    model = model.eval()
+
+    with torch.no_grad():
+        folded = fold_conv_bn(model)
+        scripted = torch.jit.trace(folded, example_inputs)
+        optimized = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+
+        expected = model(*example_inputs)
+        actual = optimized(*example_inputs)
+        diff = (expected - actual).abs().max().item()
+        print(' * Optimized model max abs diff {:.2e} (tolerance {:.0e})'.format(diff, atol))
+        if diff > atol:
+            raise ValueError('Optimized model differs from the eager one by {}'.format(diff))
+
+        times = []
+        for runner in [model, optimized]:
+            runner(*example_inputs)
+            start = time.time()
+            for _ in range(repeats):
+                runner(*example_inputs)
+            times.append((time.time() - start) / repeats)
+    print(' * Eager {:.3f}s, optimized {:.3f}s per batch of {}: x{:.2f}'
+          .format(times[0], times[1], tuple(example_inputs[0].shape), times[0] / times[1]))
+    return optimized
@@ -7,6 +7,7 @@ from torch.autograd import Variable
 from torchvision import models
 import torch.nn.functional as F
 from ResNeXt import resnext101_32x4d
+from PretrainedWeights import load_pretrained
 
 nonlinearity = nn.ReLU
 
@@ -43,11 +44,14 @@ class DecoderBlock(nn.Module):
         return x
 
 class LinkNet34(nn.Module):
-    def __init__(self, num_classes, num_channels=3):
+    def __init__(self, num_classes, num_channels=3, pretrained=True):
         super().__init__()
 
         filters = [64, 128, 256, 512]
-        resnet = models.resnet34(pretrained=True)
+        # without pretrained the encoder is initialized randomly, e.g. when a checkpoint is restored
+        resnet = models.resnet34()
+        if pretrained:
+            load_pretrained(resnet, 'resnet34')
 
         # self.firstconv = resnet.conv1
         # assert num_channels == 3, "num channels not used now. to use changle first conv layer to support num channels other then 3"
@@ -108,11 +112,13 @@ class LinkNet34(nn.Module):
         return F.sigmoid(f5)
 
 class LinkNet50(nn.Module):
-    def __init__(self, num_classes, num_channels=3):
+    def __init__(self, num_classes, num_channels=3, pretrained=True):
         super().__init__()
 
         filters = [256, 512, 1024]
-        resnet = models.resnet50(pretrained=True)
+        resnet = models.resnet50()
+        if pretrained:
+            load_pretrained(resnet, 'resnet50')
 
         # self.firstconv = resnet.conv1
         # assert num_channels == 3, "num channels not used now. to use changle first conv layer to support num channels other then 3"
@@ -167,11 +173,13 @@ class LinkNet50(nn.Module):
         return F.sigmoid(f5)
 
 class LinkNet50_full(nn.Module):
-    def __init__(self, num_classes, num_channels=3):
+    def __init__(self, num_classes, num_channels=3, pretrained=True):
         super().__init__()
 
         filters = [256, 512, 1024, 2048]
-        resnet = models.resnet50(pretrained=True)
+        resnet = models.resnet50()
+        if pretrained:
+            load_pretrained(resnet, 'resnet50')
 
         # self.firstconv = resnet.conv1
         # assert num_channels == 3, "num channels not used now. to use changle first conv layer to support num channels other then 3"
@@ -230,11 +238,11 @@ class LinkNet50_full(nn.Module):
         return F.sigmoid(f5)        
 
 class LinkNeXt(nn.Module):
-    def __init__(self, num_classes, num_channels=3):
+    def __init__(self, num_classes, num_channels=3, pretrained=True):
         super().__init__()
 
         filters = [256, 512, 1024, 2048]
-        resnet = resnext101_32x4d(num_classes=1000, pretrained='imagenet')
+        resnet = resnext101_32x4d(num_classes=1000, pretrained='imagenet', load_weights=pretrained)
 
         self.stem = resnet.stem
         self.encoder1 = resnet.layer1
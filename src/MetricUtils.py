@@ -0,0 +1,78 @@
+import torch
+import torch.distributed as dist
+
+from DistUtils import is_distributed
+
+def dice_iou(intersection, pred_area, target_area):
+    """Dice and IoU of thresholded masks from their pixel areas, 1 when both masks are empty"""
+    union = pred_area + target_area - intersection
+    if union == 0:
+        return 1.0, 1.0
+    return 2 * intersection / (pred_area + target_area), intersection / union
+
+class SegmentationMeter(object):
+    """
+    Running sums of the loss and of the dice / IoU pixel areas of every city
+    The sums stay on the device: update() never waits for it, only summary()
+    copies them to the host, so call it every print_freq steps and at epoch end
+    """
+    def __init__(self, cities, device, thresh=0.5):
+        self.cities = list(cities)
+        self.device = device
+        self.thresh = thresh
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros(1, dtype=torch.float64, device=self.device)
+        self.last_loss = torch.zeros(1, dtype=torch.float64, device=self.device)
+        # intersection, predicted and target pixels, images of every city
+        self.areas = torch.zeros(len(self.cities), 4, dtype=torch.float64, device=self.device)
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, loss, output, target, city=None):
+        """
+        :param loss: batch mean loss tensor
+        :param city: city index of every image, all the images count to the first city if None
+        """
+        n = output.size(0)
+        loss = loss.detach().double().view(1)
+        self.last_loss.copy_(loss)
+        self.loss_sum += loss * n
+        self.count += n
+        pred = (output.detach() > self.thresh).flatten(1).float()
+        true = (target.detach() > 0.5).flatten(1).float()
+        areas = torch.stack([(pred * true).sum(1),
+                             pred.sum(1),
+                             true.sum(1),
+                             torch.ones_like(pred[:, 0])], 1).double()
+        if city is None:
+            city = torch.zeros(n, dtype=torch.long, device=self.device)
+        self.areas.index_add_(0, city.to(self.device, non_blocking=True), areas)
+
+    def summary(self, all_reduce=False):
+        """
+        Average loss, the loss of the last batch, dice and IoU overall and of every city with images
+        all_reduce sums the totals of all the DDP processes, every process has to call it
+        """
+        totals = torch.cat([self.loss_sum,
+                            self.last_loss,
+                            torch.tensor([self.count], dtype=torch.float64, device=self.device),
+                            self.areas.view(-1)])
+        if all_reduce and is_distributed():
+            dist.all_reduce(totals)
+            totals[1] /= dist.get_world_size()
+        totals = totals.cpu().numpy()
+        loss_sum, last_loss, count = totals[:3]
+        areas = totals[3:].reshape(len(self.cities), 4)
+
+        metrics = {'loss': loss_sum / max(count, 1), 'loss_last': last_loss}
+        metrics['dice'], metrics['iou'] = dice_iou(*areas[:, :3].sum(0))
+        for city, area in zip(self.cities, areas):
+            if area[3] > 0:
+                metrics['dice_' + city], metrics['iou_' + city] = dice_iou(*area[:3])
+        return {key: float(value) for key, value in metrics.items()}
+
+def format_city_metrics(metrics, cities):
+    return '  '.join('{} dice {:.4f} IoU {:.4f}'.format(city, metrics['dice_' + city], metrics['iou_' + city])
+                     for city in cities if 'dice_' + city in metrics)
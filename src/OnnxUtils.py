@@ -0,0 +1,73 @@
+import time
+import numpy as np
+import torch
+
+def export_onnx(model, path, num_channels=3, size=256, opset=17):
+    """
+    Export a segmentation model to ONNX with dynamic batch and spatial axes
+    Spatial sizes still have to be multiples of 32 at inference time
+    """
+    model.eval()
+    dummy = torch.randn(1, num_channels, size, size)
+    dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'},
+                    'output': {0: 'batch', 2: 'height', 3: 'width'}}
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          dummy,
+                          path,
+                          input_names=['input'],
+                          output_names=['output'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset)
+
+class OnnxModel(object):
+    """
+    onnxruntime CPU session that can be called like the torch model,
+    so it drops into predict, TTA and the sliding window predictor
+    """
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path,
+                                            sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, input):
+        input = input.detach().cpu().contiguous().numpy().astype(np.float32)
+        output = self.session.run(None, {self.input_name: input})[0]
+        return torch.from_numpy(output)
+
+def check_parity(model, onnx_model, input, atol=1e-4):
+    """Max absolute difference between the torch and the ONNX outputs"""
+    with torch.no_grad():
+        expected = model(input)
+    actual = onnx_model(input)
+    diff = (expected - actual).abs().max().item()
+    print(' * ONNX parity on {}: max abs diff {:.2e} (tolerance {:.0e})'
+          .format(tuple(input.shape), diff, atol))
+    if diff > atol:
+        raise ValueError('ONNX output differs from PyTorch by {}'.format(diff))
+    return diff
+
+def compare_throughput(model, onnx_model, input, repeats=5):
+    """Print images per second of the torch model and of the ONNX session"""
+    rates = {}
+    for name, runner in [('pytorch', model), ('onnxruntime', onnx_model)]:
+        with torch.no_grad():
+            runner(input)
+            start = time.time()
+            for _ in range(repeats):
+                runner(input)
+        elapsed = time.time() - start
+        rates[name] = repeats * input.size(0) / elapsed
+        print(' * {:<12}: {:.3f} images/s on {}'.format(name, rates[name], tuple(input.shape)))
+    print(' * onnxruntime speedup x{:.2f}'.format(rates['onnxruntime'] / rates['pytorch']))
+    return rates
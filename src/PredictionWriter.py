@@ -0,0 +1,97 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# jpg keeps the original output (default quality), the other formats store 0-255 probabilities losslessly
+write_formats = ['jpg','png','webp','npz']
+
+def to_uint8(prob):
+    return np.round(np.clip(prob, 0, 1) * 255).astype(np.uint8)
+
+def write_prediction(prob, path, fmt):
+    """Encode a single HxW probability map and write it to path + extension"""
+    if fmt == 'jpg':
+        Image.fromarray(to_uint8(prob)).save(path + '.jpg')
+    elif fmt == 'png':
+        Image.fromarray(to_uint8(prob)).save(path + '.png', compress_level=1)
+    elif fmt == 'webp':
+        # webp has no grayscale mode, read it back with .convert('L')
+        Image.fromarray(to_uint8(prob)).save(path + '.webp', lossless=True, quality=0, method=0)
+    elif fmt == 'npz':
+        np.savez_compressed(path + '.npz', prob=to_uint8(prob))
+    else:
+        raise ValueError('Prediction format not supported')
+
+def read_prediction(path, shape=None):
+    """
+    HxW uint8 probability map of a file written by write_prediction, the format is the extension
+    Other npz files, e.g. float probabilities, and maps of another shape are rejected
+    """
+    fmt = os.path.splitext(path)[1][1:].lower()
+    if fmt == 'npz':
+        with np.load(path) as data:
+            if 'prob' not in data.files:
+                raise ValueError('{}: npz without a prob array not supported'.format(path))
+            prob = data['prob']
+        if prob.dtype != np.uint8:
+            raise ValueError('{}: {} prediction maps not supported, expected uint8'.format(path, prob.dtype))
+    elif fmt in write_formats:
+        # webp is saved as RGB, all the channels hold the same values
+        prob = np.asarray(Image.open(path).convert('L'))
+    else:
+        raise ValueError('Prediction format not supported')
+    if shape is not None and prob.shape != tuple(shape):
+        raise ValueError('{}: {} prediction maps not supported, expected {}'.format(path, prob.shape, tuple(shape)))
+    return prob
+
+class PredictionWriter(object):
+    """
+    Thread pool that encodes and writes predictions while the next batch is computed
+    At most max_pending maps are queued, submit blocks when the queue is full
+    """
+    def __init__(self, fmt='jpg', workers=4, max_pending=32):
+        if fmt not in write_formats:
+            raise ValueError('Prediction format not supported')
+        self.fmt = fmt
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.folders = set()
+        self.folders_lock = threading.Lock()
+        self.futures = []
+
+    def _write(self, prob, folder, name):
+        try:
+            # every folder is created once instead of checked for every tile
+            if folder not in self.folders:
+                with self.folders_lock:
+                    if folder not in self.folders:
+                        os.makedirs(folder, exist_ok=True)
+                        self.folders.add(folder)
+            write_prediction(prob, os.path.join(folder, name), self.fmt)
+        finally:
+            self.slots.release()
+
+    def submit(self, prob, folder, name):
+        """
+        :param prob: HxW numpy array already copied to the host
+        :param name: file name without the extension
+        """
+        self.slots.acquire()
+        self.futures.append(self.pool.submit(self._write, prob, folder, name))
+        # only unfinished and failed writes are kept around for flush
+        if len(self.futures) > 1024:
+            self.futures = [future for future in self.futures
+                            if not future.done() or future.exception() is not None]
+
+    def flush(self):
+        """Wait until everything submitted so far is on disk, re-raise write errors"""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
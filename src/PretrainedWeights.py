@@ -0,0 +1,32 @@
+import os
+import torch
+
+# ImageNet weights of the torchvision encoders, the files torchvision downloads for pretrained=True
+pretrained_urls = {
+    'resnet34': 'https://download.pytorch.org/models/resnet34-b627a593.pth',
+    'resnet50': 'https://download.pytorch.org/models/resnet50-0676ba61.pth',
+    'vgg11': 'https://download.pytorch.org/models/vgg11-8a719358.pth',
+}
+
+# local weights cache, if set the weights are only read from there and never downloaded
+# otherwise they come from the torch hub cache and are downloaded when missing
+pretrained_dir = os.environ.get('PRETRAINED_DIR', '')
+
+def set_pretrained_dir(weights_dir):
+    global pretrained_dir
+    pretrained_dir = weights_dir
+
+def load_pretrained_state_dict(url):
+    """State dict of the weights file of url, from the local weights cache when it is set"""
+    if pretrained_dir:
+        path = os.path.join(pretrained_dir, os.path.basename(url))
+        if not os.path.isfile(path):
+            raise ValueError('Pretrained weights {} not found, download {} into {} '
+                             'or restore a checkpoint'.format(path, url, pretrained_dir))
+        return torch.load(path, map_location='cpu')
+    return torch.hub.load_state_dict_from_url(url, map_location='cpu', progress=False)
+
+def load_pretrained(model, name):
+    """Load the ImageNet weights of a torchvision encoder, return the model"""
+    model.load_state_dict(load_pretrained_state_dict(pretrained_urls[name]))
+    return model
@@ -0,0 +1,102 @@
+import copy
+import time
+import torch
+import torch.nn as nn
+
+from torch.ao.quantization import QConfig,QConfigMapping,get_default_qconfig,default_weight_observer
+from torch.ao.quantization.quantize_fx import prepare_fx,convert_fx
+
+from MetricUtils import dice_iou
+
+# the full resolution head, kept in fp32 with fp32_head=True
+head_modules = ['finaldeconv1','finalconv2','finalconv3']
+
+def qconfig_mapping(backend='fbgemm', fp32_head=True):
+    qconfig = get_default_qconfig(backend)
+    # per channel weights are not supported for transposed convs
+    deconv_qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+    mapping = (QConfigMapping().set_global(qconfig)
+                               .set_object_type(nn.ConvTranspose2d, deconv_qconfig))
+    if fp32_head:
+        for name in head_modules:
+            mapping = mapping.set_module_name(name, None)
+    return mapping
+
+def prepare_model(model, num_channels=3, backend='fbgemm', fp32_head=True):
+    """
+    Trace the float model with FX and insert observers
+    prepare_fx folds every conv + bn (+ relu) of the resnet encoder and of the
+    DecoderBlocks, transposed convs included, before observing
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (torch.randn(1, num_channels, 64, 64),)
+    return prepare_fx(model, qconfig_mapping(backend, fp32_head), example_inputs)
+
+def calibrate(prepared, loader, num_batches):
+    """Run calibration batches through the observed model"""
+    with torch.no_grad():
+        for i, (input, _) in enumerate(loader):
+            if i >= num_batches:
+                break
+            prepared(input.float())
+    return prepared
+
+def quantize_model(model, loader, num_batches=16, num_channels=3, backend='fbgemm', fp32_head=True):
+    """Post-training static int8 quantization calibrated on the loader"""
+    prepared = prepare_model(model, num_channels, backend, fp32_head)
+    calibrate(prepared, loader, num_batches)
+    return convert_fx(prepared)
+
+def save_quantized(model, path, arch, preset, backend, fp32_head):
+    torch.save({
+        'arch': arch,
+        'preset': preset,
+        'backend': backend,
+        'fp32_head': fp32_head,
+        'state_dict': model.state_dict(),
+    }, path)
+
+def load_quantized(model, path, num_channels=3):
+    """
+    Rebuild the quantized graph from the float model and load the int8 weights
+    The float weights are irrelevant, they are replaced by the checkpoint
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    prepared = prepare_model(model, num_channels, checkpoint['backend'], checkpoint['fp32_head'])
+    quantized = convert_fx(prepared)
+    quantized.load_state_dict(checkpoint['state_dict'])
+    return quantized
+
+def compare_metrics(model, quantized, loader, thresh=0.5, num_batches=None):
+    """
+    Dice and IoU of the float and the quantized model run on the same batches
+    Returns the (dice, iou) of both models over the loader and the per batch
+    (fp32 dice, int8 dice, fp32 iou, int8 iou), so the drop is not crop noise
+    """
+    areas = [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]
+    batches = []
+    with torch.no_grad():
+        for i, (input, target) in enumerate(loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            input = input.float()
+            target = target > 0.5
+            batch = []
+            for total, m in zip(areas, (model, quantized)):
+                pred = m(input) > thresh
+                area = [(pred & target).sum().item(), pred.sum().item(), target.sum().item()]
+                for j in range(3):
+                    total[j] += area[j]
+                batch.append(dice_iou(*area))
+            batches.append((batch[0][0], batch[1][0], batch[0][1], batch[1][1]))
+    return dice_iou(*areas[0]), dice_iou(*areas[1]), batches
+
+def time_model(model, input, repeats=3):
+    """Seconds per forward pass of the batch"""
+    with torch.no_grad():
+        model(input)
+        start = time.time()
+        for _ in range(repeats):
+            model(input)
+    return (time.time() - start) / repeats
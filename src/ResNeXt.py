@@ -1,7 +1,7 @@
 import os
 import torch
 import torch.nn as nn
-import torch.utils.model_zoo as model_zoo
+from PretrainedWeights import load_pretrained_state_dict
 from resnext_features.resnext101_32x4d_features import resnext101_32x4d_features,resnext101_32x4d_features_blob
 from resnext_features import resnext101_64x4d_features
 
@@ -108,14 +108,16 @@ class ResNeXt101_64x4d(nn.Module):
         x = self.logits(x)
         return x
 
-def resnext101_32x4d(num_classes=1000, pretrained='imagenet'):
+def resnext101_32x4d(num_classes=1000, pretrained='imagenet', load_weights=True):
+    """load_weights=False keeps the layout of the pretrained model without downloading its weights"""
     model = ResNeXt101_32x4d(num_classes=num_classes)
     model_blob = ResNeXt101_32x4d_blob(num_classes=num_classes)
     if pretrained is not None:
         settings = pretrained_settings['resnext101_32x4d'][pretrained]
         assert num_classes == settings['num_classes'], \
             "num_classes should be {}, but is {}".format(settings['num_classes'], num_classes)
-        model_blob.load_state_dict(model_zoo.load_url(settings['url']))
+        if load_weights:
+            model_blob.load_state_dict(load_pretrained_state_dict(settings['url']))
         
         model.stem = nn.Sequential( 
             model_blob.features[0],
@@ -151,7 +153,7 @@ def resnext101_64x4d(num_classes=1000, pretrained='imagenet'):
         settings = pretrained_settings['resnext101_64x4d'][pretrained]
         assert num_classes == settings['num_classes'], \
             "num_classes should be {}, but is {}".format(settings['num_classes'], num_classes)
-        model.load_state_dict(model_zoo.load_url(settings['url']))
+        model.load_state_dict(load_pretrained_state_dict(settings['url']))
         model.input_space = settings['input_space']
         model.input_size = settings['input_size']
         model.input_range = settings['input_range']
@@ -89,11 +89,12 @@ class SatellitesTrainAugmentation(object):
         mask = self.augment_mask(mask)
         return img,mask
 class SatellitesTestAugmentation(object):
-    def __init__(self,shape=1280,padding=6):
-        self.augment_img = Compose([
+    def __init__(self,shape=1280,padding=6,crop=True):
+        # crop=False for crops cut beforehand at fixed positions
+        crop = [RandomCrop(shape)] if crop else [] # most likely causing low score on test test!
+        self.augment_img = Compose(crop + [
                 # NpyToPil(),
                 # transforms.Pad(padding=padding, fill=0),
-                RandomCrop(shape), # most likely causing low score on test test!          
                 # NumpyPad(padding),
                 # NpyToPil(),
                 # transforms.Scale(shape),
@@ -101,10 +102,9 @@ class SatellitesTestAugmentation(object):
                 ToTensor(),
                 normalize
             ])
-        self.augment_mask = Compose([
+        self.augment_mask = Compose(crop + [
                 # NpyToPil(),
                 # transforms.Pad(padding=padding, fill=0),
-                RandomCrop(shape), # most likely causing low score on test test!          
                 # NumpyPad(padding),
                 # NpyToPil(),
                 # transforms.Scale(shape),
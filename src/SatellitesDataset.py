@@ -3,6 +3,7 @@ import time
 import numpy as np
 import pandas as pd
 from skimage.io import imread
+import torch
 import torch.utils.data as data
 
 import warnings
@@ -88,6 +89,17 @@ def get_train_dataset(preset,
     
     return bit8_imgs,bit8_masks,cty_no
 
+# cities of the AOI folders, e.g. AOI_2_Vegas_Roads_Train
+city_names = ['vegas','paris','shanghai','khartoum']
+
+def city_index(path):
+    """Index in city_names of the city of an image path"""
+    path = path.lower()
+    for i, city in enumerate(city_names):
+        if '_{}_roads'.format(city) in path:
+            return i
+    raise ValueError('City not found in path {}'.format(path))
+
 # dataset class
 class SatellitesDataset(data.Dataset):
     def __init__(self,
@@ -95,11 +107,15 @@ class SatellitesDataset(data.Dataset):
                  image_paths = [],
                  mask_paths = None,                 
                  transforms = None,
+                 cache = None,
+                 with_city = False,
                  ):
         
         self.mask_paths = mask_paths
         self.preset = preset
         self.transforms = transforms
+        self.cache = cache
+        self.with_city = with_city
         
         if mask_paths is not None:
             self.image_paths = sorted(image_paths)
@@ -112,6 +128,8 @@ class SatellitesDataset(data.Dataset):
         else:
             self.image_paths = image_paths
             # self.image_paths = sorted(image_paths)
+        if with_city:
+            self.city_ids = [city_index(path) for path in self.image_paths]
                 
     def __len__(self):
         return len(self.image_paths)
@@ -119,24 +137,17 @@ class SatellitesDataset(data.Dataset):
     def __getitem__(self, idx):
         if self.mask_paths is not None: 
 
-            img = imread(self.image_paths[idx])
-            target_channels = np.zeros(shape=(self.preset['width'],self.preset['width'],len(self.preset['channels'])))
-            
-            # expand grayscale images to 3 dimensions
-            if len(img.shape)<3:
-                img = np.expand_dims(img, 2)                
-            
-            for i,channel in enumerate(self.preset['channels']):
-                target_channels[:,:,i] = img[:,:,channel-1]
-            
-            target_channels = target_channels.astype('uint8')
-            
-            mask = imread(self.mask_paths[idx])
-            mask = mask.astype('uint8')
+            if self.cache is not None and self.image_paths[idx] in self.cache:
+                target_channels, mask = self.cache.get(self.image_paths[idx])
+            else:
+                target_channels, mask = self.read_pair(idx)
             
             if self.transforms is not None:
                  target_channels, mask = self.transforms(target_channels, mask)
             
+            # the city index is used for per city metrics
+            if self.with_city:
+                return target_channels,mask,self.city_ids[idx]
             return target_channels,mask                    
 
         else:
@@ -152,6 +163,128 @@ class SatellitesDataset(data.Dataset):
                  target_channels, _ = self.transforms(target_channels, None)
             return target_channels
 
+    def read_pair(self, idx):
+        """Decode the preset channels of an image and its mask, without transforms"""
+        img = imread(self.image_paths[idx])
+        target_channels = np.zeros(shape=(self.preset['width'],self.preset['width'],len(self.preset['channels'])))
+        
+        # expand grayscale images to 3 dimensions
+        if len(img.shape)<3:
+            img = np.expand_dims(img, 2)                
+        
+        for i,channel in enumerate(self.preset['channels']):
+            target_channels[:,:,i] = img[:,:,channel-1]
+        
+        target_channels = target_channels.astype('uint8')
+        
+        mask = imread(self.mask_paths[idx])
+        mask = mask.astype('uint8')
+        return target_channels, mask
+
+class DecodedCache(object):
+    """
+    Preset channels and masks decoded once into .npy files and memory mapped
+    read-only, processes training in parallel share them through the page cache
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.images = None
+        self.masks = None
+        index_df = pd.read_csv(os.path.join(cache_dir,'index.csv'))
+        self.index = dict(zip(index_df.image_path.values, range(len(index_df))))
+
+    def __getstate__(self):
+        # loader workers map the files again instead of receiving copies
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['masks'] = None
+        return state
+
+    def __contains__(self, image_path):
+        return image_path in self.index
+
+    def get(self, image_path):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.cache_dir,'images.npy'), mmap_mode='r')
+            self.masks = np.load(os.path.join(self.cache_dir,'masks.npy'), mmap_mode='r')
+        i = self.index[image_path]
+        return np.array(self.images[i]), np.array(self.masks[i])
+
+class FixedCropDataset(data.Dataset):
+    """
+    Validation pairs cropped once at fixed positions and iterated in a fixed order
+    The uint8 crops live in shared memory for the life of the dataset: loader
+    workers fill them during the first epoch, later epochs only run the transforms
+    """
+    def __init__(self,
+                 dataset,
+                 shape,
+                 transforms = None,
+                 seed = 0,
+                 ):
+        # the wrapped dataset must not have transforms
+        self.dataset = dataset
+        self.shape = shape
+        self.transforms = transforms
+        self.seed = seed
+        # allocated before the workers fork so that all of them write the same memory
+        channels = len(dataset.preset['channels'])
+        self.images = torch.empty(len(dataset), shape, shape, channels, dtype=torch.uint8).share_memory_()
+        self.masks = torch.empty(len(dataset), shape, shape, dtype=torch.uint8).share_memory_()
+        self.cached = torch.zeros(len(dataset), dtype=torch.uint8).share_memory_()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def crop_position(self, idx, height, width):
+        rng = np.random.RandomState([self.seed, idx])
+        return rng.randint(0, height - self.shape + 1), rng.randint(0, width - self.shape + 1)
+
+    def __getitem__(self, idx):
+        if not self.cached[idx]:
+            item = self.dataset[idx]
+            target_channels, mask = item[0], item[1]
+            y, x = self.crop_position(idx, *target_channels.shape[:2])
+            self.images[idx] = torch.from_numpy(np.ascontiguousarray(target_channels[y:y+self.shape, x:x+self.shape]))
+            self.masks[idx] = torch.from_numpy(np.ascontiguousarray(mask[y:y+self.shape, x:x+self.shape]))
+            self.cached[idx] = 1
+
+        target_channels, mask = self.images[idx].numpy(), self.masks[idx].numpy()
+        if self.transforms is not None:
+            target_channels, mask = self.transforms(target_channels, mask)
+        if self.dataset.with_city:
+            return target_channels,mask,self.dataset.city_ids[idx]
+        return target_channels,mask
+
+def build_decoded_cache(cache_dir,
+                        preset,
+                        image_paths,
+                        mask_paths):
+    """Decode all the image / mask pairs into cache_dir, an existing cache is kept"""
+    if os.path.isfile(os.path.join(cache_dir,'index.csv')):
+        return DecodedCache(cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    dataset = SatellitesDataset(preset = preset,
+                                image_paths = image_paths,
+                                mask_paths = mask_paths)
+    image, mask = dataset.read_pair(0)
+    images = np.lib.format.open_memmap(os.path.join(cache_dir,'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(dataset),) + image.shape)
+    masks = np.lib.format.open_memmap(os.path.join(cache_dir,'masks.npy'), mode='w+',
+                                      dtype=np.uint8, shape=(len(dataset),) + mask.shape)
+    for i in range(len(dataset)):
+        images[i], masks[i] = dataset.read_pair(i)
+    images.flush()
+    masks.flush()
+    del images, masks
+
+    # the index is written last and marks the cache as complete
+    pd.DataFrame({'image_path': dataset.image_paths,
+                  'mask_path': dataset.mask_paths}).to_csv(os.path.join(cache_dir,'index.csv'), index=False)
+    return DecodedCache(cache_dir)
+
 def get_train_dataset_for_predict(preset,
                                   preset_dict,
                                   city='all'):
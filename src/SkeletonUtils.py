@@ -0,0 +1,83 @@
+import numpy as np
+from numba import njit, types
+
+# fused threshold + thinning kernels for the linestring post-processing
+# they work on a uint8 buffer with a 1 pixel zero border,
+# which is exactly the layout sknw expects (as uint16)
+
+def guo_hall_luts():
+    """
+    Lookup tables of the two Guo-Hall thinning sub-iterations
+    The index is the 8-neighbourhood code, bits go counter-clockwise
+    starting from the east neighbour
+    """
+    luts = np.zeros((2, 256), dtype=np.uint8)
+    for code in range(256):
+        bits = [bool(code >> i & 1) for i in range(8)]
+
+        g1 = sum((not bits[i]) and (bits[i + 1] or bits[(i + 2) % 8])
+                 for i in (0, 2, 4, 6)) == 1
+
+        n1 = sum(bits[k] or bits[k - 1] for k in (1, 3, 5, 7))
+        n2 = sum(bits[k] or bits[(k + 1) % 8] for k in (1, 3, 5, 7))
+        g2 = min(n1, n2) in (2, 3)
+
+        g3 = not ((bits[1] or bits[2] or not bits[7]) and bits[0])
+        g3p = not ((bits[5] or bits[6] or not bits[3]) and bits[4])
+
+        luts[0, code] = g1 and g2 and g3
+        luts[1, code] = g1 and g2 and g3p
+    return luts
+
+LUTS = guo_hall_luts()
+
+@njit(cache=True) # threshold (and max pool if factor > 1) into the bordered buffer
+def threshold(msk, thresh, factor, buf):
+    for r in range(msk.shape[0]):
+        for c in range(msk.shape[1]):
+            if msk[r, c] > thresh:
+                buf[1 + r // factor, 1 + c // factor] = 1
+
+@njit(types.void(types.uint8[:, :], types.uint8[:, :]), cache=True) # thin the buffer in place
+def thin(buf, luts):
+    height, width = buf.shape
+    changed = True
+    while changed:
+        changed = False
+        for step in range(2):
+            # mark the removable pixels with 2, they still count as set
+            for r in range(1, height - 1):
+                for c in range(1, width - 1):
+                    if buf[r, c] == 0:
+                        continue
+                    code = 0
+                    if buf[r, c + 1]: code |= 1
+                    if buf[r - 1, c + 1]: code |= 2
+                    if buf[r - 1, c]: code |= 4
+                    if buf[r - 1, c - 1]: code |= 8
+                    if buf[r, c - 1]: code |= 16
+                    if buf[r + 1, c - 1]: code |= 32
+                    if buf[r + 1, c]: code |= 64
+                    if buf[r + 1, c + 1]: code |= 128
+                    if luts[step, code]:
+                        buf[r, c] = 2
+                        changed = True
+            for r in range(1, height - 1):
+                for c in range(1, width - 1):
+                    if buf[r, c] == 2:
+                        buf[r, c] = 0
+
+def skeleton_buffer(msk, thresh=30, factor=1):
+    """
+    Threshold and skeletonize a mask straight into a sknw buffer
+    :param msk: 2d mask
+    :param thresh: binarization threshold
+    :param factor: downsample factor, the mask is max pooled before thinning
+    :return: uint16 skeleton with a 1 pixel zero border
+    """
+    height = -(-msk.shape[0] // factor)
+    width = -(-msk.shape[1] // factor)
+    buf = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    threshold(msk, thresh, factor, buf)
+    thin(buf, LUTS)
+    return buf.astype(np.uint16)
@@ -0,0 +1,160 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import torch
+
+from InferenceUtils import tta_forward
+
+# imagenet normalization applied by SatellitesAugs to every 3 channel chunk,
+# 8 channel images are normalized as channels 0:3, 3:6 and 6:8 (the tail of 5:8)
+mean = [0.485, 0.456, 0.406]
+std = [0.229, 0.224, 0.225]
+
+def channel_stats(num_channels):
+    if num_channels == 8:
+        return mean + mean + mean[1:], std + std + std[1:]
+    return mean[:num_channels], std[:num_channels]
+
+def blend_weights(window, kind='cosine'):
+    """
+    2d weight map used to blend overlapping windows
+    Borders get small but non zero weights, so raster edges covered by
+    a single window are still normalized properly
+    """
+    x = (np.arange(window) + 0.5) / window
+    if kind == 'cosine':
+        w = 0.5 - 0.5 * np.cos(2 * np.pi * x)
+    elif kind == 'gaussian':
+        w = np.exp(-0.5 * ((x - 0.5) / 0.25) ** 2)
+    elif kind == 'mean':
+        w = np.ones(window)
+    else:
+        raise ValueError('Blending not supported')
+    w = np.maximum(w, 1e-3)
+    return np.outer(w, w).astype(np.float32)
+
+def window_offsets(size, window, stride):
+    """Window starts covering [0, size), the last window is aligned to the end"""
+    if size <= window:
+        return [0]
+    offsets = list(range(0, size - window, stride))
+    offsets.append(size - window)
+    return offsets
+
+class SlidingWindowPredictor(object):
+    """
+    Predict rasters of any size with overlapping windows
+    The raster is processed in column bands and rows of windows, only a
+    window x band_width accumulator is kept in memory and finished rows
+    are written to the output right away
+    """
+    def __init__(self,
+                 model,
+                 device,
+                 window=1312,
+                 overlap=256,
+                 batch_size=4,
+                 band_width=8192,
+                 blend='cosine',
+                 tta=1,
+                 channels_last=False):
+        if overlap >= window:
+            raise ValueError('Overlap should be smaller than the window')
+        self.model = model
+        self.device = device
+        self.window = window
+        self.stride = window - overlap
+        self.batch_size = batch_size
+        self.band_width = max(band_width, window)
+        self.weights = blend_weights(window, blend)
+        self.tta = tta
+        self.channels_last = channels_last
+
+    def _predict_batch(self, chunks, norm_mean, norm_std):
+        input = torch.from_numpy(np.stack(chunks)).float().div(255)
+        input = (input - norm_mean) / norm_std
+        input = input.to(self.device, non_blocking=True)
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            output = tta_forward(self.model, input, self.tta)
+        return output[:, 0].cpu().numpy()
+
+    def predict_raster(self, src_path, dst_path, channels, as_float=False):
+        """
+        :param channels: 1-based band indexes to feed the model, as in presets
+        :param as_float: write float32 probabilities instead of 0-255 uint8
+        """
+        norm_mean, norm_std = channel_stats(len(channels))
+        norm_mean = torch.tensor(norm_mean).view(1, -1, 1, 1)
+        norm_std = torch.tensor(norm_std).view(1, -1, 1, 1)
+
+        with rasterio.open(src_path) as src:
+            profile = src.profile.copy()
+            profile.update(count=1,
+                           dtype='float32' if as_float else 'uint8',
+                           tiled=True,
+                           blockxsize=256,
+                           blockysize=256,
+                           compress='deflate',
+                           nodata=None)
+            height, width = src.height, src.width
+            rows = window_offsets(height, self.window, self.stride)
+            cols = window_offsets(width, self.window, self.stride)
+
+            with rasterio.open(dst_path, 'w', **profile) as dst:
+                for band_start in range(0, width, self.band_width):
+                    band_stop = min(width, band_start + self.band_width)
+                    band_cols = [col for col in cols
+                                 if col < band_stop and col + self.window > band_start]
+                    self._predict_band(src, dst, rows, band_cols,
+                                       band_start, band_stop, height,
+                                       channels, norm_mean, norm_std, as_float)
+
+    def _predict_band(self, src, dst, rows, band_cols,
+                      band_start, band_stop, height,
+                      channels, norm_mean, norm_std, as_float):
+        band_w = band_stop - band_start
+        # the accumulators always start at the current row of windows
+        acc = np.zeros((self.window, band_w), dtype=np.float32)
+        weight_sum = np.zeros((self.window, band_w), dtype=np.float32)
+        top = 0
+
+        for k, row in enumerate(rows):
+            for batch_start in range(0, len(band_cols), self.batch_size):
+                batch_cols = band_cols[batch_start:batch_start + self.batch_size]
+                chunks = [src.read(channels,
+                                   window=Window(col, row, self.window, self.window),
+                                   boundless=True,
+                                   fill_value=0)
+                          for col in batch_cols]
+                preds = self._predict_batch(chunks, norm_mean, norm_std)
+
+                for col, pred in zip(batch_cols, preds):
+                    # clip the window to the band
+                    start = max(col, band_start)
+                    stop = min(col + self.window, band_stop)
+                    window_slice = slice(start - col, stop - col)
+                    band_slice = slice(start - band_start, stop - band_start)
+                    acc[row - top:row - top + self.window, band_slice] += \
+                        pred[:, window_slice] * self.weights[:, window_slice]
+                    weight_sum[row - top:row - top + self.window, band_slice] += \
+                        self.weights[:, window_slice]
+
+            # rows above the next window row will not change any more
+            done = rows[k + 1] if k + 1 < len(rows) else min(height, row + self.window)
+            if done > top:
+                self._write_rows(dst, acc[:done - top], weight_sum[:done - top],
+                                 top, band_start, as_float)
+                shift = done - top
+                acc[:-shift] = acc[shift:]
+                acc[-shift:] = 0
+                weight_sum[:-shift] = weight_sum[shift:]
+                weight_sum[-shift:] = 0
+                top = done
+
+    def _write_rows(self, dst, acc, weight_sum, top, band_start, as_float):
+        prob = acc / np.maximum(weight_sum, 1e-6)
+        if not as_float:
+            prob = np.round(prob * 255).astype(np.uint8)
+        dst.write(prob, 1, window=Window(band_start, top, prob.shape[1], prob.shape[0]))
@@ -1,71 +1,120 @@
 # Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
-import tensorflow as tf
+# A thin wrapper over the torch TensorBoard writer, which writes event files in its own thread
+import atexit
+import queue
+import threading
 import numpy as np
-import scipy.misc 
-try:
-    from StringIO import StringIO  # Python 2.7
-except ImportError:
-    from io import BytesIO         # Python 3.x
+import torch
+import torch.nn.functional as F
+from torch.utils.tensorboard import SummaryWriter
 
+def to_uint8(img):
+    """HW or HWC image scaled to 0-255 as scipy.misc.toimage did"""
+    img = np.asarray(img)
+    if img.ndim == 3 and img.shape[0] in (1, 3) and img.shape[2] not in (1, 3):
+        img = img.transpose(1, 2, 0)
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+    if img.dtype != np.uint8:
+        img = img.astype(np.float32)
+        low, high = img.min(), img.max()
+        img = ((img - low) * (255.0 / max(high - low, 1e-12))).round().astype(np.uint8)
+    return img
 
 class Logger(object):
-    
-    def __init__(self, log_dir):
+    """
+    Same API as the TensorFlow logger
+    Images are converted and PNG encoded by a daemon thread fed through a queue,
+    snapshot_images only queues a copy started without waiting for the device
+    flush / close wait for the queue to be drained
+    """
+    def __init__(self, log_dir, max_queue=256, max_pending=64):
         """Create a summary writer logging to log_dir."""
-        self.writer = tf.summary.FileWriter(log_dir)
+        self.writer = SummaryWriter(log_dir, max_queue=max_queue)
+        # put blocks once max_pending snapshots wait, the copies are not held without bound
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._encode_images, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        self.writer.add_scalar(tag, float(value), step)
 
     def image_summary(self, tag, images, step):
         """Log a list of images."""
+        self.queue.put((tag, images, step, None))
 
-        img_summaries = []
+    def _add_images(self, tag, images, step):
         for i, img in enumerate(images):
-            # Write the image to a string
+            img = to_uint8(img)
+            self.writer.add_image('%s/%d' % (tag, i), img, step, dataformats='HW' if img.ndim == 2 else 'HWC')
+
+    def _encode_images(self):
+        while True:
+            item = self.queue.get()
             try:
-                s = StringIO()
-            except:
-                s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+                if item is None:
+                    return
+                tag, images, step, ready = item
+                if ready is not None:
+                    ready.synchronize()
+                if torch.is_tensor(images):
+                    images = images.numpy()
+                    images = images[:, 0] if images.shape[1] == 1 else images
+                self._add_images(tag, images, step)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
+    def snapshot_images(self, tag, batch, step, max_images=5, size=0):
+        """
+        Log the first images of an NCHW or NHW batch without waiting for the device
+        Images are downscaled to thumbnails with the longer side of `size` on the
+        device and copied asynchronously to pinned memory
+        """
+        batch = batch.detach()[:max_images]
+        if batch.dim() == 3:
+            batch = batch.unsqueeze(1)
+        # only the first 3 channels are shown
+        batch = batch[:, :3].float()
+        height, width = batch.shape[-2:]
+        if size and max(height, width) > size:
+            scale = size / max(height, width)
+            batch = F.adaptive_avg_pool2d(batch, (max(int(round(height * scale)), 1),
+                                                  max(int(round(width * scale)), 1)))
+        if batch.is_cuda:
+            host = torch.empty(batch.shape, dtype=batch.dtype, pin_memory=True)
+            host.copy_(batch, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        else:
+            host = batch.clone()
+            ready = None
+        self.queue.put((tag, host, step, ready))
 
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
-        
     def histo_summary(self, tag, values, step, bins=1000):
         """Log a histogram of the tensor of values."""
+        self.writer.add_histogram(tag, np.asarray(values), step, bins=bins)
+        self.writer.flush()
 
-        # Create a histogram using numpy
-        counts, bin_edges = np.histogram(values, bins=bins)
-
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values**2))
-
-        # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
-
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
-
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
+    def flush(self):
+        """Wait for the queued images and write everything logged so far to disk"""
+        self.queue.join()
         self.writer.flush()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.writer is not None:
+            self.queue.join()
+            self.queue.put(None)
+            self.thread.join()
+            self.writer.close()
+            self.writer = None
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
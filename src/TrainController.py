@@ -0,0 +1,113 @@
+import time
+import torch
+import torch.distributed as dist
+
+from DistUtils import is_distributed
+
+def parse_duration(duration):
+    """'2h', '90m', '45s' or plain seconds -> seconds, '' or 0 -> 0 (no budget)"""
+    if not duration:
+        return 0
+    units = {'h': 3600, 'm': 60, 's': 1}
+    if duration[-1] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
+
+class TrainController(object):
+    """
+    Decides after every epoch, once its checkpoint is saved, whether training goes on
+    Training stops when
+        - the val loss did not improve by more than min_delta for `patience` epochs
+        - ReduceLROnPlateau has reached min_lr and the val loss still plateaus
+        - the next epoch would not fit into the time budget (seconds)
+    out_of_time is also checked on every training batch, so a long epoch is cut
+    once the budget is spent. Validation and the checkpoint of that epoch still
+    run, the budget can be overrun by their time
+    Under DDP every process gets the decision of rank 0
+    """
+    def __init__(self,
+                 patience=0,
+                 min_delta=1e-3,
+                 time_budget=0,
+                 scheduler=None,
+                 device=None,
+                 sync_every=20):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.time_budget = time_budget
+        self.scheduler = scheduler
+        self.device = device
+        self.sync_every = sync_every
+        self.start = time.time()
+        self.epoch_start = self.start
+        self.longest_epoch = 0
+        self.best_loss = float('inf')
+        self.bad_epochs = 0
+        self.min_lr_bad_epochs = 0
+        self.epochs = 0
+        self.reason = ''
+        self.out_of_budget = False
+
+    def out_of_time(self, step):
+        """
+        True once the time budget is spent, called with the batch index
+        Under DDP rank 0 decides every sync_every batches, so that all the
+        processes leave the epoch after the same batch
+        """
+        if not self.time_budget or self.out_of_budget:
+            return self.out_of_budget
+        if is_distributed():
+            if step % self.sync_every:
+                return False
+            stop = torch.tensor([1 if time.time() - self.start > self.time_budget else 0], device=self.device)
+            dist.broadcast(stop, 0)
+            self.out_of_budget = bool(stop.item())
+        else:
+            self.out_of_budget = time.time() - self.start > self.time_budget
+        if self.out_of_budget:
+            print(' * Time budget of {:.0f}s spent, cutting the epoch after batch {}'.format(self.time_budget, step))
+        return self.out_of_budget
+
+    def at_min_lr(self):
+        scheduler = self.scheduler
+        return scheduler is not None and all(group['lr'] <= min_lr + 1e-12
+                                             for group, min_lr in zip(scheduler.optimizer.param_groups,
+                                                                      scheduler.min_lrs))
+
+    def step(self, val_loss):
+        """Record the epoch, return True if training should stop, the reason is in self.reason"""
+        now = time.time()
+        self.longest_epoch = max(self.longest_epoch, now - self.epoch_start)
+        self.epoch_start = now
+        self.epochs += 1
+
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        # the scheduler resets its own count even when it can not lower the lr any more
+        if self.at_min_lr() and self.bad_epochs:
+            self.min_lr_bad_epochs += 1
+        else:
+            self.min_lr_bad_epochs = 0
+
+        reason = ''
+        if self.patience and self.bad_epochs >= self.patience:
+            reason = 'no val loss improvement for {} epochs'.format(self.bad_epochs)
+        elif self.scheduler is not None and self.min_lr_bad_epochs > self.scheduler.patience:
+            reason = 'val loss plateau at the min lr'
+        elif self.out_of_budget or (self.time_budget and now - self.start + self.longest_epoch > self.time_budget):
+            reason = 'time budget of {:.0f}s spent ({:.0f}s)'.format(self.time_budget, now - self.start)
+
+        if is_distributed():
+            stop = torch.tensor([1 if reason else 0], device=self.device)
+            dist.broadcast(stop, 0)
+            if stop.item() and not reason:
+                reason = 'stopped by rank 0'
+            elif not stop.item():
+                reason = ''
+        self.reason = reason
+        if reason:
+            print(' * Stopping after {} epochs: {}'.format(self.epochs, reason))
+        return bool(reason)
@@ -6,6 +6,7 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torchvision import models
 from torch.nn import functional as F
+from PretrainedWeights import load_pretrained
 
 def conv3x3(in_, out):
     return nn.Conv2d(in_, out, 3, padding=1)
@@ -63,10 +64,13 @@ class DecoderBlock(nn.Module):
         return self.block(x)      
     
 class UNet11(nn.Module):
-    def __init__(self, num_classes=1, num_filters=32, num_channels=3):
+    def __init__(self, num_classes=1, num_filters=32, num_channels=3, pretrained=True):
         super().__init__()
         self.pool = nn.MaxPool2d(2, 2)
-        encoder = models.vgg11(pretrained=True).features
+        encoder = models.vgg11()
+        if pretrained:
+            load_pretrained(encoder, 'vgg11')
+        encoder = encoder.features
         self.relu = encoder[1]
         
         # try to use 8-channels as first input
@@ -0,0 +1,69 @@
+import argparse
+import time
+
+import torch
+
+from InferenceUtils import get_model,eight_channel_presets
+from ActivationCheckpoint import checkpoint_activations,saved_activation_meter
+
+parser = argparse.ArgumentParser(description='Memory and step time with and without activation checkpointing')
+parser.add_argument('--archs', default='linknet34,linknet50,linknet50_full,linknext,unet11', type=str,
+                    metavar='ARCHS', help='comma separated architectures')
+parser.add_argument('--preset', '-pres', default='mul_ps_vegetation', type=str,
+                    metavar='PS', help='preset for satellite channels')
+parser.add_argument('-im', '--imsize', default=320, type=int, metavar='N',
+                    help='image size')
+parser.add_argument('-b', '--batch-size', default=2, type=int, metavar='N',
+                    help='mini-batch size (default: 2)')
+parser.add_argument('--repeats', default=3, type=int, metavar='N',
+                    help='timed steps per setting (default: 3)')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda or cpu (default: cuda)')
+
+args = parser.parse_args()
+
+print(args)
+
+def train_step(model, input, optimizer):
+    optimizer.zero_grad()
+    with saved_activation_meter() as saved:
+        # the loss does not matter for memory and time, unet11 returns logits
+        loss = model(input).mean()
+    loss.backward()
+    optimizer.step()
+    return saved['bytes']
+
+def measure(arch, checkpointed, device):
+    model = get_model(arch, args.preset, pretrained=False)
+    if checkpointed:
+        checkpoint_activations(model)
+    model = model.to(device).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    num_channels = 3 if arch.startswith('linknext') or args.preset not in eight_channel_presets else 8
+    input = torch.randn(args.batch_size, num_channels, args.imsize, args.imsize).to(device)
+
+    train_step(model, input, optimizer)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(args.repeats):
+        saved = train_step(model, input, optimizer)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / args.repeats
+    peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else None
+    return saved, peak, elapsed
+
+def main():
+    device = torch.device(args.device)
+    for arch in args.archs.split(','):
+        for checkpointed in [False, True]:
+            saved, peak, elapsed = measure(arch, checkpointed, device)
+            print(' * {:<15} checkpointing {:<3}: saved activations {:8.1f} MB{}, {:.3f}s per step'
+                  .format(arch, 'on' if checkpointed else 'off', saved / 2**20,
+                          ', peak {:8.1f} MB'.format(peak / 2**20) if peak is not None else '',
+                          elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import torch
+
+from DilatedResnet import GapNet18,GapNetImg18
+from Loss import TDiceLoss
+
+parser = argparse.ArgumentParser(description='Step time of the GapNets with and without encoder batching')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='gapnetimg18',
+                    help='gapnet18 or gapnetimg18 (default: gapnetimg18)')
+parser.add_argument('--num-channels', default=1, type=int, metavar='N',
+                    help='channels of the shared encoder inputs (default: 1, as in train_gapnet.py)')
+parser.add_argument('-im', '--imsize', default=320, type=int, metavar='N',
+                    help='image size')
+parser.add_argument('-b', '--batch-size', default=4, type=int, metavar='N',
+                    help='mini-batch size (default: 4)')
+parser.add_argument('--repeats', default=5, type=int, metavar='N',
+                    help='timed steps per mode (default: 5)')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda or cpu (default: cuda)')
+
+args = parser.parse_args()
+
+print(args)
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def step_time(model, inputs, target, device, train):
+    criterion = TDiceLoss().to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train(train)
+
+    def step():
+        if train:
+            optimizer.zero_grad()
+            loss = criterion(model(*inputs), target)
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(*inputs)
+
+    step()
+    synchronize(device)
+    start = time.time()
+    for _ in range(args.repeats):
+        step()
+    synchronize(device)
+    return (time.time() - start) / args.repeats
+
+def main():
+    device = torch.device(args.device)
+    if args.arch.startswith('gapnetimg18'):
+        model = GapNetImg18(num_classes=1, num_channels=args.num_channels)
+        channels = [3, args.num_channels, args.num_channels]
+    elif args.arch.startswith('gapnet18'):
+        model = GapNet18(num_classes=1, num_channels=args.num_channels)
+        channels = [args.num_channels, args.num_channels]
+    else:
+        raise ValueError('Model not supported')
+    model = model.to(device)
+    inputs = [torch.randn(args.batch_size, c, args.imsize, args.imsize).to(device) for c in channels]
+    target = torch.rand(args.batch_size, 1, args.imsize, args.imsize).round().to(device)
+
+    for train in [False, True]:
+        times = {}
+        for mode in ['never', 'always']:
+            model.batch_encoder = mode
+            times[mode] = step_time(model, inputs, target, device, train)
+        print(' * {:<9}: sequential encoder {:.3f}s, batched encoder {:.3f}s per step, x{:.2f}'
+              .format('train' if train else 'inference', times['never'], times['always'],
+                      times['never'] / times['always']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+
+from GraphUtils import segmets_to_linestrings
+
+parser = argparse.ArgumentParser(description='WKT serialization time of the per vertex loop and of the stacked formatting')
+parser.add_argument('--segments', default=30000, type=int, metavar='N',
+                    help='segments per mask (default: 30000)')
+parser.add_argument('--vertices', default='2,3,6,12', type=str, metavar='V',
+                    help='comma separated vertex counts per segment (default: 2,3,6,12)')
+parser.add_argument('--repeats', default=5, type=int, metavar='N',
+                    help='timed runs per setting, the best one is reported (default: 5)')
+parser.add_argument('-s', '--seed', default=42, type=int, metavar='N',
+                    help='seed of the random segments (default: 42)')
+
+args = parser.parse_args()
+
+print(args)
+
+def loop_linestring(segment):
+    """The per vertex serializer the stacked formatting replaced"""
+    if len(segment) < 2:
+        return []
+    sublinestring = ''
+    for i, node in enumerate(segment):
+        if i == 0:
+            sublinestring = sublinestring + '{:.1f} {:.1f}'.format(node[1], node[0])
+        else:
+            if node[0] == segment[i - 1][0] and node[1] == segment[i - 1][1]:
+                if len(segment) == 2:
+                    return []
+                continue
+            if i > 1 and node[0] == segment[i - 2][0] and node[1] == segment[i - 2][1]:
+                continue
+            sublinestring = sublinestring + ', {:.1f} {:.1f}'.format(node[1], node[0])
+    return 'LINESTRING ({})'.format(sublinestring)
+
+def loop_linestrings(segments):
+    linestrings = [linestring for linestring in map(loop_linestring, segments) if len(linestring) > 0]
+    return linestrings or ['LINESTRING EMPTY']
+
+def random_segments(count, vertices, rng):
+    """sknw int16 pixel coordinates, with repeated vertices as simplify_graph leaves them"""
+    segments = rng.randint(0, 1300, (count, vertices, 2)).astype(np.int16)
+    segments[::7, 1] = segments[::7, 0]
+    if vertices > 2:
+        segments[::11, 2] = segments[::11, 0]
+    return list(segments)
+
+def best_time(function, segments):
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        function(segments)
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    rng = np.random.RandomState(args.seed)
+    for vertices in [int(v) for v in args.vertices.split(',')]:
+        segments = random_segments(args.segments, vertices, rng)
+        if segmets_to_linestrings(segments) != loop_linestrings(segments):
+            raise ValueError('Stacked formatting differs from the per vertex loop')
+        loop_time = best_time(loop_linestrings, segments)
+        stacked_time = best_time(segmets_to_linestrings, segments)
+        print(' * {} segments of {:2d} vertices: loop {:.3f}s, stacked {:.3f}s, x{:.2f}'
+              .format(args.segments, vertices, loop_time, stacked_time, loop_time / stacked_time))
+
+if __name__ == '__main__':
+    main()
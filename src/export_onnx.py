@@ -0,0 +1,52 @@
+import argparse
+
+import torch
+
+from InferenceUtils import get_model,load_checkpoint,eight_channel_presets
+from OnnxUtils import export_onnx,OnnxModel,check_parity,compare_throughput
+
+parser = argparse.ArgumentParser(description='Export a trained checkpoint to ONNX')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='linknet34',
+                    help='model architecture: linknet34, linknet50, linknet50_full or unet11')
+parser.add_argument('--preset', '-pres', default='mul_ps_vegetation', type=str,
+                    metavar='PS', help='preset for satellite channels')
+parser.add_argument('--resume', required=True, type=str, metavar='PATH',
+                    help='path to the model checkpoint')
+parser.add_argument('--output', '-o', required=True, type=str, metavar='PATH',
+                    help='resulting .onnx file')
+parser.add_argument('--opset', default=17, type=int, metavar='N',
+                    help='ONNX opset version (default: 17)')
+parser.add_argument('--check-size', default=512, type=int, metavar='N',
+                    help='spatial size of the parity / throughput input (default: 512)')
+parser.add_argument('-b', '--batch-size', default=2, type=int, metavar='N',
+                    help='batch size of the parity / throughput input (default: 2)')
+parser.add_argument('--atol', default=1e-4, type=float, metavar='TOL',
+                    help='max abs difference allowed between PyTorch and ONNX (default: 1e-4)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='CPU threads for both runtimes, 0 keeps the defaults')
+
+args = parser.parse_args()
+
+print(args)
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    num_channels = 8 if args.preset in eight_channel_presets else 3
+    model = get_model(args.arch, args.preset, pretrained=False)
+    checkpoint = load_checkpoint(model, args.resume)
+    print("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
+    model.eval()
+
+    export_onnx(model, args.output, num_channels=num_channels, opset=args.opset)
+    print('ONNX model saved to {}'.format(args.output))
+
+    # a different batch and size than the export input checks the dynamic axes
+    onnx_model = OnnxModel(args.output, threads=args.threads)
+    input = torch.randn(args.batch_size, num_channels, args.check_size, args.check_size)
+    check_parity(model, onnx_model, input, atol=args.atol)
+    compare_throughput(model, onnx_model, input)
+
+if __name__ == '__main__':
+    main()
@@ -12,17 +12,35 @@ import cv2
 from collections import Counter
 from skimage.draw import circle
 import os
+import time
 import argparse
+from multiprocessing import Pool
+from GraphUtils import mask_to_graph,simplify_graph,segmets_to_linestrings
+from PredictionWriter import write_formats,read_prediction
 
 parser = argparse.ArgumentParser(description='Masks into linestrings')
 
 parser.add_argument('--folder', '-fld', default='norm_ln34_mul_ps_vegetation_aug_dice_predict', type=str,
                     metavar='FLD', help='masks containing folder name')
 
+parser.add_argument('--workers', '-j', default=1, type=int,
+                    metavar='N', help='number of graph extraction processes (default: 1)')
+
+parser.add_argument('--fast-skeleton', action='store_true',
+                    help='use the fused numba threshold + thinning kernel')
+
+parser.add_argument('--downsample', default=1, type=int,
+                    metavar='N', help='skeletonize at 1/N resolution (default: 1)')
+
+parser.add_argument('--wkb', action='store_true',
+                    help='write hex encoded WKB_Pix instead of WKT_Pix')
+
 parser.add_argument('--params', nargs = '*', dest = 'params', help = 'topcoder args', default = argparse.SUPPRESS)
 
 args = parser.parse_args()
 
+geometry_column = 'WKB_Pix' if args.wkb else 'WKT_Pix'
+
 param_list = args.params
 param_list =[(directory.replace('data/','wdata/')) for directory in param_list]
 
@@ -49,7 +67,9 @@ for test_folder in test_folders1:
     for mask_folder_test in mask_folders2_test_pad:
         local = pd.DataFrame()
         mask_folder_test_path = os.path.join(root, test_folder, mask_folder_test)
-        local['mask_img'] = glob.glob('{}/*.jpg'.format(mask_folder_test_path))
+        # any format the PredictionWriter of the predict scripts writes
+        local['mask_img'] = sorted(path for fmt in write_formats
+                                   for path in glob.glob('{}/*.{}'.format(mask_folder_test_path, fmt)))
         local['mask_folder_test'] = mask_folder_test
         local['test_folder'] = test_folder
         globdf_masks_test_pad = pd.concat([globdf_masks_test_pad, local],ignore_index = True)
@@ -60,124 +80,53 @@ globdf_masks_test_pad['img_id'] = globdf_masks_test_pad['mask_name'].apply(lambd
 
 globdf_test_pad = globdf_masks_test_pad
 
-# functions
-def simplify_edge(ps: np.ndarray, max_distance=3):
-    """
-    Combine multiple points of graph edges to line segments
-    so distance from points to segments <= max_distance
-    :param ps: array of points in the edge, including node coordinates
-    :param max_distance: maximum distance, if exceeded new segment started
-    :return: ndarray of new nodes coordinates
-    """
-    res_points = []
-    cur_idx = 0
-    # combine points to the single line while distance from the line to any point < max_distance
-    for i in range(1, len(ps) - 1):
-        segment = ps[cur_idx:i + 1, :] - ps[cur_idx, :]
-        angle = -math.atan2(segment[-1, 1], segment[-1, 0])
-        ca = math.cos(angle)
-        sa = math.sin(angle)
-        # rotate all the points so line is alongside first column coordinate
-        # and the second col coordinate means the distance to the line
-        segment_rotated = np.array([[ca, -sa], [sa, ca]]).dot(segment.T)
-        distance = np.max(np.abs(segment_rotated[1, :]))
-        if distance > max_distance:
-            res_points.append(ps[cur_idx, :])
-            cur_idx = i
-    if len(res_points) == 0:
-        res_points.append(ps[0, :])
-    res_points.append(ps[-1, :])
-
-    return np.array(res_points)
-
-def simplify_graph(graph, max_distance=2):
-    """
-    :type graph: MultiGraph
-    """
-    all_segments = []
-    for (s, e) in graph.edges():
-        for _, val in graph[s][e].items():
-            ps = val['pts']
-            full_segments = np.row_stack([
-                graph.node[s]['o'],
-                ps,
-                graph.node[e]['o']
-            ])
-
-            segments = simplify_edge(full_segments, max_distance=max_distance)
-            all_segments.append(segments)
-
-    return all_segments
-
-def segment_to_linestring(segment):
-    
-    if len(segment) < 2:
-        return []
-    
-    linestring = 'LINESTRING ({})'
-    sublinestring = ''
-        
-    for i, node in enumerate(segment):
-        
-        if i == 0:
-            sublinestring = sublinestring + '{:.1f} {:.1f}'.format(node[1], node[0])
-        else:
-            if node[0] == segment[i - 1][0] and node[1] == segment[i - 1][1]:
-                if len(segment) == 2:
-                    return []
-                continue
-            if i > 1 and node[0] == segment[i - 2][0] and node[1] == segment[i - 2][1]:
-                continue
-            sublinestring = sublinestring + ', {:.1f} {:.1f}'.format(node[1], node[0])
-    linestring = linestring.format(sublinestring)
-    return linestring
-
-def segmets_to_linestrings(segments):
-    linestrings = []
-    for segment in segments:
-        linestring = segment_to_linestring(segment)
-        if len(linestring) > 0:
-            linestrings.append(linestring)
-    if len(linestrings) == 0:
-        linestrings = ['LINESTRING EMPTY']
-    return linestrings
-
-def process_masks(mask_paths):
-    lnstr_df = pd.DataFrame()
-    with tqdm(total=len(mask_paths)) as pbar:
-        for msk_pth in mask_paths:
-            #print(msk_pth)
-            msk = imread(msk_pth)
-            msk = msk[6:1306, 6:1306]
-            msk_nme = msk_pth.split('/')[-1]
-            img_id = msk_nme[msk_nme.find('AOI'):msk_nme.find('.')]
-
-            # open and skeletonize
-            thresh = 30
-            binary = (msk > thresh)*1
-            
-            ske = skeletonize(binary).astype(np.uint16)
-
-            # build graph from skeleton
-            graph = sknw.build_sknw(ske, multi=True)
-            segments = simplify_graph(graph)
-
-            linestrings = segmets_to_linestrings(segments)
-            local = pd.DataFrame()
-            local['WKT_Pix'] = linestrings
-            local['ImageId'] = img_id
-
-            lnstr_df = pd.concat([lnstr_df, local], ignore_index = True)
-            pbar.update(1)
-    return lnstr_df
+def process_mask(msk_pth):
+    # padded predict output, anything else fails here instead of giving empty graphs
+    msk = read_prediction(msk_pth, shape=(1312, 1312))
+    msk = msk[6:1306, 6:1306]
+    msk_nme = msk_pth.split('/')[-1]
+    img_id = msk_nme[msk_nme.find('AOI'):msk_nme.find('.')]
+
+    # open, skeletonize and build graph from skeleton
+    graph = mask_to_graph(msk, thresh=30,
+                          fast=args.fast_skeleton,
+                          factor=args.downsample)
+    segments = simplify_graph(graph)
+
+    local = pd.DataFrame()
+    if args.wkb:
+        local['WKB_Pix'] = [linestring.hex() for linestring in segmets_to_linestrings(segments, wkb=True)]
+    else:
+        local['WKT_Pix'] = segmets_to_linestrings(segments)
+    local['ImageId'] = img_id
+    return local
+
+def init_worker():
+    # load the cached sknw kernels once per process, not on the first mask
+    warmup_time = sknw.warmup()
+    print('Worker {} ready, sknw warmup took {:.3f}s'.format(os.getpid(), warmup_time))
+
+def process_masks(mask_paths, workers=1):
+    start = time.time()
+    if workers > 1:
+        with Pool(workers, initializer=init_worker) as p:
+            local_dfs = list(tqdm(p.imap(process_mask, mask_paths),
+                                total=len(mask_paths)))
+    else:
+        init_worker()
+        local_dfs = [process_mask(msk_pth) for msk_pth in tqdm(mask_paths)]
+    print('Processed {} masks in {:.1f}s'.format(len(mask_paths), time.time() - start))
+    if len(local_dfs) == 0:
+        return pd.DataFrame(columns=[geometry_column, 'ImageId'])
+    return pd.concat(local_dfs, ignore_index = True)
 
 # calculating result
 print('Processing masks into linestrings...')
 
 globdf_test_narrow_vegetation = globdf_test_pad[globdf_test_pad['mask_folder_test'] == args.folder].copy()
-lstrs_test = process_masks(globdf_test_narrow_vegetation.mask_img)
+lstrs_test = process_masks(list(globdf_test_narrow_vegetation.mask_img), args.workers)
 
-lstrs_test = lstrs_test[['ImageId', 'WKT_Pix']].copy()
+lstrs_test = lstrs_test[['ImageId', geometry_column]].copy()
 lstrs_test = lstrs_test.drop_duplicates()
 #os.makedirs('../solutions', exist_ok=True)
 lstrs_test.to_csv('../{}.txt'.format(log_file), index = False)
@@ -0,0 +1,127 @@
+import pandas as pd
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from tqdm import tqdm
+import os
+import time
+import argparse
+from multiprocessing import Pool
+import sknw
+from GraphUtils import mask_to_graph,offset_graph,seam_nodes,split_seam_edges,TileGraphMerger,simplify_graph,segmets_to_linestrings
+
+parser = argparse.ArgumentParser(description='Large area predicted mask mosaic into linestrings')
+
+parser.add_argument('--mosaic', '-m', type=str, required=True,
+                    metavar='PATH', help='georeferenced mask mosaic or VRT (first band is used)')
+parser.add_argument('--output', '-o', type=str, required=True,
+                    metavar='PATH', help='resulting csv file')
+parser.add_argument('--aoi', default=None, type=str,
+                    metavar='AOI', help='ImageId to write, defaults to the mosaic file name')
+parser.add_argument('--tile-size', default=1300, type=int,
+                    metavar='N', help='tile size in pixels (default: 1300)')
+parser.add_argument('--halo', default=64, type=int,
+                    metavar='N', help='overlap read around each tile before skeletonization (default: 64)')
+parser.add_argument('--thresh', default=30, type=float,
+                    metavar='T', help='mask binarization threshold (default: 30)')
+parser.add_argument('--seam-tolerance', default=2, type=float,
+                    metavar='D', help='max distance to join road ends across tile seams (default: 2)')
+parser.add_argument('--fast-skeleton', action='store_true',
+                    help='use the fused numba threshold + thinning kernel')
+parser.add_argument('--workers', '-j', default=4, type=int,
+                    metavar='N', help='number of graph extraction processes (default: 4)')
+parser.add_argument('--geo', action='store_true',
+                    help='also write WKT_Geo using the mosaic transform')
+
+args = parser.parse_args()
+
+# one open dataset per worker process
+dataset = None
+
+def init_worker(mosaic_path):
+    global dataset
+    dataset = rasterio.open(mosaic_path)
+    sknw.warmup()
+
+def tile_windows(height, width, tile_size):
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield (row_off,
+                   col_off,
+                   min(tile_size, height - row_off),
+                   min(tile_size, width - col_off))
+
+def process_tile(core):
+    # read the tile together with its halo, clipped to the mosaic
+    row_off, col_off, height, width = core
+    row_start = max(0, row_off - args.halo)
+    col_start = max(0, col_off - args.halo)
+    row_stop = min(dataset.height, row_off + height + args.halo)
+    col_stop = min(dataset.width, col_off + width + args.halo)
+    msk = dataset.read(1, window=Window(col_start, row_start,
+                                        col_stop - col_start, row_stop - row_start))
+
+    # skeletonize with context, keep only the core of the tile
+    graph = mask_to_graph(msk, thresh=args.thresh,
+                          crop=(row_off - row_start, col_off - col_start, height, width),
+                          fast=args.fast_skeleton)
+    graph = offset_graph(graph, row_off, col_off)
+    seams = seam_nodes(graph, core, (dataset.height, dataset.width))
+
+    # only the edges of the cut road ends go back to be stitched, the others are final
+    interior, graph = split_seam_edges(graph, seams)
+    return graph_linestrings(interior), graph, seams
+
+def graph_linestrings(graph):
+    return [linestring for linestring in segmets_to_linestrings(simplify_graph(graph))
+            if linestring != 'LINESTRING EMPTY']
+
+def pix_to_geo(linestring, transform):
+    if linestring == 'LINESTRING EMPTY':
+        return linestring
+    coords = linestring[len('LINESTRING ('):-1].split(', ')
+    geo_coords = []
+    for coord in coords:
+        x, y = [float(_) for _ in coord.split(' ')]
+        geo_x, geo_y = transform * (x, y)
+        geo_coords.append('{} {}'.format(geo_x, geo_y))
+    return 'LINESTRING ({})'.format(', '.join(geo_coords))
+
+start = time.time()
+
+with rasterio.open(args.mosaic) as src:
+    height, width = src.height, src.width
+    transform = src.transform
+
+cores = list(tile_windows(height, width, args.tile_size))
+print('Processing {}x{} mosaic as {} tiles...'.format(width, height, len(cores)))
+
+aoi = args.aoi or os.path.splitext(os.path.basename(args.mosaic))[0]
+columns = ['ImageId', 'WKT_Pix'] + (['WKT_Geo'] if args.geo else [])
+
+def write_linestrings(out, linestrings):
+    lstrs = pd.DataFrame()
+    lstrs['ImageId'] = [aoi] * len(linestrings)
+    lstrs['WKT_Pix'] = linestrings
+    if args.geo:
+        lstrs['WKT_Geo'] = [pix_to_geo(linestring, transform) for linestring in linestrings]
+    lstrs.to_csv(out, index = False, header = False)
+    return len(linestrings)
+
+# the rasters stay in the workers, rows are written as soon as a tile or a stitched road is done
+merger = TileGraphMerger(cores, args.tile_size, tolerance=args.seam_tolerance)
+count = 0
+with open(args.output, 'w') as out, \
+     Pool(args.workers, initializer=init_worker, initargs=(args.mosaic,)) as p:
+    out.write(','.join(columns) + '\n')
+    results = p.imap(process_tile, cores)
+    for core, (linestrings, graph, seams) in tqdm(zip(cores, results), total=len(cores)):
+        count += write_linestrings(out, linestrings)
+        for finished in merger.add(core, graph, seams):
+            count += write_linestrings(out, graph_linestrings(finished))
+    for finished in merger.close():
+        count += write_linestrings(out, graph_linestrings(finished))
+    if count == 0:
+        count = write_linestrings(out, ['LINESTRING EMPTY'])
+
+print('{} linestrings saved to {} in {:.1f}s'.format(count, args.output, time.time() - start))
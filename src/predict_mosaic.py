@@ -0,0 +1,96 @@
+import argparse
+import time
+
+import torch
+
+from presets import preset_dict
+from InferenceUtils import get_model,place_model,load_checkpoint,load_ensemble,optimize_for_inference
+from SlidingWindow import SlidingWindowPredictor
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+parser = argparse.ArgumentParser(description='Sliding window prediction of large 8-bit rasters')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='linknet34',
+                    help='model architecture')
+parser.add_argument('--preset', '-pres', default='mul_ps_vegetation', type=str,
+                    metavar='PS', help='preset for satellite channels')
+parser.add_argument('--resume', default=[], nargs='+', type=str, metavar='PATH',
+                    help='path to the model checkpoint, several checkpoints are averaged as an ensemble')
+parser.add_argument('--ensemble-threads', dest='ensemble_threads', action='store_true',
+                    help='run the ensemble models in parallel threads')
+parser.add_argument('--input', '-i', required=True, type=str, metavar='PATH',
+                    help='8-bit raster, mosaic or VRT to predict')
+parser.add_argument('--output', '-o', required=True, type=str, metavar='PATH',
+                    help='resulting probability GeoTIFF')
+parser.add_argument('--window', default=1312, type=int, metavar='N',
+                    help='window size, a multiple of 32 (default: 1312)')
+parser.add_argument('--overlap', default=256, type=int, metavar='N',
+                    help='overlap between neighbouring windows (default: 256)')
+parser.add_argument('-b', '--batch-size', default=4, type=int, metavar='N',
+                    help='windows per forward pass (default: 4)')
+parser.add_argument('--band-width', default=8192, type=int, metavar='N',
+                    help='raster columns processed at once, bounds memory use (default: 8192)')
+parser.add_argument('--blend', default='cosine', type=str, metavar='BLEND',
+                    help='overlap weighting: cosine, gaussian or mean (default: cosine)')
+parser.add_argument('--tta', default=1, type=int, metavar='N',
+                    help='number of flip / rotation TTA variants (default: 1)')
+parser.add_argument('--float', dest='as_float', default=False, type=str2bool,
+                    help='write float32 probabilities instead of 0-255 uint8')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda or cpu (default: cuda)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='intra-op CPU threads, 0 keeps the torch default')
+parser.add_argument('--channels-last', dest='channels_last', action='store_true',
+                    help='use channels last memory format')
+parser.add_argument('--optimize', dest='optimize', action='store_true',
+                    help='fold conv + bn and freeze the model with TorchScript (single device)')
+parser.add_argument('--onnx', default='', type=str, metavar='PATH',
+                    help='use an exported ONNX model on onnxruntime CPU instead of --resume')
+
+args = parser.parse_args()
+
+print(args)
+
+def main():
+    device = torch.device(args.device)
+    if device.type == 'cpu' and args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    if args.onnx:
+        from OnnxUtils import OnnxModel
+        model = OnnxModel(args.onnx, threads=args.threads)
+        print("=> loaded ONNX model '{}'".format(args.onnx))
+    elif len(args.resume) > 1:
+        model = load_ensemble(args.arch, args.preset, args.resume, device,
+                              channels_last=args.channels_last, parallel=args.ensemble_threads)
+    elif args.resume:
+        model = get_model(args.arch, args.preset, pretrained=False)
+        model = place_model(model, device, channels_last=args.channels_last)
+        checkpoint = load_checkpoint(model, args.resume[0])
+        print("=> loaded checkpoint '{}' (epoch {})".format(args.resume[0], checkpoint['epoch']))
+        model.eval()
+        if args.optimize:
+            num_channels = len(preset_dict[args.preset]['channels'])
+            model = optimize_for_inference(model, torch.randn(1, num_channels, 256, 256).to(device))
+    else:
+        raise ValueError('Either --resume or --onnx should be given')
+
+    predictor = SlidingWindowPredictor(model,
+                                       device,
+                                       window=args.window,
+                                       overlap=args.overlap,
+                                       batch_size=args.batch_size,
+                                       band_width=args.band_width,
+                                       blend=args.blend,
+                                       tta=args.tta,
+                                       channels_last=args.channels_last)
+    start = time.time()
+    predictor.predict_raster(args.input,
+                             args.output,
+                             preset_dict[args.preset]['channels'],
+                             as_float=args.as_float)
+    print('Probabilities saved to {} in {:.1f}s'.format(args.output, time.time() - start))
+
+if __name__ == '__main__':
+    main()
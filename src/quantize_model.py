@@ -0,0 +1,132 @@
+import argparse
+
+import torch
+from sklearn.model_selection import train_test_split
+
+from presets import preset_dict
+from SatellitesDataset import get_train_dataset,SatellitesDataset,FixedCropDataset
+from SatellitesAugs import SatellitesTestAugmentation
+from InferenceUtils import get_model,load_checkpoint,eight_channel_presets
+from QuantUtils import quantize_model,save_quantized,compare_metrics,time_model
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+parser = argparse.ArgumentParser(description='Post-training int8 quantization for CPU inference')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='linknet34',
+                    help='model architecture (default: linknet34)')
+parser.add_argument('--preset', '-pres', default='mul_ps_vegetation', type=str,
+                    metavar='PS', help='preset for satellite channels')
+parser.add_argument('--resume', required=True, type=str, metavar='PATH',
+                    help='path to the float model checkpoint')
+parser.add_argument('--output', '-o', required=True, type=str, metavar='PATH',
+                    help='resulting quantized checkpoint')
+parser.add_argument('--path-prefix', default='', type=str, metavar='PATH',
+                    help='prefix of the image paths in mask_df.csv, as in train_satellites.py')
+parser.add_argument('--city', '-cty', default='all', type=str,
+                    metavar='CTY', help='a city to use')
+parser.add_argument('-s', '--seed', default=42, type=int, metavar='N',
+                    help='seed for train test split, same as in training (default: 42)')
+parser.add_argument('-im', '--imsize', default=1280, type=int, metavar='N',
+                    help='image size of the calibration and validation crops (default: 1280)')
+parser.add_argument('-b', '--batch-size', default=4, type=int, metavar='N',
+                    help='mini-batch size (default: 4)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 4)')
+parser.add_argument('--calib-batches', default=16, type=int, metavar='N',
+                    help='number of training batches used for calibration (default: 16)')
+parser.add_argument('--val-batches', default=0, type=int, metavar='N',
+                    help='limit the validation batches, 0 uses the whole split')
+parser.add_argument('--backend', default='fbgemm', type=str, metavar='BE',
+                    help='quantized engine: fbgemm (x86) or qnnpack (arm)')
+parser.add_argument('--fp32-head', dest='fp32_head', default=True, type=str2bool,
+                    help='keep the final deconv / convs in fp32 (default: True)')
+parser.add_argument('--bench-size', default=1312, type=int, metavar='N',
+                    help='image size of the speed comparison (default: 1312)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='intra-op CPU threads, 0 keeps the torch default')
+
+args = parser.parse_args()
+
+print(args)
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    num_channels = 8 if args.preset in eight_channel_presets else 3
+
+    model = get_model(args.arch, args.preset, pretrained=False)
+    checkpoint = load_checkpoint(model, args.resume)
+    print("=> loaded checkpoint '{}' (epoch {})".format(args.resume, checkpoint['epoch']))
+    model.eval()
+
+    # the same split as in train_satellites.py
+    bit8_imgs,bit8_masks,cty_no = get_train_dataset(args.preset,
+                                                    preset_dict,
+                                                    city=args.city,
+                                                    path_prefix=args.path_prefix)
+    train_imgs, val_imgs, train_masks, val_masks = train_test_split(bit8_imgs,
+                                                                    bit8_masks,
+                                                                    test_size=0.25,
+                                                                    stratify=cty_no,
+                                                                    random_state=args.seed)
+    augs = SatellitesTestAugmentation(shape=args.imsize)
+    calib_dataset = SatellitesDataset(preset = preset_dict[args.preset],
+                                      image_paths = train_imgs,
+                                      mask_paths = train_masks,
+                                      transforms = augs,
+                                     )
+    val_dataset = SatellitesDataset(preset = preset_dict[args.preset],
+                                    image_paths = val_imgs,
+                                    mask_paths = val_masks,
+                                   )
+    # both models are scored on the same fixed crops
+    val_dataset = FixedCropDataset(val_dataset,
+                                   args.imsize,
+                                   SatellitesTestAugmentation(shape=args.imsize, crop=False),
+                                   seed=args.seed)
+    calib_loader = torch.utils.data.DataLoader(calib_dataset,
+                                               batch_size=args.batch_size,
+                                               shuffle=True,
+                                               num_workers=args.workers)
+    val_loader = torch.utils.data.DataLoader(val_dataset,
+                                             batch_size=args.batch_size,
+                                             shuffle=False,
+                                             num_workers=args.workers)
+
+    print('Calibrating on {} batches'.format(args.calib_batches))
+    quantized = quantize_model(model,
+                               calib_loader,
+                               num_batches=args.calib_batches,
+                               num_channels=num_channels,
+                               backend=args.backend,
+                               fp32_head=args.fp32_head)
+    save_quantized(quantized, args.output, args.arch, args.preset, args.backend, args.fp32_head)
+    print('Quantized checkpoint saved to {}'.format(args.output))
+
+    val_batches = args.val_batches or None
+    (fp32_dice, fp32_iou), (int8_dice, int8_iou), batches = compare_metrics(model,
+                                                                             quantized,
+                                                                             val_loader,
+                                                                             num_batches=val_batches)
+    for i, (batch_fp32_dice, batch_int8_dice, batch_fp32_iou, batch_int8_iou) in enumerate(batches):
+        print('Val batch {}: dice fp32 {:.4f} int8 {:.4f} drop {:.4f}, IoU fp32 {:.4f} int8 {:.4f} drop {:.4f}'
+              .format(i, batch_fp32_dice, batch_int8_dice, batch_fp32_dice - batch_int8_dice,
+                      batch_fp32_iou, batch_int8_iou, batch_fp32_iou - batch_int8_iou))
+    dice_drops = [batch[0] - batch[1] for batch in batches]
+
+    input = torch.randn(1, num_channels, args.bench_size, args.bench_size)
+    fp32_time = time_model(model, input)
+    int8_time = time_model(quantized, input)
+
+    print(' * fp32: dice {:.4f} IoU {:.4f} {:.3f}s per {}x{} image'
+          .format(fp32_dice, fp32_iou, fp32_time, args.bench_size, args.bench_size))
+    print(' * int8: dice {:.4f} IoU {:.4f} {:.3f}s per {}x{} image'
+          .format(int8_dice, int8_iou, int8_time, args.bench_size, args.bench_size))
+    print(' * dice drop {:.4f}, IoU drop {:.4f}, speedup x{:.2f}'
+          .format(fp32_dice - int8_dice, fp32_iou - int8_iou, fp32_time / int8_time))
+    print(' * per batch dice drop: mean {:.4f} max {:.4f} over {} batches'
+          .format(sum(dice_drops) / max(len(dice_drops), 1), max(dice_drops, default=0), len(dice_drops)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Train the folds of train_satellites_folds.py as parallel processes',
+                                 epilog='arguments after -- are passed to train_satellites_folds.py, '
+                                        'e.g. -- --arch linknet34 --preset mul_ps_vegetation --epochs 40')
+parser.add_argument('--folds', default='0,1,2', type=str, metavar='FOLDS',
+                    help='comma separated folds to train (default: 0,1,2)')
+parser.add_argument('--parallel', default=0, type=int, metavar='N',
+                    help='folds running at the same time, 0 runs all of them at once')
+parser.add_argument('--gpus', default='', type=str, metavar='GPUS',
+                    help='comma separated GPU ids assigned round robin to the folds, empty trains on CPU')
+parser.add_argument('--threads-per-fold', default=0, type=int, metavar='N',
+                    help='CPU threads of every fold, 0 splits the cores evenly')
+parser.add_argument('--decoded-cache', default='', type=str, metavar='DIR',
+                    help='decode the images once into DIR and share them read-only between the folds')
+parser.add_argument('--summary', default='fold_summary.json', type=str, metavar='PATH',
+                    help='resulting summary of all the folds (default: fold_summary.json)')
+parser.add_argument('--log-dir', default='fold_logs', type=str, metavar='DIR',
+                    help='stdout / stderr of every fold and the per fold summaries (default: fold_logs)')
+parser.add_argument('train_args', nargs=argparse.REMAINDER,
+                    help='arguments of train_satellites_folds.py')
+
+args = parser.parse_args()
+
+print(args)
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_satellites_folds.py')
+
+def fold_command(fold, train_args, device_args, summary_path):
+    command = [sys.executable, script] + train_args + device_args
+    command += ['--folds', str(fold), '--summary', summary_path]
+    if args.decoded_cache:
+        command += ['--decoded-cache', args.decoded_cache]
+    return command
+
+def main():
+    train_args = [arg for arg in args.train_args if arg != '--']
+    folds = [int(fold) for fold in args.folds.split(',')]
+    parallel = args.parallel or len(folds)
+    gpus = [gpu for gpu in args.gpus.split(',') if gpu]
+    threads = args.threads_per_fold or max(os.cpu_count() // parallel, 1)
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    # the folds only read the decoded cache, it is built once beforehand
+    if args.decoded_cache:
+        subprocess.check_call([sys.executable, script] + train_args +
+                              ['--decoded-cache', args.decoded_cache, '--build-cache-only'])
+
+    start = time.time()
+    pending = list(folds)
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < parallel:
+            fold = pending.pop(0)
+            env = os.environ.copy()
+            if gpus:
+                env['CUDA_VISIBLE_DEVICES'] = gpus[fold % len(gpus)]
+                device_args = ['--device', 'cuda']
+            else:
+                env['OMP_NUM_THREADS'] = str(threads)
+                device_args = ['--device', 'cpu', '--threads', str(threads)]
+            summary_path = os.path.join(args.log_dir, 'fold{}.json'.format(fold))
+            log = open(os.path.join(args.log_dir, 'fold{}.log'.format(fold)), 'w')
+            process = subprocess.Popen(fold_command(fold, train_args, device_args, summary_path),
+                                       stdout=log, stderr=subprocess.STDOUT, env=env)
+            running[fold] = (process, log)
+            print('Fold {} started on {}'.format(fold, 'GPU ' + env['CUDA_VISIBLE_DEVICES'] if gpus
+                                                 else '{} CPU threads'.format(threads)))
+        time.sleep(1)
+        for fold, (process, log) in list(running.items()):
+            if process.poll() is not None:
+                log.close()
+                del running[fold]
+                print('Fold {} finished with code {}'.format(fold, process.returncode))
+                if process.returncode != 0:
+                    failed.append(fold)
+
+    summary = {'folds': {}, 'failed': failed, 'wall_seconds': time.time() - start}
+    for fold in folds:
+        summary_path = os.path.join(args.log_dir, 'fold{}.json'.format(fold))
+        if os.path.isfile(summary_path):
+            with open(summary_path) as f:
+                summary['folds'].update(json.load(f))
+    losses = [fold['best_val_loss'] for fold in summary['folds'].values()]
+    if losses:
+        summary['mean_best_val_loss'] = sum(losses) / len(losses)
+    fold_seconds = sum(fold['seconds'] for fold in summary['folds'].values())
+    with open(args.summary, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for fold, result in sorted(summary['folds'].items()):
+        print(' * Fold {}: best val loss {:.4f} at epoch {}, {:.0f}s, {}'
+              .format(fold, result['best_val_loss'], result['best_epoch'],
+                      result['seconds'], result['best_checkpoint']))
+    print(' * Wall clock {:.0f}s for {:.0f}s of fold training, summary saved to {}'
+          .format(summary['wall_seconds'], fold_seconds, args.summary))
+    if failed:
+        raise ValueError('Folds {} failed, see {}'.format(failed, args.log_dir))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
+import time
 import numpy as np
-from numba import jit
+from numba import njit, types
 import networkx as nx
 
 # author https://github.com/yxdragon/sknw/blob/master/sknw/sknw.py
 
+# kernels are compiled in nopython mode and cached on disk (__pycache__),
+# so every process after the first one loads machine code instead of re-jitting
+
 # get neighbors d index
 def neighbors(shape):
     dim = len(shape)
@@ -13,12 +17,14 @@ def neighbors(shape):
     idx = np.array(idx, dtype=np.uint8).T
     idx = np.array(idx-[1]*dim)
     acc = np.cumprod((1,)+shape[::-1][:-1])
-    return np.dot(idx, acc[::-1])
+    return np.ascontiguousarray(np.dot(idx, acc[::-1]), dtype=np.int64)
 
-@jit # my mark
-def mark(img): # mark the array use (0, 1, 2)
-    nbs = neighbors(img.shape)
-    img = img.ravel()
+# strides of the raveled buffer, used to trans index to r, c...
+def strides(shape):
+    return np.ascontiguousarray(np.cumprod((1,)+shape[::-1][:-1])[::-1], dtype=np.int64)
+
+@njit(types.void(types.uint16[:], types.int64[:]), cache=True) # my mark
+def mark(img, nbs): # mark the raveled array use (0, 1, 2)
     for p in range(len(img)):
         if img[p]==0:continue
         s = 0
@@ -27,7 +33,7 @@ def mark(img): # mark the array use (0, 1, 2)
         if s==2:img[p]=1
         else:img[p]=2
 
-@jit # trans index to r, c...
+@njit(types.int16[:, :](types.int64[:], types.int64[:]), cache=True) # trans index to r, c...
 def idx2rc(idx, acc):
     rst = np.zeros((len(idx), len(acc)), dtype=np.int16)
     for i in range(len(idx)):
@@ -37,7 +43,9 @@ def idx2rc(idx, acc):
     rst -= 1
     return rst
     
-@jit # fill a node (may be two or more points)
+@njit(types.int16[:, :](types.uint16[:], types.int64, types.int64,
+                        types.int64[:], types.int64[:], types.int64[:]),
+      cache=True) # fill a node (may be two or more points)
 def fill(img, p, num, nbs, acc, buf):
     back = img[p]
     img[p] = num
@@ -56,7 +64,9 @@ def fill(img, p, num, nbs, acc, buf):
         if cur==s:break
     return idx2rc(buf[:s], acc)
 
-@jit # trace the edge and use a buffer, then buf.copy, if use [] numba not works
+@njit(types.Tuple((types.int64, types.int64, types.int16[:, :]))(
+          types.uint16[:], types.int64, types.int64[:], types.int64[:], types.int64[:]),
+      cache=True) # trace the edge and use a buffer, then buf.copy, if use [] numba not works
 def trace(img, p, nbs, acc, buf):
     c1 = 0; c2 = 0;
     newp = 0
@@ -69,20 +79,17 @@ def trace(img, p, nbs, acc, buf):
         for dp in nbs:
             cp = p + dp
             if img[cp] >= 10:
-                if c1==0:c1=img[cp]
-                else: c2 = img[cp]
+                if c1==0:c1=np.int64(img[cp])
+                else: c2 = np.int64(img[cp])
             if img[cp] == 1:
                 newp = cp
         p = newp
         if c2!=0:break
     return (c1-10, c2-10, idx2rc(buf[:cur], acc))
    
-@jit # parse the image then get the nodes and edges
-def parse_struc(img):
-    nbs = neighbors(img.shape)
-    acc = np.cumprod((1,)+img.shape[::-1][:-1])[::-1]
-    img = img.ravel()
-    pts = np.array(np.where(img==2))[0]
+@njit(cache=True) # parse the raveled image then get the nodes and edges
+def parse_struc(img, nbs, acc):
+    pts = np.where(img==2)[0]
     buf = np.zeros(131072, dtype=np.int64)
     num = 10
     nodes = []
@@ -116,10 +123,26 @@ def buffer(ske):
     return buf
 
 def build_sknw(ske, multi=False):
-    buf = buffer(ske)
-    mark(buf)
-    nodes, edges = parse_struc(buf)
+    return build_sknw_buffer(buffer(ske), multi)
+
+# same as build_sknw for a skeleton that already has the 1 pixel zero border
+def build_sknw_buffer(buf, multi=False):
+    nbs = neighbors(buf.shape)
+    acc = strides(buf.shape)
+    img = buf.ravel()
+    mark(img, nbs)
+    nodes, edges = parse_struc(img, nbs, acc)
     return build_graph(nodes, edges, multi)
+
+# compile / load from cache all the kernels for 2d skeletons
+# meant to be used as a process pool initializer, returns the time spent
+def warmup():
+    start = time.time()
+    ske = np.zeros((8, 8), dtype=np.uint16)
+    ske[1:7, 4] = 1
+    ske[4, 1:7] = 1
+    build_sknw(ske, multi=True)
+    return time.time() - start
     
 # draw the graph
 def draw_graph(img, graph, cn=255, ce=128):
@@ -1,6 +1,3 @@
-# Custom tensorboard logging
-from TbLogger import Logger
-
 import argparse
 import os
 import shutil
@@ -26,9 +23,13 @@ from sklearn.model_selection import train_test_split
 # custom classes
 from UNet import UNet11
 from DilatedResnet import GapNet18,GapNetImg18
+from InferenceUtils import place_model,load_checkpoint
 from Loss import BCEDiceLoss,TDiceLoss,DiceLoss
 from presets import preset_dict
 from SatellitesDataset import get_train_dataset_mul_ps_preds, SatellitesDatasetRefine
+from CheckpointWriter import CheckpointWriter
+from TrainController import TrainController,parse_duration
+from MetricUtils import SegmentationMeter
 from SatellitesAugs import SatellitesTrainAugmentation,SatellitesTestAugmentation
 from presets import preset_dict
 
@@ -42,6 +43,14 @@ parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
 parser.add_argument('--epochs', default=20, type=int, metavar='N',
                     help='number of total epochs to run')
+parser.add_argument('--patience', default=0, type=int, metavar='N',
+                    help='stop after N epochs without a val loss improvement, 0 disables early stopping')
+parser.add_argument('--min-delta', default=1e-3, type=float, metavar='D',
+                    help='smallest val loss decrease counted as an improvement (default: 1e-3)')
+parser.add_argument('--time-budget', default='', type=str, metavar='T',
+                    help='wall clock budget, e.g. 2h or 90m, training stops before an epoch that would not fit')
+parser.add_argument('--keep-checkpoints', default=0, type=int, metavar='K',
+                    help='also keep the checkpoints of the last K epochs as hardlinks (default: 0)')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
 parser.add_argument('-b', '--batch-size', default=256, type=int,
@@ -76,12 +85,19 @@ parser.add_argument('-pr_train', '--predict_train', dest='predict_train', action
                     help='generate prediction masks')
 parser.add_argument('--tensorboard_images', default=False, type=str2bool,
                     help='Use tensorboard to see images')
+parser.add_argument('--batch-encoder', default='eval', type=str, metavar='MODE',
+                    help='run the shared GapNet encoder once on stacked inputs: eval, always or never (default: eval)')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda (all visible GPUs) or cpu (default: cuda)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='intra-op CPU threads, 0 keeps the torch default')
 
 best_val_loss = 100
 train_minib_counter = 0
 valid_minib_counter = 0
 
 args = parser.parse_args()
+checkpoint_writer = CheckpointWriter(keep=args.keep_checkpoints)
 
 print(args)
 
@@ -101,7 +117,9 @@ if not (args.evaluate or args.predict or args.predict_train):
         pass
 
 # Set the Tensorboard logger
+# the logger is only imported when logging is on
 if args.tensorboard or args.tensorboard_images:
+    from TbLogger import Logger
     logger = Logger('./tb_logs/{}'.format(args.lognumber))
 
 def main():
@@ -155,28 +173,31 @@ def main():
         print('Gapnet18 activated')
         model = GapNetImg18(num_classes=1,
                         num_channels=1,
-                        dilation=args.dilation)
+                        dilation=args.dilation,
+                        batch_encoder=args.batch_encoder)
     else:
         raise ValueError('Model not supported')
     
-    # train on 2 GPUs for speed
-    # model = model.cuda()
-    model = torch.nn.DataParallel(model).cuda()
+    # train on 2 GPUs for speed, or run on CPU
+    device = torch.device(args.device)
+    if device.type == 'cpu' and args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = place_model(model, device)
 
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            # the checkpoint writer saves CPU tensors, they load on any device
+            checkpoint = load_checkpoint(model, args.resume)
             args.start_epoch = checkpoint['epoch']
             best_val_loss = checkpoint['best_val_loss']
-            model.load_state_dict(checkpoint['state_dict'])
             print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.evaluate, checkpoint['epoch']))
+                  .format(args.resume, checkpoint['epoch']))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
-    cudnn.benchmark = True
+    cudnn.benchmark = device.type == 'cuda'
      
     if not (args.predict or args.predict_train):
         
@@ -206,14 +227,14 @@ def main():
             batch_size=args.batch_size,        
             shuffle=True,
             num_workers=args.workers,
-            pin_memory=True)
+            pin_memory=(device.type == 'cuda'))
 
         val_loader = torch.utils.data.DataLoader(
             val_dataset,
             batch_size=args.batch_size,        
             shuffle=True,
             num_workers=args.workers,
-            pin_memory=True)
+            pin_memory=(device.type == 'cuda'))
         
     # else:
     #    predict_augs = SatellitesTestAugmentation(shape=args.imsize)    
@@ -234,7 +255,7 @@ def main():
     #        pin_memory=True)    
 
     # play with criteria?
-    criterion = TDiceLoss().cuda()
+    criterion = TDiceLoss().to(device)
     # criterion = DiceLoss().cuda()
     
     if args.optimizer.startswith('adam'):           
@@ -250,7 +271,6 @@ def main():
                                               mode = 'min',
                                               factor = 0.1,
                                               patience = 4,
-                                              verbose = True,
                                               threshold = 1e-3,
                                               min_lr = 1e-5
                                              )    
@@ -268,21 +288,25 @@ def main():
     #            predict_prefix)
     #    return    
 
+    controller = TrainController(patience=args.patience,
+                                 min_delta=args.min_delta,
+                                 time_budget=parse_duration(args.time_budget),
+                                 scheduler=scheduler,
+                                 device=device)
+
     for epoch in range(args.start_epoch, args.epochs):
         # adjust_learning_rate(optimizer, epoch)
 
         # train for one epoch
-        train_loss = train(train_loader, model, criterion, optimizer, epoch)
+        train_loss = train(train_loader, model, criterion, optimizer, epoch, device, controller)
 
         # evaluate on validation set
-        val_loss = validate(val_loader, model, criterion)
+        val_loss = validate(val_loader, model, criterion, device)
         
+        lr = optimizer.param_groups[0]['lr']
         scheduler.step(val_loss)
-
-        # add code for early stopping here 
-        # 
-        #
-  
+        if optimizer.param_groups[0]['lr'] < lr:
+            print(' * Reducing learning rate to {:.1e}'.format(optimizer.param_groups[0]['lr']))
 
         #============ TensorBoard logging ============#
         # Log the scalar values        
@@ -308,13 +332,20 @@ def main():
         'weights/{}_best.pth.tar'.format(str(args.lognumber))
         )
 
-def train(train_loader, model, criterion, optimizer, epoch):
+        # the checkpoint of the last epoch is saved before stopping
+        if controller.step(val_loss):
+            break
+
+    checkpoint_writer.flush()
+
+def train(train_loader, model, criterion, optimizer, epoch, device, controller=None):
     global train_minib_counter
     global logger
         
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
+    # loss and dice / IoU are summed on the device, there are no cities here
+    meter = SegmentationMeter(['all'], device)
 
     # switch to train mode
     model.train()
@@ -325,22 +356,17 @@ def train(train_loader, model, criterion, optimizer, epoch):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
-        target_narrow = target_narrow.float().cuda(async=True)
-        target_wide = target_wide.float().cuda(async=True)
-        
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        target_narrow_var = torch.autograd.Variable(target_narrow)
-        target_wide_var = torch.autograd.Variable(target_wide)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
+        target_narrow = target_narrow.float().to(device, non_blocking=True)
+        target_wide = target_wide.float().to(device, non_blocking=True)
         
         # compute output
-        output = model(input_var,target_narrow_var,target_wide_var)
-        loss = criterion(output, target_var)
+        output = model(input,target_narrow,target_wide)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -351,35 +377,44 @@ def train(train_loader, model, criterion, optimizer, epoch):
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'train_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, train_minib_counter)                
-        
         train_minib_counter += 1
         
+        # the sums are only copied to the host here
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'train_loss': metrics['loss_last'],
+                    'train_dice': metrics['dice'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, train_minib_counter)                
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   epoch, i, len(train_loader), batch_time=batch_time,
-                   data_time=data_time, loss=losses))
+                  'Loss {3:.4f} ({4:.4f})\t'
+                  'Dice {5:.4f}\tIoU {6:.4f}\t'.format(
+                   epoch, i, len(train_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time, data_time=data_time))
 
-    print(' * Avg Train Loss {loss.avg:.4f}'.format(loss=losses))         
+        # a long epoch is cut once the time budget is spent
+        if controller is not None and controller.out_of_time(i):
+            break
+
+    metrics = meter.summary()
+    print(' * Avg Train Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
             
-    return losses.avg
+    return metrics['loss']
 
-def validate(val_loader, model, criterion):
+@torch.no_grad()
+def validate(val_loader, model, criterion, device):
     global valid_minib_counter
     global logger
     
     batch_time = AverageMeter()
-    losses = AverageMeter()
+    meter = SegmentationMeter(['all'], device)
 
     # switch to evaluate mode
     model.eval()
@@ -387,18 +422,13 @@ def validate(val_loader, model, criterion):
     end = time.time()
     for i, (input, target, target_narrow, target_wide) in enumerate(val_loader):
         
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
-        target_narrow = target_narrow.float().cuda(async=True)
-        target_wide = target_wide.float().cuda(async=True)
-        
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
-        target_narrow_var = torch.autograd.Variable(target_narrow, volatile=True)
-        target_wide_var = torch.autograd.Variable(target_wide, volatile=True)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
+        target_narrow = target_narrow.float().to(device, non_blocking=True)
+        target_wide = target_wide.float().to(device, non_blocking=True)
 
         # compute output
-        output = model(input_var,target_narrow_var,target_wide_var)
+        output = model(input,target_narrow,target_wide)
         
         #============ TensorBoard logging ============#              
         # Show original images
@@ -437,48 +467,52 @@ def validate(val_loader, model, criterion):
         if args.tensorboard_images:
             if i % args.print_freq == 0:
                 info = {
-                    'e_preds': to_np(output.data.view(-1,args.imsize, args.imsize)[:10])
+                    'e_preds': to_np(output.view(-1,args.imsize, args.imsize)[:10])
                 }
                 for tag, images in info.items():
                     logger.image_summary(tag, images, train_minib_counter)  
         
         
-        loss = criterion(output, target_var)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'valid_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, valid_minib_counter)            
-        
         valid_minib_counter += 1
         
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'valid_loss': metrics['loss_last'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, valid_minib_counter)            
             print('Test: [{0}/{1}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   i, len(val_loader), batch_time=batch_time, loss=losses))
+                  'Loss {2:.4f} ({3:.4f})\t'
+                  'Dice {4:.4f}\tIoU {5:.4f}\t'.format(
+                   i, len(val_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time))
 
-    print(' * Avg Val Loss {loss.avg:.4f}'.format(loss=losses))
+    metrics = meter.summary()
+    print(' * Avg Val Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
 
-    return losses.avg
+    return metrics['loss']
 
 def predict(predict_loader,
             model,
             predict_imgs,
             predict_city_folders,
             predict_img_names,
-            predict_prefix):
+            predict_prefix,
+            device):
     
     global valid_minib_counter
     global logger
@@ -491,14 +525,13 @@ def predict(predict_loader,
     print(predict_img_names[0:16])
     print(len(predict_img_names))
 
-    with tqdm.tqdm(total=len(predict_loader)) as pbar:
+    with tqdm.tqdm(total=len(predict_loader)) as pbar, torch.no_grad():
         for i, (input) in enumerate(predict_loader):
 
-            input = input.float().cuda(async=True)
-            input_var = torch.autograd.Variable(input, volatile=True)
+            input = input.float().to(device, non_blocking=True)
 
             # compute output
-            output = model(input_var)
+            output = model(input)
             
             for pred_image in output:
 
@@ -513,7 +546,7 @@ def predict(predict_loader,
                 im_path = os.path.join(prediction_folder,predict_img_names[c][:-3]+'jpg')
                 
                 # save image to disk
-                imsave(im_path,pred_image.data.cpu().numpy()[0,:,:])
+                imsave(im_path,pred_image.cpu().numpy()[0,:,:])
                 
                 c+=1
 
@@ -525,9 +558,8 @@ def predict(predict_loader,
     return 1
 
 def save_checkpoint(state, is_best, filename, best_filename):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, best_filename)
+    # copied to the CPU here, written in the background, best is a hardlink
+    checkpoint_writer.save(state, is_best, filename, best_filename)
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -1,12 +1,8 @@
-# Custom tensorboard logging
-from TbLogger import Logger
-
 import argparse
 import os
 import shutil
 import time
 import tqdm
-from skimage.io import imsave
 
 import torch
 import torch.nn as nn
@@ -24,19 +20,46 @@ from PIL import Image
 from sklearn.model_selection import train_test_split
 
 # custom classes
-from UNet import UNet11
-from LinkNet import LinkNet34,LinkNet50,LinkNet50_full,LinkNeXt
+from InferenceUtils import get_model,place_model,load_checkpoint,ThroughputMeter,tta_forward,benchmark_tta,optimize_for_inference
 from Loss import BCEDiceLoss,TDiceLoss,DiceLoss
 from presets import preset_dict
-from SatellitesDataset import get_test_dataset,get_train_dataset,SatellitesDataset,get_train_dataset_for_predict,get_train_dataset_wide_masks,get_train_dataset_layered_masks,get_train_dataset_all,get_train_dataset_for_predict_all,get_train_dataset_all_16bit,get_train_dataset_for_predict_all_16bit,get_test_dataset_16bit
+from SatellitesDataset import get_test_dataset,get_train_dataset,SatellitesDataset,FixedCropDataset,city_names,get_train_dataset_for_predict,get_train_dataset_wide_masks,get_train_dataset_layered_masks,get_train_dataset_all,get_train_dataset_for_predict_all,get_train_dataset_all_16bit,get_train_dataset_for_predict_all_16bit,get_test_dataset_16bit
 from SatellitesAugs import SatellitesTrainAugmentation,SatellitesTestAugmentation,SatellitesTestAugmentationPredict
 from presets import preset_dict
 
+from PretrainedWeights import set_pretrained_dir
+from CheckpointWriter import CheckpointWriter
+from TrainController import TrainController,parse_duration
 from LRScheduler import CyclicLR
+from GraphUtils import GraphExtractionPool
+from PredictionWriter import PredictionWriter
+from ActivationCheckpoint import checkpoint_activations
+from MetricUtils import SegmentationMeter,format_city_metrics
+from DistUtils import is_main_process,init_distributed,wrap_ddp,distributed_loader,set_loader_epoch,eval_model,cleanup
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
+def parse_imsize_schedule(schedule, batch_size, imsize):
+    """
+    '512:10,896:10,1280:20' -> [(first epoch, imsize, batch size), ...] and the total epochs
+    Phases without a batch size keep the pixels per batch of --batch-size at --imsize
+    """
+    phases = []
+    start = 0
+    for phase in schedule.split(','):
+        values = [int(value) for value in phase.split(':')]
+        if len(values) == 2:
+            size, epochs = values
+            batch = max(int(batch_size * (imsize / size) ** 2), 1)
+        elif len(values) == 3:
+            size, epochs, batch = values
+        else:
+            raise ValueError('Imsize schedule phase {} not supported'.format(phase))
+        phases.append((start, size, batch))
+        start += epochs
+    return phases, start
+
 parser = argparse.ArgumentParser(description='PyTorch Satellites semseg training')
 parser.add_argument('--arch', '-a', metavar='ARCH', default='linknet34',
                     help='model architecture')
@@ -44,6 +67,19 @@ parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
 parser.add_argument('--epochs', default=20, type=int, metavar='N',
                     help='number of total epochs to run')
+parser.add_argument('--patience', default=0, type=int, metavar='N',
+                    help='stop after N epochs without a val loss improvement, 0 disables early stopping')
+parser.add_argument('--min-delta', default=1e-3, type=float, metavar='D',
+                    help='smallest val loss decrease counted as an improvement (default: 1e-3)')
+parser.add_argument('--time-budget', default='', type=str, metavar='T',
+                    help='wall clock budget, e.g. 2h or 90m, training stops before an epoch that would not fit')
+parser.add_argument('--no-pretrained', dest='no_pretrained', action='store_true',
+                    help='do not load the ImageNet encoder weights')
+parser.add_argument('--pretrained-dir', default='', type=str, metavar='DIR',
+                    help='read the ImageNet encoder weights only from DIR, never download them '
+                         '(default: $PRETRAINED_DIR or the torch hub cache)')
+parser.add_argument('--keep-checkpoints', default=0, type=int, metavar='K',
+                    help='also keep the checkpoints of the last K epochs as hardlinks (default: 0)')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
 parser.add_argument('-b', '--batch-size', default=256, type=int,
@@ -66,6 +102,11 @@ parser.add_argument('--augs', default=False, type=str2bool,
                     help='Use augs for training')
 parser.add_argument('-im', '--imsize', default=320, type=int, metavar='N',
                     help='image size')
+parser.add_argument('--imsize-schedule', default='', type=str, metavar='SCHED',
+                    help='progressive resizing, size:epochs[:batch] phases, e.g. 512:10,896:10,1280:20, '
+                         'overrides --epochs, validation stays at --imsize')
+parser.add_argument('--target-loss', default=0, type=float, metavar='L',
+                    help='report the training time until the val loss first reaches L')
 parser.add_argument('-s', '--seed', default=42, type=int, metavar='N',
                     help='seed for train test split (default: 42)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
@@ -76,8 +117,50 @@ parser.add_argument('-pr_train', '--predict_train', dest='predict_train', action
                     help='generate prediction masks')
 parser.add_argument('--tensorboard_images', default=False, type=str2bool,
                     help='Use tensorboard to see images')
+parser.add_argument('--val-cache', dest='val_cache', action='store_true',
+                    help='validate on crops fixed by --seed, cut once and kept in shared memory')
+parser.add_argument('--image-freq', default=0, type=int, metavar='N',
+                    help='log validation images every N batches (default: 0, --print-freq)')
+parser.add_argument('--image-count', default=5, type=int, metavar='N',
+                    help='max images logged per batch (default: 5)')
+parser.add_argument('--image-size', default=256, type=int, metavar='N',
+                    help='longer side of the logged thumbnails, 0 keeps the full size (default: 256)')
 parser.add_argument('--city', '-cty', default='all', type=str,
                     metavar='CTY', help='a city to train on')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda (all visible GPUs) or cpu (default: cuda)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='intra-op CPU threads, 0 keeps the torch default')
+parser.add_argument('--channels-last', dest='channels_last', action='store_true',
+                    help='use channels last memory format')
+parser.add_argument('--tta', default=1, type=int, metavar='N',
+                    help='number of flip / rotation TTA variants averaged in predict (default: 1, no TTA)')
+parser.add_argument('--tta-benchmark', dest='tta_benchmark', action='store_true',
+                    help='time the first predict batch with 1..--tta variants')
+parser.add_argument('--vectorize', dest='vectorize', action='store_true',
+                    help='build linestrings from predictions in memory instead of saving jpg masks')
+parser.add_argument('--graph-workers', default=6, type=int, metavar='N',
+                    help='number of graph extraction processes for --vectorize (default: 6)')
+parser.add_argument('--save-probs', dest='save_probs', action='store_true',
+                    help='with --vectorize also save the padded masks as npz, the --write-format npz layout')
+parser.add_argument('--fast-skeleton', dest='fast_skeleton', action='store_true',
+                    help='with --vectorize use the fused numba skeletonization kernel')
+parser.add_argument('--distributed', dest='distributed', action='store_true',
+                    help='DistributedDataParallel training, launch with torchrun')
+parser.add_argument('--dist-backend', default='', type=str, metavar='BE',
+                    help='nccl or gloo, default nccl on cuda and gloo on cpu')
+parser.add_argument('--checkpoint-activations', dest='checkpoint_activations', action='store_true',
+                    help='recompute encoder / decoder activations in backward to save memory')
+parser.add_argument('--optimize', dest='optimize', action='store_true',
+                    help='fold conv + bn and freeze the model with TorchScript before predict (single device)')
+parser.add_argument('--write-format', default='jpg', type=str, metavar='FMT',
+                    help='predicted mask format: jpg, png, webp (lossless) or npz (default: jpg)')
+parser.add_argument('--writer-threads', default=4, type=int, metavar='N',
+                    help='threads encoding and writing predicted masks (default: 4)')
+parser.add_argument('--writer-queue', default=32, type=int, metavar='N',
+                    help='max predicted masks waiting to be written (default: 32)')
+parser.add_argument('--onnx', default='', type=str, metavar='PATH',
+                    help='predict with an exported ONNX model on onnxruntime CPU instead of PyTorch')
 parser.add_argument('--params', nargs = '*', dest = 'params', help = 'topcoder args', default = argparse.SUPPRESS)
 
 best_val_loss = 100
@@ -85,18 +168,19 @@ train_minib_counter = 0
 valid_minib_counter = 0
 
 args = parser.parse_args()
+checkpoint_writer = CheckpointWriter(keep=args.keep_checkpoints)
+if args.pretrained_dir:
+    set_pretrained_dir(args.pretrained_dir)
 
 print(args)
 
-def to_np(x):
-    x = x.cpu().numpy()
-    if len(x.shape)>3:
-        return x[:,0:3,:,:]
-    else:
-        return x
+# checkpoints and tensorboard logs are written by rank 0 only
+if not is_main_process():
+    args.tensorboard = False
+    args.tensorboard_images = False
 
 # remove the log file if it exists if we run the script in the training mode
-if not (args.evaluate or args.predict or args.predict_train):
+if not (args.evaluate or args.predict or args.predict_train) and is_main_process():
     print('Folder {} delete triggered'.format(args.lognumber))
     try:
         shutil.rmtree('tb_logs/{}/'.format(args.lognumber))
@@ -104,7 +188,9 @@ if not (args.evaluate or args.predict or args.predict_train):
         pass
 
 # Set the Tensorboard logger
+# the logger is only imported when logging is on
 if args.tensorboard or args.tensorboard_images:
+    from TbLogger import Logger
     logger = Logger('./tb_logs/{}'.format(args.lognumber))
 
 def main():
@@ -162,96 +248,82 @@ def main():
         print('Predict images: {}\n'.format(len(predict_imgs)))        
     
     
-    if args.arch.startswith('linknet34'):
-        print('Full linknet34 activated')
-        if args.preset in ['mul_ps_8channel','mul_8channel']:
-            model = LinkNet34(num_channels=8,
-                              num_classes=1)
-        else:
-            model = LinkNet34(num_channels=3,
-                              num_classes=1)
-    elif args.arch.startswith('linknext'):
-        print('LinkNeXt101-32 activated')
-        model = LinkNeXt(num_channels=3,
-                          num_classes=1)            
-    elif args.arch.startswith('linknet50_full'):
-        print('Full linknet50 activated')
-        if args.preset in ['mul_ps_8channel','mul_8channel']:
-            model = LinkNet50_full(num_channels=8,
-                              num_classes=1)
-        else:
-            model = LinkNet50_full(num_channels=3,
-                              num_classes=1)               
-    elif args.arch.startswith('linknet50'):
-        print('Truncated linknet50 activated')
-        if args.preset in ['mul_ps_8channel','mul_8channel']:
-            model = LinkNet50(num_channels=8,
-                              num_classes=1)
-        else:
-            model = LinkNet50(num_channels=3,
-                              num_classes=1)            
-    elif args.arch.startswith('unet11'):
-        if args.preset in ['mul_ps_8channel','mul_8channel']:
-            model = UNet11(num_classes=1,
-                           num_channels=8)            
-        else:
-            model = UNet11(num_classes=1,
-                           num_channels=3,
-                           num_filters=32)
-    else:
-        raise ValueError('Model not supported')
+    # the ImageNet weights are only loaded when no checkpoint or ONNX model replaces them
+    restore = (args.resume and os.path.isfile(args.resume)) or args.onnx
+    model = get_model(args.arch, args.preset, pretrained=not (restore or args.no_pretrained))
+    if args.checkpoint_activations:
+        print('Activation checkpointing of {}'.format(', '.join(checkpoint_activations(model))))
     
-    # train on 2 GPUs for speed
-    # model = model.cuda()
-    model = torch.nn.DataParallel(model).cuda()
+    # train on 2 GPUs for speed, one process per GPU / CPU worker with torchrun, or run on CPU
+    if args.distributed:
+        if args.predict or args.predict_train:
+            raise ValueError('Distributed predict not supported')
+        device = init_distributed(args.device, args.dist_backend)
+    else:
+        device = torch.device(args.device)
+    if device.type == 'cpu' and args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.distributed:
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        model = wrap_ddp(model, device)
+    else:
+        model = place_model(model, device, channels_last=args.channels_last)
 
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            checkpoint = load_checkpoint(model, args.resume)
             args.start_epoch = checkpoint['epoch']
             best_val_loss = checkpoint['best_val_loss']
-            model.load_state_dict(checkpoint['state_dict'])
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.evaluate, checkpoint['epoch']))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
-    cudnn.benchmark = True
+    cudnn.benchmark = device.type == 'cuda'
      
     if not (args.predict or args.predict_train):
         
         train_augs = SatellitesTrainAugmentation(shape=args.imsize,
                                                  aug_scheme = args.augs)
 
-        val_augs = SatellitesTestAugmentation(shape=args.imsize)
+        val_augs = SatellitesTestAugmentation(shape=args.imsize, crop=not args.val_cache)
         
         train_dataset = SatellitesDataset(preset = preset_dict[args.preset],
                                           image_paths = train_imgs,
                                           mask_paths = train_masks,
                                           transforms = train_augs,
+                                          with_city = True,
                                          )
 
         val_dataset = SatellitesDataset(preset = preset_dict[args.preset],
                                         image_paths = val_imgs,
                                         mask_paths = val_masks,
-                                        transforms = val_augs,
+                                        transforms = None if args.val_cache else val_augs,
+                                        with_city = True,
                                        )
-        
-        train_loader = torch.utils.data.DataLoader(
-            train_dataset,
-            batch_size=args.batch_size,        
-            shuffle=True,
-            num_workers=args.workers,
-            pin_memory=True)
-
-        val_loader = torch.utils.data.DataLoader(
-            val_dataset,
-            batch_size=args.batch_size,        
-            shuffle=True,
-            num_workers=args.workers,
-            pin_memory=True)
+        if args.val_cache:
+            # the same crops every epoch, decoded during the first one only
+            val_dataset = FixedCropDataset(val_dataset, args.imsize, val_augs, seed=args.seed)
+
+        train_loader = make_train_loader(train_dataset, args.batch_size, device)
+        if args.distributed:
+            # no padded duplicates, the reduced val metrics count every crop once
+            val_loader = distributed_loader(val_dataset,
+                                            batch_size=args.batch_size,
+                                            shuffle=False,
+                                            num_workers=args.workers,
+                                            pin_memory=(device.type == 'cuda'),
+                                            pad=False)
+        else:
+            val_loader = torch.utils.data.DataLoader(
+                val_dataset,
+                batch_size=args.batch_size,        
+                shuffle=False,
+                num_workers=args.workers,
+                pin_memory=(device.type == 'cuda'))
         
     else:
         predict_augs = SatellitesTestAugmentationPredict(shape=args.imsize,
@@ -268,10 +340,10 @@ def main():
             batch_size=args.batch_size,        
             shuffle=False,
             num_workers=args.workers,
-            pin_memory=True)    
+            pin_memory=(device.type == 'cuda'))    
 
     # play with criteria?
-    criterion = TDiceLoss().cuda()
+    criterion = TDiceLoss().to(device)
     # criterion = DiceLoss().cuda()
     
     if args.optimizer.startswith('adam'):           
@@ -287,7 +359,6 @@ def main():
                                               mode = 'min',
                                               factor = 0.1,
                                               patience = 4,
-                                              verbose = True,
                                               threshold = 1e-3,
                                               min_lr = 1e-5
                                               )
@@ -301,33 +372,78 @@ def main():
         
     # if we pass evaluate or predict flat, training loop is omitted altogether
     if args.evaluate:
-        validate(val_loader, model, criterion)
+        validate(val_loader, model, criterion, scheduler, device)
         return
     
     if args.predict or args.predict_train:
-        predict(predict_loader,
-                model,
-                predict_imgs,
-                predict_city_folders,
-                predict_img_names,
-                predict_prefix)
+        if args.onnx:
+            from OnnxUtils import OnnxModel
+            print("=> predicting with ONNX model '{}'".format(args.onnx))
+            model = OnnxModel(args.onnx, threads=args.threads)
+        elif args.optimize:
+            num_channels = len(preset_dict[args.preset]['channels'])
+            model = optimize_for_inference(model, torch.randn(1, num_channels, 256, 256).to(device))
+        if args.vectorize:
+            lstrs = predict_linestrings(predict_loader,
+                                        model,
+                                        predict_city_folders,
+                                        predict_img_names,
+                                        predict_prefix,
+                                        device)
+            # the last topcoder param is the name of the solution file
+            lstrs.to_csv('../{}.txt'.format(args.params[-1]), index = False)
+            print('Resulting {}.txt file is saved under parent directory'.format(args.params[-1]))
+        else:
+            predict(predict_loader,
+                    model,
+                    predict_imgs,
+                    predict_city_folders,
+                    predict_img_names,
+                    predict_prefix,
+                    device)
         return    
 
+    if args.imsize_schedule:
+        schedule, args.epochs = parse_imsize_schedule(args.imsize_schedule, args.batch_size, args.imsize)
+        print('Imsize schedule (first epoch, imsize, batch size): {}'.format(schedule))
+    train_shape = (args.imsize, args.batch_size)
+    train_start = time.time()
+    controller = TrainController(patience=args.patience,
+                                 min_delta=args.min_delta,
+                                 time_budget=parse_duration(args.time_budget),
+                                 scheduler=scheduler,
+                                 device=device)
+    target_reached = False
+
     for epoch in range(args.start_epoch, args.epochs):
         # adjust_learning_rate(optimizer, epoch)
 
+        # progressive resizing, the loader is rebuilt in place when the phase changes
+        if args.imsize_schedule:
+            _, imsize, batch_size = [phase for phase in schedule if phase[0] <= epoch][-1]
+            if (imsize, batch_size) != train_shape:
+                print('Epoch {}: training on {}px crops, batch size {}'.format(epoch, imsize, batch_size))
+                train_dataset.transforms = SatellitesTrainAugmentation(shape=imsize,
+                                                                       aug_scheme = args.augs)
+                train_loader = make_train_loader(train_dataset, batch_size, device)
+                train_shape = (imsize, batch_size)
+
         # train for one epoch
-        train_loss = train(train_loader, model, criterion, optimizer, epoch, scheduler)
+        set_loader_epoch(train_loader, epoch)
+        train_loss = train(train_loader, model, criterion, optimizer, epoch, scheduler, device, controller)
 
         # evaluate on validation set
-        val_loss = validate(val_loader, model, criterion, scheduler)
+        val_loss = validate(val_loader, model, criterion, scheduler, device)
         
+        lr = optimizer.param_groups[0]['lr']
         scheduler.step(val_loss)
+        if optimizer.param_groups[0]['lr'] < lr:
+            print(' * Reducing learning rate to {:.1e}'.format(optimizer.param_groups[0]['lr']))
 
-        # add code for early stopping here 
-        # 
-        #
-  
+        if args.target_loss and not target_reached and val_loss <= args.target_loss:
+            target_reached = True
+            print(' * Val loss {:.4f} reached the target {:.4f} after {:.0f}s at epoch {}'
+                  .format(val_loss, args.target_loss, time.time() - train_start, epoch))
 
         #============ TensorBoard logging ============#
         # Log the scalar values        
@@ -342,18 +458,40 @@ def main():
         # remember best prec@1 and save checkpoint
         is_best = val_loss < best_val_loss
         best_val_loss = min(val_loss, best_val_loss)
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_val_loss': best_val_loss,
-        },
-        is_best,
-        'weights/{}_checkpoint.pth.tar'.format(str(args.lognumber)),
-        'weights/{}_best.pth.tar'.format(str(args.lognumber))
-        )
-
-def train(train_loader, model, criterion, optimizer, epoch, scheduler):
+        if is_main_process():
+            save_checkpoint({
+                'epoch': epoch + 1,
+                'arch': args.arch,
+                'state_dict': model.state_dict(),
+                'best_val_loss': best_val_loss,
+            },
+            is_best,
+            'weights/{}_checkpoint.pth.tar'.format(str(args.lognumber)),
+            'weights/{}_best.pth.tar'.format(str(args.lognumber))
+            )
+
+        # the checkpoint of the last epoch is saved before stopping
+        if controller.step(val_loss):
+            break
+
+    checkpoint_writer.flush()
+    cleanup()
+
+def make_train_loader(train_dataset, batch_size, device):
+    if args.distributed:
+        return distributed_loader(train_dataset,
+                                  batch_size=batch_size,
+                                  shuffle=True,
+                                  num_workers=args.workers,
+                                  pin_memory=(device.type == 'cuda'),
+                                  seed=args.seed)
+    return torch.utils.data.DataLoader(train_dataset,
+                                       batch_size=batch_size,
+                                       shuffle=True,
+                                       num_workers=args.workers,
+                                       pin_memory=(device.type == 'cuda'))
+
+def train(train_loader, model, criterion, optimizer, epoch, scheduler, device, controller=None):
     global train_minib_counter
     global logger
         
@@ -361,29 +499,27 @@ def train(train_loader, model, criterion, optimizer, epoch, scheduler):
     
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
+    # loss and per city dice / IoU are summed on the device
+    meter = SegmentationMeter(city_names, device)
 
     # switch to train mode
     model.train()
 
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    for i, (input, target, city) in enumerate(train_loader):
 
         # measure data loading time
         data_time.update(time.time() - end)
 
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
 
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        output = model(input)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target, city)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -394,117 +530,121 @@ def train(train_loader, model, criterion, optimizer, epoch, scheduler):
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'train_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, train_minib_counter)                
-        
         train_minib_counter += 1
         
+        # the sums are only copied to the host here
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'train_loss': metrics['loss_last'],
+                    'train_dice': metrics['dice'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, train_minib_counter)                
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   epoch, i, len(train_loader), batch_time=batch_time,
-                   data_time=data_time, loss=losses))
-
-    print(' * Avg Train Loss {loss.avg:.4f}'.format(loss=losses))         
+                  'Loss {3:.4f} ({4:.4f})\t'
+                  'Dice {5:.4f}\tIoU {6:.4f}\t'.format(
+                   epoch, i, len(train_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time, data_time=data_time))
+
+        # a long epoch is cut once the time budget is spent
+        if controller is not None and controller.out_of_time(i):
+            break
+
+    # the same epoch metrics on every process
+    metrics = meter.summary(all_reduce=True)
+    print(' * Avg Train Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
+    print(' * ' + format_city_metrics(metrics, city_names))
             
-    return losses.avg
+    return metrics['loss']
 
-def validate(val_loader, model, criterion, scheduler):
+@torch.no_grad()
+def validate(val_loader, model, criterion, scheduler, device):
     global valid_minib_counter
     global logger
     
     # scheduler.batch_step()    
     
     batch_time = AverageMeter()
-    losses = AverageMeter()
+    meter = SegmentationMeter(city_names, device)
 
-    # switch to evaluate mode
+    # switch to evaluate mode, outside of DDP on the uneven val shards
+    model = eval_model(model)
     model.eval()
 
     end = time.time()
-    for i, (input, target) in enumerate(val_loader):
+    for i, (input, target, city) in enumerate(val_loader):
         
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
-        
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
 
         # compute output
-        output = model(input_var)
+        output = model(input)
         
         
         #============ TensorBoard logging ============#              
-        # Show original images
+        # Show original images, masks and the output masks
+        # thumbnails are copied without a sync and PNG encoded by the logger encoder thread
         if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'images': to_np(input.view(-1,len(preset_dict[args.preset]['channels']),args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)
-        # Show masks
-        if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'masks': to_np(target.view(-1,args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)                  
-        # Show the output masks
-        if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'preds': to_np(output.data.view(-1,args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)  
+            if i % (args.image_freq or args.print_freq) == 0:
+                logger.snapshot_images('images', input, train_minib_counter, args.image_count, args.image_size)
+                logger.snapshot_images('masks', target, train_minib_counter, args.image_count, args.image_size)
+                logger.snapshot_images('preds', output, train_minib_counter, args.image_count, args.image_size)
         
         
-        loss = criterion(output, target_var)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target, city)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'valid_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, valid_minib_counter)            
-        
         valid_minib_counter += 1
         
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'valid_loss': metrics['loss_last'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, valid_minib_counter)            
             print('Test: [{0}/{1}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   i, len(val_loader), batch_time=batch_time, loss=losses))
+                  'Loss {2:.4f} ({3:.4f})\t'
+                  'Dice {4:.4f}\tIoU {5:.4f}\t'.format(
+                   i, len(val_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time))
+
+    # the scheduler and the best checkpoint see the loss of the whole validation set
+    metrics = meter.summary(all_reduce=True)
+    print(' * Avg Val Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
+    print(' * ' + format_city_metrics(metrics, city_names))
 
-    print(' * Avg Val Loss {loss.avg:.4f}'.format(loss=losses))
+    #============ TensorBoard logging ============#
+    if args.tensorboard:
+        for tag, value in metrics.items():
+            if tag.startswith('dice') or tag.startswith('iou'):
+                logger.scalar_summary('valid_' + tag, value, valid_minib_counter)
 
-    return losses.avg
+    return metrics['loss']
 
 def predict(predict_loader,
             model,
             predict_imgs,
             predict_city_folders,
             predict_img_names,
-            predict_prefix):
+            predict_prefix,
+            device):
     
     global valid_minib_counter
     global logger
@@ -517,29 +657,26 @@ def predict(predict_loader,
     print(predict_img_names[0:16])
     print(len(predict_img_names))
 
-    with tqdm.tqdm(total=len(predict_loader)) as pbar:
+    meter = ThroughputMeter(device)
+    writer = PredictionWriter(args.write_format, args.writer_threads, args.writer_queue)
+
+    with tqdm.tqdm(total=len(predict_loader)) as pbar, torch.no_grad():
         for i, (input) in enumerate(predict_loader):
 
-            input = input.float().cuda(async=True)
-            input_var = torch.autograd.Variable(input, volatile=True)
+            input = to_model_input(input, device)
+
+            if i == 0 and args.tta_benchmark:
+                benchmark_tta(model, input, args.tta)
 
             # compute output
-            output = model(input_var)
+            output = tta_forward(model, input, args.tta)
+            meter.update(output.size(0))
             
-            for pred_image in output:
+            # one device to host copy per batch, encoding and writing happen in the writer threads
+            for pred_image in output.cpu().numpy():
 
                 prediction_folder = os.path.join(predict_prefix,predict_city_folders[c],args.lognumber)
-                
-                # check that prediction folder exists
-                if not os.path.exists(prediction_folder):
-                    os.mkdir(prediction_folder)                    
-                
-                # print(c)
-                # print(predict_img_names[c])
-                im_path = os.path.join(prediction_folder,predict_img_names[c][:-3]+'jpg')
-                
-                # save image to disk
-                imsave(im_path,pred_image.data.cpu().numpy()[0,:,:])
+                writer.submit(pred_image[0,:,:], prediction_folder, predict_img_names[c][:-4])
                 
                 c+=1
 
@@ -548,12 +685,74 @@ def predict(predict_loader,
             
             pbar.update(1)            
 
+    # the last masks are on disk before predict returns
+    writer.close()
+    meter.report()
     return 1
 
+def predict_linestrings(predict_loader,
+                        model,
+                        predict_city_folders,
+                        predict_img_names,
+                        predict_prefix,
+                        device,
+                        padding=6):
+    # same as predict, but the probability maps go straight to graph extraction
+    # workers through a bounded queue, so the GPU keeps working while they run
+    print('Starting to do the predictions and linestrings')
+    c = 0
+    model.eval()
+
+    graph_pool = GraphExtractionPool(workers=args.graph_workers,
+                                     max_pending=4 * args.graph_workers,
+                                     thresh=30,
+                                     fast=args.fast_skeleton)
+
+    meter = ThroughputMeter(device)
+    # the saved masks are the same padded uint8 npz files as predict writes, final_model_lstrs.py reads both
+    writer = PredictionWriter('npz', args.writer_threads, args.writer_queue) if args.save_probs else None
+
+    with tqdm.tqdm(total=len(predict_loader)) as pbar, torch.no_grad():
+        for i, (input) in enumerate(predict_loader):
+
+            input = to_model_input(input, device)
+
+            if i == 0 and args.tta_benchmark:
+                benchmark_tta(model, input, args.tta)
+
+            # compute output
+            output = tta_forward(model, input, args.tta)
+            output = output[:, 0].cpu().numpy()
+            meter.update(output.shape[0])
+
+            for pred_image in output:
+                img_name = predict_img_names[c]
+                img_id = img_name[img_name.find('AOI'):img_name.find('.')]
+
+                if writer is not None:
+                    prediction_folder = os.path.join(predict_prefix,predict_city_folders[c],args.lognumber)
+                    writer.submit(pred_image, prediction_folder, img_name[:-4])
+
+                graph_pool.submit(pred_image[padding:-padding, padding:-padding], img_id)
+                c+=1
+
+            pbar.update(1)
+
+    if writer is not None:
+        writer.close()
+    meter.report()
+    lstrs = graph_pool.close()
+    return lstrs.drop_duplicates()
+
+def to_model_input(input, device):
+    input = input.float().to(device, non_blocking=True)
+    if args.channels_last:
+        input = input.contiguous(memory_format=torch.channels_last)
+    return input
+
 def save_checkpoint(state, is_best, filename, best_filename):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, best_filename)
+    # copied to the CPU here, written in the background, best is a hardlink
+    checkpoint_writer.save(state, is_best, filename, best_filename)
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
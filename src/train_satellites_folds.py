@@ -1,12 +1,9 @@
-# Custom tensorboard logging
-from TbLogger import Logger
-
 import argparse
+import json
 import os
 import shutil
 import time
 import tqdm
-from skimage.io import imsave
 import numpy as np
 
 import torch
@@ -26,13 +23,19 @@ from sklearn.model_selection import train_test_split
 from sklearn.model_selection import StratifiedKFold
 
 # custom classes
-from UNet import UNet11
-from LinkNet import LinkNet34,LinkNet50,LinkNet50_full,LinkNeXt
 from Loss import BCEDiceLoss,TDiceLoss,DiceLoss
 from presets import preset_dict
-from SatellitesDataset import get_test_dataset,get_train_dataset,SatellitesDataset,get_train_dataset_for_predict,get_train_dataset_wide_masks,get_train_dataset_layered_masks,get_train_dataset_all
+from SatellitesDataset import get_test_dataset,get_train_dataset,SatellitesDataset,FixedCropDataset,city_names,get_train_dataset_for_predict,get_train_dataset_wide_masks,get_train_dataset_layered_masks,get_train_dataset_all
+from SatellitesDataset import DecodedCache,build_decoded_cache
 from SatellitesAugs import SatellitesTrainAugmentation,SatellitesTestAugmentation,SatellitesTestAugmentationTTA
 from presets import preset_dict
+from InferenceUtils import get_model,place_model,load_checkpoint,load_ensemble
+from PredictionWriter import PredictionWriter
+from MetricUtils import SegmentationMeter,format_city_metrics
+from PretrainedWeights import set_pretrained_dir
+from CheckpointWriter import CheckpointWriter
+from TrainController import TrainController,parse_duration
+from DistUtils import is_main_process,init_distributed,wrap_ddp,distributed_loader,set_loader_epoch,eval_model,cleanup
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -44,6 +47,19 @@ parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
 parser.add_argument('--epochs', default=20, type=int, metavar='N',
                     help='number of total epochs to run')
+parser.add_argument('--patience', default=0, type=int, metavar='N',
+                    help='stop after N epochs without a val loss improvement, 0 disables early stopping')
+parser.add_argument('--min-delta', default=1e-3, type=float, metavar='D',
+                    help='smallest val loss decrease counted as an improvement (default: 1e-3)')
+parser.add_argument('--time-budget', default='', type=str, metavar='T',
+                    help='wall clock budget of every fold, e.g. 2h or 90m, training stops before an epoch that would not fit')
+parser.add_argument('--no-pretrained', dest='no_pretrained', action='store_true',
+                    help='do not load the ImageNet encoder weights')
+parser.add_argument('--pretrained-dir', default='', type=str, metavar='DIR',
+                    help='read the ImageNet encoder weights only from DIR, never download them '
+                         '(default: $PRETRAINED_DIR or the torch hub cache)')
+parser.add_argument('--keep-checkpoints', default=0, type=int, metavar='K',
+                    help='also keep the checkpoints of the last K epochs as hardlinks (default: 0)')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
 parser.add_argument('-b', '--batch-size', default=256, type=int,
@@ -76,30 +92,67 @@ parser.add_argument('-pr_train', '--predict_train', dest='predict_train', action
                     help='generate prediction masks')
 parser.add_argument('--tensorboard_images', default=False, type=str2bool,
                     help='Use tensorboard to see images')
+parser.add_argument('--val-cache', dest='val_cache', action='store_true',
+                    help='validate on crops fixed by --seed, cut once and kept in shared memory')
+parser.add_argument('--image-freq', default=0, type=int, metavar='N',
+                    help='log validation images every N batches (default: 0, --print-freq)')
+parser.add_argument('--image-count', default=5, type=int, metavar='N',
+                    help='max images logged per batch (default: 5)')
+parser.add_argument('--image-size', default=256, type=int, metavar='N',
+                    help='longer side of the logged thumbnails, 0 keeps the full size (default: 256)')
 parser.add_argument('--city', '-cty', default='all', type=str,
                     metavar='CTY', help='a city to train on')
 parser.add_argument('--hflip', default=False, type=str2bool,
                     help='horizontal TTA flip')
 parser.add_argument('--vflip', default=False, type=str2bool,
                     help='vertical TTA flip')
+parser.add_argument('--device', default='cuda', type=str, metavar='DEV',
+                    help='cuda (all visible GPUs) or cpu (default: cuda)')
+parser.add_argument('--threads', default=0, type=int, metavar='N',
+                    help='intra-op CPU threads, 0 keeps the torch default')
+parser.add_argument('--distributed', dest='distributed', action='store_true',
+                    help='DistributedDataParallel training, launch with torchrun')
+parser.add_argument('--dist-backend', default='', type=str, metavar='BE',
+                    help='nccl or gloo, default nccl on cuda and gloo on cpu')
+parser.add_argument('--folds', default='0,1,2', type=str, metavar='FOLDS',
+                    help='comma separated folds to process (default: 0,1,2)')
+parser.add_argument('--decoded-cache', default='', type=str, metavar='DIR',
+                    help='read the images from a decoded .npy cache, shared read-only between processes')
+parser.add_argument('--build-cache-only', dest='build_cache_only', action='store_true',
+                    help='only decode the images into --decoded-cache and exit')
+parser.add_argument('--ensemble', dest='ensemble', action='store_true',
+                    help='predict once with the average of the --resume best checkpoints of all the --folds')
+parser.add_argument('--ensemble-threads', dest='ensemble_threads', action='store_true',
+                    help='run the ensemble models in parallel threads')
+parser.add_argument('--write-format', default='jpg', type=str, metavar='FMT',
+                    help='predicted mask format: jpg, png, webp (lossless) or npz (default: jpg)')
+parser.add_argument('--writer-threads', default=4, type=int, metavar='N',
+                    help='threads encoding and writing predicted masks (default: 4)')
+parser.add_argument('--writer-queue', default=32, type=int, metavar='N',
+                    help='max predicted masks waiting to be written (default: 32)')
+parser.add_argument('--summary', default='', type=str, metavar='PATH',
+                    help='json file with the best loss, epoch, time and checkpoints of every fold')
 
 best_val_loss = 100
 train_minib_counter = 0
 valid_minib_counter = 0
 
 args = parser.parse_args()
+checkpoint_writer = CheckpointWriter(keep=args.keep_checkpoints)
+if args.pretrained_dir:
+    set_pretrained_dir(args.pretrained_dir)
 
 print(args)
 
-def to_np(x):
-    x = x.cpu().numpy()
-    if len(x.shape)>3:
-        return x[:,0:3,:,:]
-    else:
-        return x
+# checkpoints and tensorboard logs are written by rank 0 only
+if not is_main_process():
+    args.tensorboard = False
+    args.tensorboard_images = False
 
 # Set the Tensorboard logger
+# the logger is only imported when logging is on
 if args.tensorboard or args.tensorboard_images:
+    from TbLogger import Logger
     logger = Logger('./tb_logs/{}'.format(args.lognumber))
 
 def main():
@@ -130,9 +183,31 @@ def main():
                                                                                            preset_dict,
                                                                                            args.city)     
 
+    # one process per GPU / CPU worker with torchrun, all the folds share the process group
+    if args.distributed:
+        if args.predict or args.predict_train:
+            raise ValueError('Distributed predict not supported')
+        device = init_distributed(args.device, args.dist_backend)
+    else:
+        device = torch.device(args.device)
+    if device.type == 'cpu' and args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    cache = None
+    if args.decoded_cache:
+        if args.build_cache_only:
+            build_decoded_cache(args.decoded_cache, preset_dict[args.preset], bit8_imgs, bit8_masks)
+            print('Decoded cache is saved to {}'.format(args.decoded_cache))
+            return
+        cache = DecodedCache(args.decoded_cache)
+    elif args.build_cache_only:
+        raise ValueError('--build-cache-only needs --decoded-cache')
+
     skf = StratifiedKFold(n_splits=3, shuffle = True, random_state = 42)
     f1, f2, f3 = skf.split(bit8_imgs, cty_no)
     folds = [f1, f2, f3]
+    selected_folds = [int(fold) for fold in args.folds.split(',')]
+    summary = {}
     
     bit8_imgs = np.array(bit8_imgs)
     bit8_masks = np.array(bit8_masks)
@@ -146,8 +221,10 @@ def main():
         
         best_val_loss = 100
         
-        # if i!=2:
-        #    continue
+        if i not in selected_folds:
+            continue
+        fold_start = time.time()
+        best_epoch = args.start_epoch
             
         # remove the log file if it exists if we run the script in the training mode
         if not (args.evaluate or args.predict or args.predict_train):
@@ -165,48 +242,25 @@ def main():
         print('Processing fold : {}'.format(i))
 
         
-        if args.arch.startswith('linknet34'):
-            print('Full linknet34 activated')
-            if args.preset in ['mul_ps_8channel','mul_8channel']:
-                model = LinkNet34(num_channels=8,
-                                  num_classes=1)
-            else:
-                model = LinkNet34(num_channels=3,
-                                  num_classes=1)
-        elif args.arch.startswith('linknext'):
-            print('LinkNeXt101-32 activated')
-            model = LinkNeXt(num_channels=3,
-                              num_classes=1)            
-        elif args.arch.startswith('linknet50_full'):
-            print('Full linknet50 activated')
-            if args.preset in ['mul_ps_8channel','mul_8channel']:
-                model = LinkNet50_full(num_channels=8,
-                                  num_classes=1)
-            else:
-                model = LinkNet50_full(num_channels=3,
-                                  num_classes=1)               
-        elif args.arch.startswith('linknet50'):
-            print('Truncated linknet50 activated')
-            if args.preset in ['mul_ps_8channel','mul_8channel']:
-                model = LinkNet50(num_channels=8,
-                                  num_classes=1)
-            else:
-                model = LinkNet50(num_channels=3,
-                                  num_classes=1)            
-        elif args.arch.startswith('unet11'):
-            if args.preset in ['mul_ps_8channel','mul_8channel']:
-                model = UNet11(num_classes=1,
-                               num_channels=8)            
-            else:
-                model = UNet11(num_classes=1,
-                               num_channels=3,
-                               num_filters=32)
+        if args.ensemble:
+            if not (args.predict or args.predict_train) or not args.resume:
+                raise ValueError('--ensemble needs --resume and a predict mode')
+            # all the folds are loaded once, every batch is decoded once and predict runs a single time
+            model = load_ensemble(args.arch,
+                                  args.preset,
+                                  [args.resume + '_fold{}'.format(j) + '_best.pth.tar' for j in selected_folds],
+                                  device,
+                                  parallel=args.ensemble_threads)
         else:
-            raise ValueError('Model not supported')
+            # the ImageNet weights are only loaded when the fold checkpoint does not replace them
+            restore = args.resume and os.path.isfile(args.resume + '_fold{}'.format(i) + '_best.pth.tar')
+            model = get_model(args.arch, args.preset, pretrained=not (restore or args.no_pretrained))
 
-        # train on 2 GPUs for speed
-        # model = model.cuda()
-        model = torch.nn.DataParallel(model).cuda()        
+            # train on 2 GPUs for speed, or run on CPU
+            if args.distributed:
+                model = wrap_ddp(model, device)
+            else:
+                model = place_model(model, device)
         
         
         if not (args.predict or args.predict_train):
@@ -219,52 +273,73 @@ def main():
             print('Predict images: {}\n'.format(len(predict_imgs)))         
 
         # optionally resume from a checkpoint
-        if args.resume:
+        if args.resume and not args.ensemble:
             if os.path.isfile(args.resume + '_fold{}'.format(i) + '_best.pth.tar'):
                 print("=> loading checkpoint '{}'".format(args.resume + '_fold{}'.format(i) + '_best.pth.tar'))
-                checkpoint = torch.load(args.resume + '_fold{}'.format(i) + '_best.pth.tar' )
+                checkpoint = load_checkpoint(model, args.resume + '_fold{}'.format(i) + '_best.pth.tar')
                 args.start_epoch = checkpoint['epoch']
                 best_val_loss = checkpoint['best_val_loss']
-                model.load_state_dict(checkpoint['state_dict'])
                 print("=> loaded checkpoint '{}' (epoch {})"
                       .format(args.evaluate, checkpoint['epoch']))
             else:
                 print("=> no checkpoint found at '{}'".format(args.resume + '_fold{}'.format(i) + '_best.pth.tar'))
 
-        cudnn.benchmark = True
+        cudnn.benchmark = device.type == 'cuda'
 
         if not (args.predict or args.predict_train):
 
             train_augs = SatellitesTrainAugmentation(shape=args.imsize,
                                                      aug_scheme = args.augs)
 
-            val_augs = SatellitesTestAugmentation(shape=args.imsize)
+            val_augs = SatellitesTestAugmentation(shape=args.imsize, crop=not args.val_cache)
            
             train_dataset = SatellitesDataset(preset = preset_dict[args.preset],
                                               image_paths = bit8_imgs[fold[0]],
                                               mask_paths = bit8_masks[fold[0]],
                                               transforms = train_augs,
+                                              cache = cache,
+                                              with_city = True,
                                              )
 
             val_dataset = SatellitesDataset(preset = preset_dict[args.preset],
                                             image_paths = bit8_imgs[fold[1]],
                                             mask_paths = bit8_masks[fold[1]],
-                                            transforms = val_augs,
+                                            transforms = None if args.val_cache else val_augs,
+                                            cache = cache,
+                                            with_city = True,
                                            )
-
-            train_loader = torch.utils.data.DataLoader(
-                train_dataset,
-                batch_size=args.batch_size,        
-                shuffle=True,
-                num_workers=args.workers,
-                pin_memory=True)
-
-            val_loader = torch.utils.data.DataLoader(
-                val_dataset,
-                batch_size=args.batch_size,        
-                shuffle=True,
-                num_workers=args.workers,
-                pin_memory=True)
+            if args.val_cache:
+                # the same crops every epoch, decoded during the first one only
+                val_dataset = FixedCropDataset(val_dataset, args.imsize, val_augs, seed=args.seed)
+
+            if args.distributed:
+                train_loader = distributed_loader(train_dataset,
+                                                  batch_size=args.batch_size,
+                                                  shuffle=True,
+                                                  num_workers=args.workers,
+                                                  pin_memory=(device.type == 'cuda'),
+                                                  seed=args.seed)
+                # no padded duplicates, the reduced val metrics count every crop once
+                val_loader = distributed_loader(val_dataset,
+                                                batch_size=args.batch_size,
+                                                shuffle=False,
+                                                num_workers=args.workers,
+                                                pin_memory=(device.type == 'cuda'),
+                                                pad=False)
+            else:
+                train_loader = torch.utils.data.DataLoader(
+                    train_dataset,
+                    batch_size=args.batch_size,        
+                    shuffle=True,
+                    num_workers=args.workers,
+                    pin_memory=(device.type == 'cuda'))
+
+                val_loader = torch.utils.data.DataLoader(
+                    val_dataset,
+                    batch_size=args.batch_size,        
+                    shuffle=False,
+                    num_workers=args.workers,
+                    pin_memory=(device.type == 'cuda'))
 
         else:
             
@@ -287,32 +362,15 @@ def main():
                 batch_size=args.batch_size,        
                 shuffle=False,
                 num_workers=args.workers,
-                pin_memory=True)    
+                pin_memory=(device.type == 'cuda'))    
 
         # play with criteria?
-        criterion = TDiceLoss().cuda()
+        criterion = TDiceLoss().to(device)
         # criterion = DiceLoss().cuda()
 
-        if args.optimizer.startswith('adam'):           
-            optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), # Only finetunable params
-                                        lr = args.lr)
-        elif args.optimizer.startswith('rmsprop'):
-            optimizer = torch.optim.RMSprop(filter(lambda p: p.requires_grad, model.parameters()), # Only finetunable params
-                                        lr = args.lr)
-        else:
-            raise ValueError('Optimizer not supported')        
-
-        scheduler = ReduceLROnPlateau(optimizer = optimizer,
-                                                  mode = 'min',
-                                                  factor = 0.1,
-                                                  patience = 4,
-                                                  verbose = True,
-                                                  threshold = 1e-3,
-                                                  min_lr = 1e-5
-                                                 )    
         # if we pass evaluate or predict flat, training loop is omitted altogether
         if args.evaluate:
-            validate(val_loader, model, criterion)
+            validate(val_loader, model, criterion, device)
             return
 
         if args.predict or args.predict_train:
@@ -332,23 +390,47 @@ def main():
                     predict_city_folders,
                     predict_img_names,
                     predict_prefix,
-                    str(i)+tta_prefix)
+                    ('_ensemble' if args.ensemble else '_fold{}'.format(i)) + tta_prefix,
+                    device)
+            if args.ensemble:
+                break
         else:
+            # only the training path has parameters to optimize, an ensemble has none
+            if args.optimizer.startswith('adam'):           
+                optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), # Only finetunable params
+                                            lr = args.lr)
+            elif args.optimizer.startswith('rmsprop'):
+                optimizer = torch.optim.RMSprop(filter(lambda p: p.requires_grad, model.parameters()), # Only finetunable params
+                                            lr = args.lr)
+            else:
+                raise ValueError('Optimizer not supported')        
+
+            scheduler = ReduceLROnPlateau(optimizer = optimizer,
+                                                      mode = 'min',
+                                                      factor = 0.1,
+                                                      patience = 4,
+                                                      threshold = 1e-3,
+                                                      min_lr = 1e-5
+                                                     )
+            controller = TrainController(patience=args.patience,
+                                         min_delta=args.min_delta,
+                                         time_budget=parse_duration(args.time_budget),
+                                         scheduler=scheduler,
+                                         device=device)
             for epoch in range(args.start_epoch, args.epochs):
                 # adjust_learning_rate(optimizer, epoch)
 
                 # train for one epoch
-                train_loss = train(train_loader, model, criterion, optimizer, epoch)
+                set_loader_epoch(train_loader, epoch)
+                train_loss = train(train_loader, model, criterion, optimizer, epoch, device, controller)
 
                 # evaluate on validation set
-                val_loss = validate(val_loader, model, criterion)
+                val_loss = validate(val_loader, model, criterion, device)
 
+                lr = optimizer.param_groups[0]['lr']
                 scheduler.step(val_loss)
-
-                # add code for early stopping here 
-                # 
-                #
-
+                if optimizer.param_groups[0]['lr'] < lr:
+                    print(' * Reducing learning rate to {:.1e}'.format(optimizer.param_groups[0]['lr']))
 
                 #============ TensorBoard logging ============#
                 # Log the scalar values        
@@ -363,46 +445,68 @@ def main():
                 # remember best prec@1 and save checkpoint
                 is_best = val_loss < best_val_loss
                 best_val_loss = min(val_loss, best_val_loss)
-                save_checkpoint({
-                    'epoch': epoch + 1,
-                    'arch': args.arch,
-                    'state_dict': model.state_dict(),
-                    'best_val_loss': best_val_loss,
-                },
-                is_best,
-                'weights/{}_checkpoint.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i))),
-                'weights/{}_best.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i)))
-                )
-
-def train(train_loader, model, criterion, optimizer, epoch):
+                if is_best:
+                    best_epoch = epoch + 1
+                if is_main_process():
+                    save_checkpoint({
+                        'epoch': epoch + 1,
+                        'arch': args.arch,
+                        'state_dict': model.state_dict(),
+                        'best_val_loss': best_val_loss,
+                    },
+                    is_best,
+                    'weights/{}_checkpoint.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i))),
+                    'weights/{}_best.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i)))
+                    )
+
+                # the checkpoint of the last epoch is saved before stopping
+                if controller.step(val_loss):
+                    break
+
+            # the summary points to checkpoints that are on disk
+            checkpoint_writer.flush()
+            summary[i] = {
+                'best_val_loss': best_val_loss,
+                'best_epoch': best_epoch,
+                'epochs': controller.epochs,
+                'stop_reason': controller.reason,
+                'seconds': time.time() - fold_start,
+                'checkpoint': 'weights/{}_checkpoint.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i))),
+                'best_checkpoint': 'weights/{}_best.pth.tar'.format(str(args.lognumber + '_fold{}'.format(i))),
+            }
+            if args.summary and is_main_process():
+                with open(args.summary, 'w') as f:
+                    json.dump(summary, f, indent=2)
+
+    cleanup()
+
+def train(train_loader, model, criterion, optimizer, epoch, device, controller=None):
     global train_minib_counter
     global logger
         
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
+    # loss and per city dice / IoU are summed on the device
+    meter = SegmentationMeter(city_names, device)
 
     # switch to train mode
     model.train()
 
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    for i, (input, target, city) in enumerate(train_loader):
 
         # measure data loading time
         data_time.update(time.time() - end)
 
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
 
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-        
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        output = model(input)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target, city)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -413,108 +517,111 @@ def train(train_loader, model, criterion, optimizer, epoch):
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'train_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, train_minib_counter)                
-        
         train_minib_counter += 1
         
+        # the sums are only copied to the host here
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'train_loss': metrics['loss_last'],
+                    'train_dice': metrics['dice'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, train_minib_counter)                
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   epoch, i, len(train_loader), batch_time=batch_time,
-                   data_time=data_time, loss=losses))
-
-    print(' * Avg Train Loss {loss.avg:.4f}'.format(loss=losses))         
+                  'Loss {3:.4f} ({4:.4f})\t'
+                  'Dice {5:.4f}\tIoU {6:.4f}\t'.format(
+                   epoch, i, len(train_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time, data_time=data_time))
+
+        # a long epoch is cut once the time budget is spent
+        if controller is not None and controller.out_of_time(i):
+            break
+
+    # the same epoch metrics on every process
+    metrics = meter.summary(all_reduce=True)
+    print(' * Avg Train Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
+    print(' * ' + format_city_metrics(metrics, city_names))
             
-    return losses.avg
+    return metrics['loss']
 
-def validate(val_loader, model, criterion):
+@torch.no_grad()
+def validate(val_loader, model, criterion, device):
     global valid_minib_counter
     global logger
     
     batch_time = AverageMeter()
-    losses = AverageMeter()
+    meter = SegmentationMeter(city_names, device)
 
-    # switch to evaluate mode
+    # switch to evaluate mode, outside of DDP on the uneven val shards
+    model = eval_model(model)
     model.eval()
 
     end = time.time()
-    for i, (input, target) in enumerate(val_loader):
+    for i, (input, target, city) in enumerate(val_loader):
         
-        input = input.float().cuda(async=True)
-        target = target.float().cuda(async=True)
-        
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
+        input = input.float().to(device, non_blocking=True)
+        target = target.float().to(device, non_blocking=True)
 
         # compute output
-        output = model(input_var)
+        output = model(input)
         
         
         #============ TensorBoard logging ============#              
-        # Show original images
-        if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'images': to_np(input.view(-1,len(preset_dict[args.preset]['channels']),args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)
-        # Show masks
+        # Show original images, masks and the output masks
+        # thumbnails are copied without a sync and PNG encoded by the logger encoder thread
         if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'masks': to_np(target.view(-1,args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)                  
-        # Show the output masks
-        if args.tensorboard_images:
-            if i % args.print_freq == 0:
-                info = {
-                    'preds': to_np(output.data.view(-1,args.imsize, args.imsize)[:5])
-                }
-                for tag, images in info.items():
-                    logger.image_summary(tag, images, train_minib_counter)  
+            if i % (args.image_freq or args.print_freq) == 0:
+                logger.snapshot_images('images', input, train_minib_counter, args.image_count, args.image_size)
+                logger.snapshot_images('masks', target, train_minib_counter, args.image_count, args.image_size)
+                logger.snapshot_images('preds', output, train_minib_counter, args.image_count, args.image_size)
         
         
-        loss = criterion(output, target_var)
+        loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        losses.update(loss.data[0], input.size(0))
+        # record loss and accuracy without waiting for the device
+        meter.update(loss, output, target, city)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        #============ TensorBoard logging ============#
-        # Log the scalar values        
-        if args.tensorboard:
-            info = {
-                'valid_loss': losses.val,
-            }
-            for tag, value in info.items():
-                logger.scalar_summary(tag, value, valid_minib_counter)            
-        
         valid_minib_counter += 1
         
         if i % args.print_freq == 0:
+            metrics = meter.summary()
+            #============ TensorBoard logging ============#
+            # Log the scalar values        
+            if args.tensorboard:
+                info = {
+                    'valid_loss': metrics['loss_last'],
+                }
+                for tag, value in info.items():
+                    logger.scalar_summary(tag, value, valid_minib_counter)            
             print('Test: [{0}/{1}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                   i, len(val_loader), batch_time=batch_time, loss=losses))
+                  'Loss {2:.4f} ({3:.4f})\t'
+                  'Dice {4:.4f}\tIoU {5:.4f}\t'.format(
+                   i, len(val_loader), metrics['loss_last'], metrics['loss'],
+                   metrics['dice'], metrics['iou'], batch_time=batch_time))
+
+    # the scheduler and the best checkpoint see the loss of the whole validation set
+    metrics = meter.summary(all_reduce=True)
+    print(' * Avg Val Loss {:.4f} Dice {:.4f} IoU {:.4f}'.format(metrics['loss'], metrics['dice'], metrics['iou']))
+    print(' * ' + format_city_metrics(metrics, city_names))
 
-    print(' * Avg Val Loss {loss.avg:.4f}'.format(loss=losses))
+    #============ TensorBoard logging ============#
+    if args.tensorboard:
+        for tag, value in metrics.items():
+            if tag.startswith('dice') or tag.startswith('iou'):
+                logger.scalar_summary('valid_' + tag, value, valid_minib_counter)
 
-    return losses.avg
+    return metrics['loss']
 
 def predict(predict_loader,
             model,
@@ -522,7 +629,8 @@ def predict(predict_loader,
             predict_city_folders,
             predict_img_names,
             predict_prefix,
-            fold_number):
+            folder_suffix,
+            device):
     
     global valid_minib_counter
     global logger
@@ -534,29 +642,21 @@ def predict(predict_loader,
     
     print(len(predict_img_names))
 
-    with tqdm.tqdm(total=len(predict_loader)) as pbar:
+    writer = PredictionWriter(args.write_format, args.writer_threads, args.writer_queue)
+
+    with tqdm.tqdm(total=len(predict_loader)) as pbar, torch.no_grad():
         for i, (input) in enumerate(predict_loader):
 
-            input = input.float().cuda(async=True)
-            input_var = torch.autograd.Variable(input, volatile=True)
+            input = input.float().to(device, non_blocking=True)
 
             # compute output
-            output = model(input_var)
+            output = model(input)
             
-            for pred_image in output:
+            # one device to host copy per batch, encoding and writing happen in the writer threads
+            for pred_image in output.cpu().numpy():
 
-                prediction_folder = os.path.join(predict_prefix,predict_city_folders[c],args.lognumber + '_fold{}'.format(fold_number))
-                
-                # check that prediction folder exists
-                if not os.path.exists(prediction_folder):
-                    os.mkdir(prediction_folder)                    
-                
-                # print(c)
-                # print(predict_img_names[c])
-                im_path = os.path.join(prediction_folder,predict_img_names[c][:-3]+'jpg')
-                
-                # save image to disk
-                imsave(im_path,pred_image.data.cpu().numpy()[0,:,:])
+                prediction_folder = os.path.join(predict_prefix,predict_city_folders[c],args.lognumber + folder_suffix)
+                writer.submit(pred_image[0,:,:], prediction_folder, predict_img_names[c][:-4])
                 
                 c+=1
 
@@ -565,12 +665,13 @@ def predict(predict_loader,
             
             pbar.update(1)            
 
+    # the last masks are on disk before predict returns
+    writer.close()
     return 1
 
 def save_checkpoint(state, is_best, filename, best_filename):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, best_filename)
+    # copied to the CPU here, written in the background, best is a hardlink
+    checkpoint_writer.save(state, is_best, filename, best_filename)
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""